@@ -1,58 +1,136 @@
 import json
 import os
 import uuid
-import boto3
-from common.dynamodb import put_item
+from common import query_store
+from common.dynamodb import batch_write_items, put_item
 from common.auth import check_api_key
-from common.logging import setup_logger
+from common.logging import instrument_handler, setup_logger
+from common.notify import is_valid_callback_url
+from common.responses import request_body
+from common.sqs import send_message, send_messages
 
 logger = setup_logger()
-# sqs = boto3.client("sqs")
 
 QUEUE_URL = os.environ["AI_SQS_QUEUE"]
 TABLE = os.environ["AI_QUERIES_TABLE"]
+# Upper bound on prompts accepted by POST /ai/query/batch.
+MAX_BATCH_PROMPTS = int(os.environ.get("AI_MAX_BATCH_PROMPTS", 50))
 
 
-def lambda_handler(event, context):
-    logger.info("----handler start: ai_agent_lambda")
-    if not check_api_key(event):
-        return {"statusCode": 403, "body": "Forbidden"}
+def _message(item, body):
+    message = {
+        "query_id": item["query_id"],
+        "prompt": item["prompt"],
+        "no_cache": bool(body.get("no_cache")),
+    }
+    if "stream" in body:
+        message["stream"] = bool(body["stream"])
+    if item.get("callback_url"):
+        message["callback_url"] = item["callback_url"]
+    return json.dumps(message)
+
+
+def _callback_url(body):
+    """Returns (callback_url, error response)."""
+    url = body.get("callback_url")
+    if url is not None and not is_valid_callback_url(url):
+        return None, {"statusCode": 400, "body": "Invalid callback_url"}
+    return url, None
 
-    body = json.loads(event.get("body") or "{}")
+
+def _query_item(prompt, callback_url):
+    item = {
+        "query_id": str(uuid.uuid4()),
+        "prompt": prompt,
+        "status": "QUEUED",
+        "expires_at": query_store.expires_at(),
+    }
+    if callback_url:
+        item["callback_url"] = callback_url
+    return item
+
+
+def submit_query(body):
     prompt = body.get("prompt")
     if not prompt:
         return {"statusCode": 400, "body": "Missing prompt"}
 
-    query_id = str(uuid.uuid4())
+    callback_url, error = _callback_url(body)
+    if error:
+        return error
+
+    item = _query_item(prompt, callback_url)
+    query_id = item["query_id"]
     # Store initial status in DynamoDB
-    put_item(TABLE, {"query_id": query_id, "prompt": prompt, "status": "QUEUED"})
-
-    MOCK_AWS = os.environ.get("MOCK_AWS", "false").lower() == "true"
-    if MOCK_AWS:
-        # This block is for demo purposes only. for realworld testing, seperate mock project would be created.
-        print("----MOCK_AWS_LocalStack---")
-        sqs = boto3.client(
-            "sqs",
-            region_name="us-east-1",
-            endpoint_url="http://127.0.0.1:4566",  # "http://host.docker.internal:4566",
-            aws_access_key_id="test",
-            aws_secret_access_key="test",
-        )
-        QUEUE_URL = "ai-query-queue"
-        response = sqs.create_queue(QueueName=QUEUE_URL)
-        print(f"Que created {response['QueueUrl']}")
-
-    else:
-        sqs = boto3.client("sqs")
+    put_item(TABLE, item)
 
     # Enqueue the request
-    sqs.send_message(
-        QueueUrl=QUEUE_URL,
-        MessageBody=json.dumps({"query_id": query_id, "prompt": prompt}),
-    )
+    send_message(QUEUE_URL, _message(item, body))
 
     logger.info(f"\nEnqueued AI query: {query_id}")
     return {
         "statusCode": 202,
         "body": json.dumps({"query_id": query_id, "status": "QUEUED"}),
     }
+
+
+def submit_batch(body):
+    """
+    Accepts up to MAX_BATCH_PROMPTS prompts: the QUEUED rows are written with
+    BatchWriteItem and the messages sent with SendMessageBatch.
+    """
+    prompts = body.get("prompts")
+    if not isinstance(prompts, list) or not prompts:
+        return {"statusCode": 400, "body": "Missing prompts"}
+    if len(prompts) > MAX_BATCH_PROMPTS:
+        return {
+            "statusCode": 400,
+            "body": f"At most {MAX_BATCH_PROMPTS} prompts per batch",
+        }
+    if not all(isinstance(prompt, str) and prompt for prompt in prompts):
+        return {"statusCode": 400, "body": "Prompts must be non-empty strings"}
+
+    callback_url, error = _callback_url(body)
+    if error:
+        return error
+
+    items = [_query_item(prompt, callback_url) for prompt in prompts]
+    # The rows must exist before a worker can pick the messages up.
+    counts = batch_write_items(TABLE, items)
+    if counts["failed"]:
+        logger.error(f"Could not store {counts['failed']} of {len(items)} queries")
+        return {"statusCode": 503, "body": "Could not store queries, retry later"}
+
+    failed = send_messages(QUEUE_URL, [_message(item, body) for item in items])
+    for index in failed:
+        items[index]["status"] = "FAILED"
+        items[index]["error"] = "Could not enqueue query"
+    if failed:
+        batch_write_items(TABLE, [items[index] for index in failed])
+
+    logger.info(f"\nEnqueued {len(items) - len(failed)} AI queries")
+    return {
+        "statusCode": 202,
+        "body": json.dumps(
+            {
+                "query_ids": [item["query_id"] for item in items],
+                "queries": [
+                    {"query_id": item["query_id"], "status": item["status"]}
+                    for item in items
+                ],
+            }
+        ),
+    }
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    logger.info("----handler start: ai_agent_lambda")
+    if not check_api_key(event):
+        return {"statusCode": 403, "body": "Forbidden"}
+
+    body = request_body(event)
+    path = event.get("resource") or event.get("path") or ""
+    if path.endswith("/batch"):
+        return submit_batch(body)
+    return submit_query(body)
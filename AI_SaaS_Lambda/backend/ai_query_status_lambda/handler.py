@@ -1,20 +1,139 @@
 import os
-import json
-from common.dynamodb import get_item
+import hashlib
+import time
+from common import query_store
 from common.auth import check_api_key
-from common.logging import setup_logger
+from common.logging import instrument_handler, setup_logger
+from common.notify import TERMINAL_STATUSES, payload
+from common.responses import dumps, header, request_body, respond
 
 logger = setup_logger()
-TABLE = os.environ["AI_QUERIES_TABLE"]
+# Long-poll bounds. API Gateway cuts integrations off after 29 seconds.
+MAX_WAIT_SECONDS = float(os.environ.get("STATUS_MAX_WAIT_SECONDS", 20))
+POLL_INTERVAL_SECONDS = float(os.environ.get("STATUS_POLL_INTERVAL_SECONDS", 0.5))
+MAX_POLL_INTERVAL_SECONDS = 2.0
+# Upper bound on query_ids accepted by POST /ai/query/status.
+MAX_BATCH_IDS = int(os.environ.get("STATUS_MAX_BATCH_IDS", 100))
 
 
-def lambda_handler(event, context):
-    if not check_api_key(event):
-        return {"statusCode": 403, "body": "Forbidden"}
-    query_id = event.get("pathParameters", {}).get("id")
+def _etag(body):
+    digest = hashlib.sha1(body).hexdigest()
+    return f'"{digest}"'
+
+
+def _wait_seconds(requested, context):
+    try:
+        wait = float(requested or 0)
+    except (TypeError, ValueError):
+        wait = 0.0
+    wait = max(0.0, min(wait, MAX_WAIT_SECONDS))
+    if context is not None:
+        # Leave a second to build the response before the function times out.
+        wait = min(wait, context.get_remaining_time_in_millis() / 1000.0 - 1)
+    return wait
+
+
+def long_poll(fetch, is_done, wait, if_none_match):
+    """
+    Calls fetch() until is_done(result) holds, the serialized result no longer
+    matches if_none_match, or wait seconds pass. Returns (result, body, etag);
+    result is None when fetch found nothing.
+    """
+    deadline = time.time() + wait
+    interval = POLL_INTERVAL_SECONDS
+    while True:
+        result = fetch()
+        if result is None:
+            return None, None, None
+        body = dumps(result, sort_keys=True)
+        etag = _etag(body)
+        changed = etag != if_none_match
+        if (
+            is_done(result)
+            or (if_none_match and changed)
+            or time.time() + interval > deadline
+        ):
+            return result, body, etag
+        time.sleep(interval)
+        interval = min(interval * 2, MAX_POLL_INTERVAL_SECONDS)
+
+
+def _respond(event, body, etag, if_none_match):
+    if etag == if_none_match:
+        return {"statusCode": 304, "headers": {"ETag": etag}, "body": ""}
+    return respond(event, body=body, headers={"ETag": etag})
+
+
+def get_status(event, context):
+    """
+    GET /ai/query/{id}[?wait=seconds]. With wait the request is held until the
+    query finishes or, when If-None-Match is sent, until it changes.
+    """
+    query_id = (event.get("pathParameters") or {}).get("id")
     if not query_id:
         return {"statusCode": 400, "body": "Missing query_id"}
-    item = get_item(TABLE, {"query_id": query_id})
-    if not item:
+    params = event.get("queryStringParameters") or {}
+    if_none_match = header(event, "If-None-Match")
+
+    def fetch():
+        item = query_store.get(query_id)
+        return payload(item) if item else None
+
+    item, body, etag = long_poll(
+        fetch,
+        lambda item: item.get("status") in TERMINAL_STATUSES,
+        _wait_seconds(params.get("wait"), context),
+        if_none_match,
+    )
+    if item is None:
         return {"statusCode": 404, "body": "Not found"}
-    return {"statusCode": 200, "body": json.dumps(item)}
+    return _respond(event, body, etag, if_none_match)
+
+
+def get_batch_status(event, context):
+    """
+    POST /ai/query/status with {"query_ids": [...], "wait": seconds}. Looks the
+    queries up with BatchGetItem; wait holds the request until all finished.
+    """
+    try:
+        request = request_body(event)
+    except ValueError:
+        return {"statusCode": 400, "body": "Invalid JSON body"}
+    if not isinstance(request, dict):
+        return {"statusCode": 400, "body": "Invalid JSON body"}
+    query_ids = request.get("query_ids")
+    if not isinstance(query_ids, list) or not query_ids:
+        return {"statusCode": 400, "body": "Missing query_ids"}
+    query_ids = list(dict.fromkeys(str(query_id) for query_id in query_ids))
+    if len(query_ids) > MAX_BATCH_IDS:
+        return {"statusCode": 400, "body": f"At most {MAX_BATCH_IDS} query_ids"}
+    if_none_match = header(event, "If-None-Match")
+
+    def fetch():
+        found = {item["query_id"]: item for item in query_store.batch_get(query_ids)}
+        return {
+            "queries": [payload(found[i]) for i in query_ids if i in found],
+            "missing": [i for i in query_ids if i not in found],
+        }
+
+    def all_done(result):
+        return all(q.get("status") in TERMINAL_STATUSES for q in result["queries"])
+
+    _, body, etag = long_poll(
+        fetch,
+        all_done,
+        _wait_seconds(request.get("wait"), context),
+        if_none_match,
+    )
+    return _respond(event, body, etag, if_none_match)
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    if not check_api_key(event):
+        return {"statusCode": 403, "body": "Forbidden"}
+    if event.get("httpMethod") == "POST" or (event.get("resource") or "").endswith(
+        "/status"
+    ):
+        return get_batch_status(event, context)
+    return get_status(event, context)
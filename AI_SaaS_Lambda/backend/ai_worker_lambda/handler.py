@@ -1,41 +1,192 @@
 import json
 import os
-from common.dynamodb import put_item
-from common.openai_agent import process_query
-from common.logging import setup_logger
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from common import query_store, response_cache, single_flight
+from common.dynamodb import get_item
+from common.openai_agent import MAX_TOKENS, cache_key, process_query
+from common.dataset_snapshot import estimate_tokens, load_snapshot_text
+from common.logging import bind, instrument_handler, setup_logger
+from common.notify import TERMINAL_STATUSES, notify_completed
+from common.rate_limit import RetryableError
 
 logger = setup_logger()
 TABLE = os.environ["AI_QUERIES_TABLE"]
+# Maximum number of records of one SQS batch processed at the same time.
+WORKER_CONCURRENCY = int(os.environ.get("AI_WORKER_CONCURRENCY", 5))
+# Stream answers into the item by default; a message can also ask with "stream".
+STREAM_RESPONSES = os.environ.get("AI_STREAM_RESPONSES", "false").lower() == "true"
+# Partial responses are written at most this often, and only once this many
+# new characters arrived, which caps the write units one answer can use.
+STREAM_FLUSH_SECONDS = float(os.environ.get("AI_STREAM_FLUSH_SECONDS", 1.0))
+STREAM_FLUSH_MIN_CHARS = int(os.environ.get("AI_STREAM_FLUSH_MIN_CHARS", 200))
+# Identical cacheable queries in flight at the same time share one model call.
+COALESCE_QUERIES = os.environ.get("AI_COALESCE_QUERIES", "true").lower() == "true"
 
 
-def lambda_handler(event, context):
-    logger.info("handler start: ai_worker_lambda")
-    for record in event["Records"]:
-        body = json.loads(record["body"])
-        query_id = body["query_id"]
-        prompt = body["prompt"]
+def partial_writer(query_id):
+    """Returns an on_partial callback that persists the growing response."""
+    flushed = {"at": 0.0, "chars": 0}
+
+    def on_partial(text):
+        now = time.time()
+        if (
+            now - flushed["at"] < STREAM_FLUSH_SECONDS
+            or len(text) - flushed["chars"] < STREAM_FLUSH_MIN_CHARS
+        ):
+            return
+        flushed.update({"at": now, "chars": len(text)})
+        progress = {
+            "tokens": estimate_tokens(text),
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }
+        if MAX_TOKENS:
+            progress["percent"] = min(99, progress["tokens"] * 100 // MAX_TOKENS)
         try:
-            # Fetch dataset from DynamoDB or use a mock
-            dataset = "Sample customer data from DynamoDB"
-            ai_response = process_query(prompt, dataset)
-            put_item(
-                TABLE,
-                {
-                    "query_id": query_id,
-                    "prompt": prompt,
-                    "response": ai_response,
-                    "status": "COMPLETED",
-                },
+            query_store.update(
+                query_id,
+                {"status": "STREAMING", "response": text, "progress": progress},
             )
-            logger.info(f"Processed AI query: {query_id}")
         except Exception as e:
-            put_item(
-                TABLE,
-                {
-                    "query_id": query_id,
-                    "prompt": prompt,
-                    "status": "FAILED",
-                    "error": str(e),
-                },
-            )
-            logger.error(f"Failed to process AI query {query_id}: {e}")
+            # Partials are a preview only; the final result is still written.
+            logger.warning(f"Could not store partial response for {query_id}: {e}")
+
+    return on_partial
+
+
+def _redelivered(record):
+    return int(record.get("attributes", {}).get("ApproximateReceiveCount", 1)) > 1
+
+
+def _lease(key, query_id):
+    """
+    Takes the single-flight lease for key, returning the key when held.
+    Raises single_flight.Coalesced when another query is computing it.
+    """
+    if response_cache.get(key) is not None:
+        return None  # answered from the cache, nothing to coalesce
+    try:
+        single_flight.acquire(key, query_id)
+    except single_flight.Coalesced:
+        raise
+    except Exception as e:
+        # The lease only saves duplicate work; never fail a query over it.
+        logger.warning(f"Could not take the lease for {query_id}: {e}")
+        return None
+    return key
+
+
+def process_record(record, dataset):
+    """
+    Runs one SQS record through the model and stores the outcome. Returns
+    its final status item (None when the query was already resolved) and
+    the items of coalesced queries resolved along with it.
+    """
+    body = json.loads(record["body"])
+    query_id = body["query_id"]
+    with bind(query_id=query_id):
+        return _process(record, body, query_id, dataset)
+
+
+def _process(record, body, query_id, dataset):
+    prompt = body["prompt"]
+    if _redelivered(record):
+        # A coalesced query is resolved by its owner; its retry only checks.
+        current = get_item(TABLE, {"query_id": query_id})
+        if current and current.get("status") in TERMINAL_STATUSES:
+            logger.info(f"AI query {query_id} was already resolved")
+            return None, []
+    # Clients may opt out of cached answers per request.
+    use_cache = not body.get("no_cache", False)
+    stream = body.get("stream", STREAM_RESPONSES)
+    item = {"query_id": query_id, "prompt": prompt}
+    if body.get("callback_url"):
+        item["callback_url"] = body["callback_url"]
+    lease = retry = None
+    if use_cache and COALESCE_QUERIES:
+        lease = _lease(cache_key(prompt, dataset), query_id)
+    try:
+        ai_response = process_query(
+            prompt,
+            dataset,
+            use_cache=use_cache,
+            on_partial=partial_writer(query_id) if stream else None,
+        )
+        logger.info(f"Processed AI query: {query_id}")
+        item.update({"response": ai_response, "status": "COMPLETED"})
+    except RetryableError as e:
+        # Throttled past the retry budget: SQS redelivers it, nothing is stored.
+        retry = e
+    except Exception as e:
+        logger.error(f"Failed to process AI query {query_id}: {e}")
+        item.update({"status": "FAILED", "error": str(e)})
+
+    resolved = []
+    if lease:
+        try:
+            waiters = single_flight.release(lease, query_id)
+            # Without an answer the waiters' own redeliveries compute it.
+            if retry is None:
+                resolved = single_flight.resolve_waiters(waiters, item)
+        except Exception as e:
+            # Waiters fall back to their redelivered messages and the cache.
+            logger.error(f"Could not release the lease of {query_id}: {e}")
+    if retry is not None:
+        raise retry
+    # One UpdateItem per query, from this thread: only the fields that changed
+    # are written, which a BatchWriteItem put cannot do.
+    try:
+        query_store.finish(item)
+    except Exception as e:
+        logger.error(f"Failed to store AI query result {query_id}: {e}")
+        # The waiters' rows are already stored; the redelivery will not resolve them.
+        notify_completed(resolved)
+        raise
+    return item, resolved
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    """
+    Processes a batch of SQS records concurrently and reports the records
+    that must be redelivered through batchItemFailures.
+    """
+    logger.info("handler start: ai_worker_lambda")
+    records = event["Records"]
+    # One compact, warm-cached snapshot of the Customers table serves the batch.
+    dataset = load_snapshot_text()
+    failures = []
+    results = []
+    resolved = []
+
+    workers = max(1, min(WORKER_CONCURRENCY, len(records)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(process_record, record, dataset) for record in records
+        ]
+        for record, future in zip(records, futures):
+            try:
+                item, coalesced = future.result()
+            except single_flight.Coalesced as e:
+                # Resolved by the owning query; the redelivery is only a fallback.
+                logger.info(f"Coalesced SQS message {record.get('messageId')}: {e}")
+                failures.append({"itemIdentifier": record.get("messageId")})
+                continue
+            except RetryableError as e:
+                logger.warning(f"Returning SQS message to the queue: {e}")
+                failures.append({"itemIdentifier": record.get("messageId")})
+                continue
+            except Exception as e:
+                # Malformed messages never reach the model; let SQS redeliver them.
+                logger.error(f"Could not process SQS message: {e}")
+                failures.append({"itemIdentifier": record.get("messageId")})
+                continue
+            if item is not None:
+                results.append(item)
+            resolved.extend(coalesced)
+
+    # Only stored results are announced; webhooks are best effort.
+    notify_completed(resolved + results)
+
+    return {"batchItemFailures": failures}
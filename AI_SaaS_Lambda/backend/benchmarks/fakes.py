@@ -0,0 +1,439 @@
+"""
+In-process fakes for the services the Lambda handlers talk to.
+
+They implement just enough of the boto3, requests.Session and openai 0.28
+surfaces for the handlers to run offline. Every call can be delayed by a
+configurable latency so network cost is part of the measurement.
+ConditionExpressions are accepted but not evaluated: the fakes model cost,
+not DynamoDB semantics.
+"""
+
+import copy
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+# Milliseconds added to every call, per service.
+LATENCY_MS = {"dynamodb": 0.0, "sqs": 0.0, "ssm": 0.0, "salesforce": 0.0, "openai": 0.0}
+# Relative random jitter applied to the latency (0.1 = +/-10%).
+JITTER = 0.1
+
+
+def configure_latency(latency_ms, jitter=JITTER):
+    global JITTER
+    LATENCY_MS.update(latency_ms)
+    JITTER = jitter
+
+
+def _wait(service):
+    delay = LATENCY_MS.get(service, 0.0)
+    if delay > 0:
+        time.sleep(delay * random.uniform(1 - JITTER, 1 + JITTER) / 1000.0)
+
+
+# --- DynamoDB -----------------------------------------------------------------
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+KEY_SCHEMAS = {
+    "Customers": "Id",
+    "AIQueries": "query_id",
+    "AIResponseCache": "cache_key",
+    "SyncState": "state_id",
+}
+
+
+def _projection(item, expression, names):
+    if not expression:
+        return copy.deepcopy(item)
+    names = names or {}
+    fields = [names.get(part.strip(), part.strip()) for part in expression.split(",")]
+    return {k: copy.deepcopy(item[k]) for k in fields if k in item}
+
+
+class FakeBatchWriter:
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+
+class FakeTable:
+    def __init__(self, name):
+        self.name = name
+        self.hash_key = KEY_SCHEMAS.get(name, "id")
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        _wait("dynamodb")
+
+    def wait_until_exists(self):
+        pass
+
+    def put_item(self, Item, **kwargs):
+        _wait("dynamodb")
+        with self.lock:
+            self.items[Item[self.hash_key]] = copy.deepcopy(Item)
+        return {}
+
+    def get_item(self, Key, ProjectionExpression=None, **kwargs):
+        _wait("dynamodb")
+        with self.lock:
+            item = self.items.get(Key[self.hash_key])
+        if item is None:
+            return {}
+        names = kwargs.get("ExpressionAttributeNames")
+        return {"Item": _projection(item, ProjectionExpression, names)}
+
+    def update_item(self, Key, UpdateExpression, **kwargs):
+        """
+        Supports the "SET #a = :a, ... [REMOVE #r, ...]" and "ADD #a :n"
+        expressions the handlers build.
+        """
+        _wait("dynamodb")
+        names = kwargs.get("ExpressionAttributeNames") or {}
+        values = kwargs.get("ExpressionAttributeValues") or {}
+        with self.lock:
+            item = self.items.setdefault(Key[self.hash_key], dict(Key))
+            if UpdateExpression.startswith("ADD"):
+                name, value = UpdateExpression[3:].split()
+                name = names.get(name, name)
+                item[name] = item.get(name, 0) + values[value]
+                return {"Attributes": {name: item[name]}}
+            assignments, _, removed = UpdateExpression.partition(" REMOVE ")
+            for assignment in assignments.split("SET", 1)[1].split(","):
+                name, value = (part.strip() for part in assignment.split("="))
+                item[names.get(name, name)] = copy.deepcopy(values[value])
+            for name in removed.split(",") if removed else []:
+                item.pop(names.get(name.strip(), name.strip()), None)
+            if kwargs.get("ReturnValues") == "ALL_NEW":
+                return {"Attributes": copy.deepcopy(item)}
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        _wait("dynamodb")
+        with self.lock:
+            old = self.items.pop(Key[self.hash_key], None)
+        if kwargs.get("ReturnValues") == "ALL_OLD" and old is not None:
+            return {"Attributes": old}
+        return {}
+
+    def scan(self, **kwargs):
+        _wait("dynamodb")
+        with self.lock:
+            keys = list(self.items)
+        total = kwargs.get("TotalSegments")
+        if total:
+            segment = kwargs["Segment"]
+            keys = [k for k in keys if hash(k) % total == segment]
+        start = kwargs.get("ExclusiveStartKey")
+        if start:
+            keys = keys[keys.index(start[self.hash_key]) + 1 :]
+        limit = kwargs.get("Limit") or len(keys)
+        page = keys[:limit]
+        with self.lock:
+            items = [
+                _projection(
+                    self.items[k],
+                    kwargs.get("ProjectionExpression"),
+                    kwargs.get("ExpressionAttributeNames"),
+                )
+                for k in page
+                if k in self.items
+            ]
+        response = {"Items": items, "Count": len(items)}
+        if len(keys) > limit:
+            response["LastEvaluatedKey"] = {self.hash_key: page[-1]}
+        return response
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return FakeBatchWriter(self)
+
+
+def get_fake_table(name):
+    with _tables_lock:
+        if name not in _tables:
+            _tables[name] = FakeTable(name)
+        return _tables[name]
+
+
+def reset_tables():
+    with _tables_lock:
+        _tables.clear()
+
+
+class FakeDynamoDBResource:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def Table(self, name):
+        return get_fake_table(name)
+
+    def batch_write_item(self, RequestItems):
+        _wait("dynamodb")
+        for name, requests in RequestItems.items():
+            table = get_fake_table(name)
+            for request in requests:
+                if "PutRequest" in request:
+                    item = request["PutRequest"]["Item"]
+                    with table.lock:
+                        table.items[item[table.hash_key]] = copy.deepcopy(item)
+                else:
+                    key = request["DeleteRequest"]["Key"]
+                    with table.lock:
+                        table.items.pop(key[table.hash_key], None)
+        return {"UnprocessedItems": {}}
+
+    def batch_get_item(self, RequestItems):
+        _wait("dynamodb")
+        responses = {}
+        for name, request in RequestItems.items():
+            table = get_fake_table(name)
+            found = []
+            with table.lock:
+                for key in request["Keys"]:
+                    item = table.items.get(key[table.hash_key])
+                    if item is not None:
+                        found.append(
+                            _projection(
+                                item,
+                                request.get("ProjectionExpression"),
+                                request.get("ExpressionAttributeNames"),
+                            )
+                        )
+            responses[name] = found
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+
+# --- SQS and SSM --------------------------------------------------------------
+
+
+class FakeSQSClient:
+    def __init__(self):
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def create_queue(self, QueueName, **kwargs):
+        _wait("sqs")
+        return {"QueueUrl": f"https://sqs.fake/{QueueName}"}
+
+    def get_queue_url(self, QueueName, **kwargs):
+        _wait("sqs")
+        return {"QueueUrl": f"https://sqs.fake/{QueueName}"}
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        _wait("sqs")
+        with self.lock:
+            self.messages.append(MessageBody)
+        return {"MessageId": str(uuid.uuid4())}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        _wait("sqs")
+        with self.lock:
+            self.messages.extend(entry["MessageBody"] for entry in Entries)
+        return {
+            "Successful": [
+                {"Id": e["Id"], "MessageId": str(uuid.uuid4())} for e in Entries
+            ],
+            "Failed": [],
+        }
+
+
+class FakeSSMClient:
+    class exceptions:
+        class ParameterNotFound(Exception):
+            pass
+
+    def __init__(self):
+        self.parameters = {}
+
+    def get_parameter(self, Name, **kwargs):
+        _wait("ssm")
+        if Name not in self.parameters:
+            raise self.exceptions.ParameterNotFound(Name)
+        return {"Parameter": {"Name": Name, "Value": self.parameters[Name]}}
+
+    def put_parameter(self, Name, Value, **kwargs):
+        _wait("ssm")
+        self.parameters[Name] = Value
+        return {"Version": 1}
+
+
+_clients = {}
+
+
+def fake_client(service_name, *args, **kwargs):
+    """Drop-in replacement for boto3.client; one shared fake per service."""
+    factories = {"sqs": FakeSQSClient, "ssm": FakeSSMClient}
+    if service_name not in _clients:
+        _clients[service_name] = factories[service_name]()
+    return _clients[service_name]
+
+
+def fake_resource(service_name, *args, **kwargs):
+    """Drop-in replacement for boto3.resource."""
+    if service_name != "dynamodb":
+        raise ValueError(f"No fake resource for {service_name}")
+    return FakeDynamoDBResource()
+
+
+# --- Salesforce ---------------------------------------------------------------
+
+
+class FakeResponse:
+    def __init__(self, body=None, status_code=200, text=None, headers=None):
+        self._body = body
+        self.status_code = status_code
+        self.text = text if text is not None else json.dumps(body)
+        self.headers = headers or {}
+        self.encoding = "utf-8"
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for start in range(0, len(self.text), chunk_size):
+            yield self.text[start : start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSalesforce:
+    """
+    Serves `record_count` Contacts and Accounts through the REST query API,
+    2000 records per page as Salesforce does. Every Account query returns
+    records with fresh SystemModstamps so each poll sees a full change set.
+    """
+
+    PAGE_SIZE = 2000
+
+    def __init__(self, record_count):
+        self.record_count = record_count
+        self.instance_url = "https://fake.my.salesforce.com"
+        self._cursors = {}
+        self.lock = threading.Lock()
+        # Response hooks are accepted like requests.Session's but never called.
+        self.hooks = {"response": []}
+
+    def _records(self, soql):
+        if "FROM Account" in soql:
+            base = datetime.now(timezone.utc)
+            industries = ["Technology", "Banking", "Retail", "Energy", "Healthcare"]
+            types = ["Customer", "Prospect", "Partner"]
+            return [
+                {
+                    "attributes": {"type": "Account"},
+                    "Id": f"001{i:015d}",
+                    "Name": f"Account {i}",
+                    "Industry": industries[i % len(industries)],
+                    "Type": types[i % len(types)],
+                    "AnnualRevenue": float((i * 7919) % 10_000_000),
+                    "SystemModstamp": (base + timedelta(milliseconds=i)).strftime(
+                        "%Y-%m-%dT%H:%M:%S.%f"
+                    )[:-3]
+                    + "+0000",
+                }
+                for i in range(self.record_count)
+            ]
+        return [
+            {
+                "attributes": {"type": "Contact"},
+                "Id": f"003{i:015d}",
+                "Name": f"Contact {i}",
+                "Email": f"contact{i}@example.com" if i % 5 else None,
+            }
+            for i in range(self.record_count)
+        ]
+
+    def _page(self, cursor, records, offset):
+        page = records[offset : offset + self.PAGE_SIZE]
+        body = {"totalSize": len(records), "done": True, "records": page}
+        if offset + self.PAGE_SIZE < len(records):
+            body["done"] = False
+            body["nextRecordsUrl"] = (
+                f"/services/data/v58.0/query/{cursor}-{offset + self.PAGE_SIZE}"
+            )
+        return FakeResponse(body)
+
+    def post(self, url, data=None, **kwargs):
+        _wait("salesforce")
+        return FakeResponse(
+            {"access_token": "fake-token", "instance_url": self.instance_url}
+        )
+
+    def request(self, method, url, params=None, **kwargs):
+        _wait("salesforce")
+        path = urlparse(url).path
+        if path.endswith("/query") and params and "q" in params:
+            cursor = uuid.uuid4().hex
+            records = self._records(params["q"])
+            with self.lock:
+                self._cursors[cursor] = records
+            return self._page(cursor, records, 0)
+        if "/query/" in path:
+            cursor, offset = path.rsplit("/", 1)[1].rsplit("-", 1)
+            with self.lock:
+                records = self._cursors[cursor]
+            return self._page(cursor, records, int(offset))
+        return FakeResponse({"error": f"unsupported {method} {url}"}, 404)
+
+    def get(self, url, params=None, **kwargs):
+        query = parse_qs(urlparse(url).query)
+        params = params or {k: v[0] for k, v in query.items()}
+        return self.request("GET", url, params=params, **kwargs)
+
+
+# --- OpenAI -------------------------------------------------------------------
+
+
+# Tokens per streamed answer and delay between streamed chunks.
+STREAM_TOKENS = 200
+STREAM_TOKEN_MS = 0.0
+
+
+def _stream(content):
+    for index in range(STREAM_TOKENS):
+        if STREAM_TOKEN_MS:
+            time.sleep(STREAM_TOKEN_MS / 1000.0)
+        token = content if index == 0 else f" token{index}"
+        yield {"choices": [{"delta": {"content": token}}]}
+
+
+def fake_chat_completion(**kwargs):
+    """Stands in for openai.ChatCompletion.create."""
+    _wait("openai")
+    prompt = kwargs["messages"][-1]["content"]
+    content = f"Insight for: {prompt[:60]}"
+    if kwargs.get("stream"):
+        return _stream(content)
+    return {
+        "choices": [{"message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 20},
+    }
+
+
+def reset():
+    """Drops all fake state."""
+    reset_tables()
+    _clients.clear()
@@ -0,0 +1,112 @@
+"""
+Import-time profile of every Lambda handler declared in template.yaml.
+
+Each handler module is imported in a fresh interpreter with `-X importtime`
+and the cost is reported per top-level package (self time summed over all of
+its modules) together with the handler's total import time. This is the
+module-load share of a cold start.
+
+Examples (from the backend directory):
+
+    python benchmarks/import_profile.py
+    python benchmarks/import_profile.py --handlers customers_lambda --top 20
+    python benchmarks/import_profile.py --json > import_profile.json
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+from run_benchmarks import BACKEND_DIR, BENCHMARK_ENV
+
+TEMPLATE = os.path.join(BACKEND_DIR, "template.yaml")
+IMPORT_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+
+def template_handlers(template=TEMPLATE):
+    """Returns the handler modules referenced by `Handler:` entries."""
+    handlers = []
+    with open(template) as f:
+        for line in f:
+            match = re.match(r"\s*Handler:\s*(\S+)", line)
+            if match:
+                path = match.group(1).rsplit(".", 1)[0]
+                handlers.append(path.replace("/", "."))
+    return list(dict.fromkeys(handlers))
+
+
+def profile_module(module):
+    """Imports module in a fresh interpreter and parses the importtime log."""
+    env = dict(os.environ, **BENCHMARK_ENV)
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr}")
+
+    rows = []
+    for line in completed.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append(
+                {
+                    "module": name,
+                    "self_ms": int(self_us) / 1000,
+                    "cumulative_ms": int(cumulative_us) / 1000,
+                    "depth": len(indent) // 2,
+                }
+            )
+    return rows
+
+
+def summarize(module, rows, top):
+    total = next((row["cumulative_ms"] for row in rows if row["module"] == module), 0.0)
+    packages = defaultdict(float)
+    for row in rows:
+        packages[row["module"].split(".")[0]] += row["self_ms"]
+    ranked = sorted(packages.items(), key=lambda kv: kv[1], reverse=True)
+    return {
+        "handler": module,
+        "total_ms": total,
+        "modules": len(rows),
+        "packages": [{"package": name, "self_ms": ms} for name, ms in ranked[:top]],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--handlers", help="comma separated handler packages")
+    parser.add_argument("--top", type=int, default=10, help="packages per handler")
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args(argv)
+
+    modules = template_handlers()
+    if args.handlers:
+        wanted = {h.strip() for h in args.handlers.split(",")}
+        modules = [m for m in modules if m.split(".")[0] in wanted]
+
+    report = [summarize(m, profile_module(m), args.top) for m in modules]
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    for entry in report:
+        print(
+            f"\n{entry['handler']}: {entry['total_ms']:.1f} ms "
+            f"({entry['modules']} modules imported)"
+        )
+        for package in entry["packages"]:
+            print(f"  {package['package']:30} {package['self_ms']:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""
+Offline performance benchmarks for every Lambda handler.
+
+Each (handler, dataset size) scenario runs in a fresh interpreter against the
+in-process fakes in benchmarks/fakes.py, so the whole suite works without
+network access, LocalStack or credentials. A scenario reports:
+
+  - cold start: module import plus first invocation, one sample per process
+  - warm latency percentiles and throughput over repeated invocations
+  - peak RSS of the process
+
+Examples (from the backend directory):
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --sizes 100,5000 --latency openai=400
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/old.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+
+# Scenario name -> handler module. Variants of one handler share its module.
+SCENARIOS = {
+    "ai_agent_lambda": "ai_agent_lambda.handler",
+    "ai_agent_lambda:batch": "ai_agent_lambda.handler",
+    "ai_worker_lambda": "ai_worker_lambda.handler",
+    "ai_worker_lambda:stream": "ai_worker_lambda.handler",
+    "ai_query_status_lambda": "ai_query_status_lambda.handler",
+    "customers_lambda": "customers_lambda.handler",
+    "customers_lambda:export": "customers_lambda.handler",
+    "salesforce_sync_lambda": "salesforce_sync_lambda.handler",
+    "salesforce_poll_lambda": "salesforce_poll_lambda.handler",
+}
+
+WORKER_BATCH_SIZE = 10
+
+BENCHMARK_ENV = {
+    "MOCK_AWS": "false",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AI_QUERIES_TABLE": "AIQueries",
+    "CUSTOMERS_TABLE": "Customers",
+    "AI_RESPONSE_CACHE_TABLE": "AIResponseCache",
+    "SYNC_STATE_TABLE": "SyncState",
+    "AI_SQS_QUEUE": "https://sqs.fake/ai-query-queue",
+    "OPENAI_API_KEY": "benchmark",
+    "SF_AUTH_URL": "https://login.fake/services/oauth2/token",
+    "SF_CLIENT_ID": "benchmark",
+    "SF_CLIENT_SECRET": "benchmark",
+    "SF_USERNAME": "benchmark",
+    "SF_PASSWORD": "benchmark",
+    # The fake only serves the REST query API.
+    "SF_BULK_THRESHOLD": str(10**12),
+    "JWT_SECRET": "benchmark-secret-with-at-least-32-bytes",
+    # The fake model has no quota; client-side limits would only add waits.
+    "OPENAI_RPM_LIMIT": "0",
+    "OPENAI_TPM_LIMIT": "0",
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        "samples": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class FakeContext:
+    """Minimal stand-in for the Lambda context object."""
+
+    function_name = "benchmark"
+    aws_request_id = "benchmark-request"
+
+    def get_remaining_time_in_millis(self):
+        return 120000
+
+
+# --- Scenario side (runs in a fresh interpreter) ------------------------------
+
+
+def _install_fakes(size):
+    """Patches boto3, requests and openai with the fakes. Imports the SDKs."""
+    from unittest.mock import patch
+    import fakes
+
+    salesforce = fakes.FakeSalesforce(size)
+    salesforce.mount = lambda *args, **kwargs: None
+    patches = [
+        patch("boto3.resource", fakes.fake_resource),
+        patch("boto3.client", fakes.fake_client),
+        patch("requests.Session", lambda: salesforce),
+        patch("openai.ChatCompletion.create", fakes.fake_chat_completion),
+    ]
+    for p in patches:
+        p.start()
+    # The fakes replace the sync SDK only; hide aiobotocore so the async
+    # helpers take their executor fallback onto them.
+    sys.modules["aiobotocore.session"] = None
+    return fakes
+
+
+def _seed(scenario, size, fakes):
+    from decimal import Decimal
+
+    if scenario.startswith(("customers_lambda", "ai_worker_lambda")):
+        table = fakes.get_fake_table("Customers")
+        industries = ["Technology", "Banking", "Retail", "Energy", "Healthcare"]
+        for i in range(size):
+            table.items[f"C{i:08d}"] = {
+                "Id": f"C{i:08d}",
+                "Name": f"Customer {i}",
+                "Email": f"customer{i}@example.com",
+                "Industry": industries[i % len(industries)],
+                "AnnualRevenue": Decimal((i * 7919) % 10_000_000),
+            }
+    if scenario.startswith("ai_worker_lambda"):
+        from common.dataset_snapshot import rebuild_snapshot
+
+        rebuild_snapshot()
+    if scenario == "ai_query_status_lambda":
+        fakes.get_fake_table("AIQueries").items["bench-query"] = {
+            "query_id": "bench-query",
+            "prompt": "How many customers do we have?",
+            "status": "COMPLETED",
+            "response": "x" * 2000,
+        }
+
+
+# API Gateway events carry the key checked by common.auth.check_api_key.
+API_HEADERS = {"x-api-key": "your-secure-api-key"}
+
+
+def _event(scenario, i):
+    if scenario == "ai_agent_lambda":
+        body = json.dumps({"prompt": f"Benchmark prompt {i}"})
+        return {"headers": API_HEADERS, "body": body}
+    if scenario == "ai_agent_lambda:batch":
+        prompts = [f"Benchmark prompt {i}-{j}" for j in range(WORKER_BATCH_SIZE)]
+        body = json.dumps({"prompts": prompts})
+        return {"headers": API_HEADERS, "resource": "/ai/query/batch", "body": body}
+    if scenario.startswith("ai_worker_lambda"):
+        records = []
+        for j in range(WORKER_BATCH_SIZE):
+            body = {"query_id": f"q-{i}-{j}", "prompt": f"Benchmark prompt {i}-{j}"}
+            body["stream"] = scenario == "ai_worker_lambda:stream"
+            records.append({"messageId": f"m-{i}-{j}", "body": json.dumps(body)})
+        return {"Records": records}
+    if scenario == "ai_query_status_lambda":
+        return {"headers": API_HEADERS, "pathParameters": {"id": "bench-query"}}
+    if scenario == "customers_lambda":
+        return {"headers": API_HEADERS, "queryStringParameters": {"limit": "100"}}
+    if scenario == "customers_lambda:export":
+        return {"headers": API_HEADERS, "queryStringParameters": {"export": "true"}}
+    if scenario == "salesforce_sync_lambda":
+        from common.auth import encode_jwt
+
+        token = encode_jwt({"sub": "benchmark", "cognito:groups": ["admins"]})
+        return {"headers": {"Authorization": f"Bearer {token}"}}
+    return {}
+
+
+def run_scenario(config):
+    """Measures one scenario in the current (fresh) interpreter."""
+    started = time.perf_counter()
+    os.environ.update(BENCHMARK_ENV)
+    sys.path.insert(0, BACKEND_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import importlib
+
+    scenario = config["scenario"]
+    fakes = _install_fakes(config["size"])
+    module = importlib.import_module(SCENARIOS[scenario])
+    import_ms = (time.perf_counter() - started) * 1000
+
+    # Seeding goes straight into the fakes and is kept out of the timings.
+    fakes.configure_latency({name: 0.0 for name in fakes.LATENCY_MS})
+    _seed(scenario, config["size"], fakes)
+    fakes.configure_latency(config["latency"])
+
+    context = FakeContext()
+    start = time.perf_counter()
+    module.lambda_handler(_event(scenario, 0), context)
+    first_call_ms = (time.perf_counter() - start) * 1000
+
+    warm = []
+    warm_started = time.perf_counter()
+    for i in range(1, config["iterations"] + 1):
+        start = time.perf_counter()
+        module.lambda_handler(_event(scenario, i), context)
+        warm.append((time.perf_counter() - start) * 1000)
+    warm_total = time.perf_counter() - warm_started
+
+    return {
+        "import_ms": import_ms,
+        "cold_ms": import_ms + first_call_ms,
+        "warm_ms": warm,
+        "warm_seconds": warm_total,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+# --- Driver side ---------------------------------------------------------------
+
+
+def _spawn(config):
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--scenario", json.dumps(config)],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(
+            f"Scenario {config['scenario']} (size {config['size']}) failed:\n"
+            f"{completed.stderr}"
+        )
+    # Handlers print to stdout; the measurement is the last line.
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def benchmark(scenario, size, iterations, cold_runs, latency):
+    cold, imports, warm, rss = [], [], [], []
+    warm_seconds = 0.0
+    for run in range(cold_runs):
+        config = {
+            "scenario": scenario,
+            "size": size,
+            # Warm samples come from the first process only.
+            "iterations": iterations if run == 0 else 0,
+            "latency": latency,
+        }
+        sample = _spawn(config)
+        cold.append(sample["cold_ms"])
+        imports.append(sample["import_ms"])
+        warm.extend(sample["warm_ms"])
+        warm_seconds += sample["warm_seconds"]
+        rss.append(sample["peak_rss_mb"])
+
+    # Batched scenarios handle WORKER_BATCH_SIZE prompts per invocation.
+    batched = scenario.startswith("ai_worker_lambda") or scenario.endswith(":batch")
+    invocations = len(warm) * (WORKER_BATCH_SIZE if batched else 1)
+    return {
+        "handler": scenario,
+        "size": size,
+        "cold_ms": summarize(cold),
+        "import_ms": summarize(imports),
+        "warm_ms": summarize(warm),
+        "throughput_per_s": invocations / warm_seconds if warm_seconds else None,
+        "peak_rss_mb": max(rss),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BACKEND_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _parse_latency(values):
+    latency = {}
+    for value in values or []:
+        service, _, ms = value.partition("=")
+        latency[service.strip()] = float(ms)
+    return latency
+
+
+def _pct_change(old, new):
+    if old in (None, 0) or new is None:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def compare(previous, current):
+    """Prints the change of the headline numbers between two result files."""
+    old = {(r["handler"], r["size"]): r for r in previous["results"]}
+    print(f"\nComparison {previous['commit']} -> {current['commit']}")
+    print(
+        f"{'handler':28} {'size':>6} {'warm p50':>10} {'warm p99':>10} {'cold p50':>10} {'rss':>8}"
+    )
+    for result in current["results"]:
+        before = old.get((result["handler"], result["size"]))
+        if before is None:
+            continue
+        cells = [
+            _pct_change(before["warm_ms"]["p50"], result["warm_ms"]["p50"]),
+            _pct_change(before["warm_ms"]["p99"], result["warm_ms"]["p99"]),
+            _pct_change(before["cold_ms"]["p50"], result["cold_ms"]["p50"]),
+            _pct_change(before["peak_rss_mb"], result["peak_rss_mb"]),
+        ]
+        print(
+            f"{result['handler']:28} {result['size']:>6} "
+            + " ".join(f"{c:>10}" for c in cells)
+        )
+
+
+def print_report(report):
+    print(
+        f"{'handler':28} {'size':>6} {'cold p50':>10} {'warm p50':>10} {'warm p99':>10} {'req/s':>9} {'rss MB':>8}"
+    )
+    for r in report["results"]:
+        print(
+            f"{r['handler']:28} {r['size']:>6} {r['cold_ms']['p50']:>10.1f} "
+            f"{r['warm_ms']['p50']:>10.2f} {r['warm_ms']['p99']:>10.2f} "
+            f"{r['throughput_per_s']:>9.1f} {r['peak_rss_mb']:>8.1f}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--handlers", default=",".join(SCENARIOS))
+    parser.add_argument("--sizes", default="100,1000", help="dataset sizes to run")
+    parser.add_argument("--iterations", type=int, default=30, help="warm invocations")
+    parser.add_argument("--cold-runs", type=int, default=3, help="fresh processes")
+    parser.add_argument(
+        "--latency",
+        action="append",
+        metavar="SERVICE=MS",
+        help="injected latency, e.g. dynamodb=5 or openai=400 (repeatable)",
+    )
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="previous results file to diff against")
+    args = parser.parse_args(argv)
+
+    if args.scenario:
+        print(json.dumps(run_scenario(json.loads(args.scenario))))
+        return
+
+    latency = _parse_latency(args.latency)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    handlers = [h.strip() for h in args.handlers.split(",") if h.strip()]
+    unknown = set(handlers) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown handlers: {', '.join(sorted(unknown))}")
+
+    results = []
+    for handler in handlers:
+        for size in sizes:
+            print(f"Running {handler} with {size} records...", file=sys.stderr)
+            results.append(
+                benchmark(handler, size, args.iterations, args.cold_runs, latency)
+            )
+
+    report = {
+        "commit": _git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            "sizes": sizes,
+            "iterations": args.iterations,
+            "cold_runs": args.cold_runs,
+            "latency_ms": latency,
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print(f"\nResults written to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
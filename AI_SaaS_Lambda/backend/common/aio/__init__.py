@@ -0,0 +1,75 @@
+"""
+Asyncio counterparts of the common I/O helpers, for handlers that need many
+calls in flight at once without a thread per call.
+
+Handlers stay synchronous and enter async code with run(); the event loop,
+the aiohttp session and the async AWS clients are kept for the life of the
+container, so warm invocations reuse their connection pools.
+"""
+
+import asyncio
+import functools
+import threading
+
+_loop = None
+_loop_lock = threading.Lock()
+# One coroutine tree runs on the loop at a time.
+_run_lock = threading.Lock()
+_cleanups = []
+
+
+def get_loop():
+    """Returns the container's event loop, creating it on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+    return _loop
+
+
+def run(coro):
+    """Runs a coroutine to completion on the shared loop and returns its result."""
+    with _run_lock:
+        return get_loop().run_until_complete(coro)
+
+
+async def gather(aws, limit=None, return_exceptions=False):
+    """
+    Awaits the awaitables concurrently, at most limit at a time, and returns
+    their results in order.
+    """
+    if not limit:
+        return await asyncio.gather(*aws, return_exceptions=return_exceptions)
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(
+        *(bounded(aw) for aw in aws), return_exceptions=return_exceptions
+    )
+
+
+async def to_thread(fn, *args, **kwargs):
+    """Runs a blocking call on the loop's default executor."""
+    call = functools.partial(fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(None, call)
+
+
+def on_close(cleanup):
+    """Registers a coroutine function that close() awaits, e.g. session.close."""
+    _cleanups.append(cleanup)
+
+
+def close():
+    """Closes the shared sessions, clients and loop. Intended for tests."""
+    global _loop
+    with _run_lock:
+        if _loop is None or _loop.is_closed():
+            return
+        while _cleanups:
+            _loop.run_until_complete(_cleanups.pop()())
+        _loop.run_until_complete(_loop.shutdown_asyncgens())
+        _loop.close()
+        _loop = None
@@ -0,0 +1,55 @@
+import contextlib
+import os
+from botocore.config import Config
+from common import aio
+from common.dynamodb import MOCK_AWS, MOCK_ENDPOINT_URL
+
+# aiobotocore gives non-blocking AWS clients. Without it the async helpers
+# run the synchronous ones on the loop's executor instead.
+try:
+    from aiobotocore.session import get_session as _aiobotocore_session
+except ImportError:
+    _aiobotocore_session = None
+
+NATIVE = _aiobotocore_session is not None
+# One pool per client; sized for many concurrent calls rather than threads.
+MAX_POOL_CONNECTIONS = int(os.environ.get("AIO_AWS_MAX_POOL_CONNECTIONS", 100))
+
+_clients = {}
+_stack = None
+
+
+async def _close():
+    global _stack
+    stack, _stack = _stack, None
+    _clients.clear()
+    if stack is not None:
+        await stack.aclose()
+
+
+async def client(service):
+    """Returns the shared async client for an AWS service (needs aiobotocore)."""
+    global _stack
+    found = _clients.get(service)
+    if found is not None:
+        return found
+    if not NATIVE:
+        raise RuntimeError("aiobotocore is not installed")
+    if _stack is None:
+        _stack = contextlib.AsyncExitStack()
+        aio.on_close(_close)
+    kwargs = {
+        "region_name": os.environ.get("AWS_REGION", "us-east-1"),
+        "config": Config(max_pool_connections=MAX_POOL_CONNECTIONS),
+    }
+    if MOCK_AWS:
+        kwargs.update(
+            endpoint_url=MOCK_ENDPOINT_URL,
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+    created = await _stack.enter_async_context(
+        _aiobotocore_session().create_client(service, **kwargs)
+    )
+    # Another task may have created one while this one was awaiting.
+    return _clients.setdefault(service, created)
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import random
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+from common import aio, dynamodb
+from common.aio import aws
+from common.dynamodb import (
+    BATCH_GET_SIZE,
+    BATCH_WRITE_BASE_DELAY,
+    BATCH_WRITE_MAX_ATTEMPTS,
+    BATCH_WRITE_MAX_DELAY,
+    BATCH_WRITE_SIZE,
+    TABLE_KEYS,
+    MOCK_AWS,
+    get_table,
+    projection_args,
+    update_args,
+)
+
+logger = logging.getLogger(__name__)
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+def _serialize(item):
+    return {k: _serializer.serialize(v) for k, v in item.items()}
+
+
+def _deserialize(item):
+    return {k: _deserializer.deserialize(v) for k, v in item.items()}
+
+
+async def _client(table_name):
+    if MOCK_AWS:
+        # Provisioning is a one-off per container; the sync path handles it.
+        await aio.to_thread(get_table, table_name)
+    return await aws.client("dynamodb")
+
+
+async def get_item(table_name, key):
+    if not aws.NATIVE:
+        return await aio.to_thread(dynamodb.get_item, table_name, key)
+    client = await _client(table_name)
+    response = await client.get_item(TableName=table_name, Key=_serialize(key))
+    item = response.get("Item")
+    return _deserialize(item) if item else None
+
+
+async def put_item(table_name, item):
+    if not aws.NATIVE:
+        return await aio.to_thread(dynamodb.put_item, table_name, item)
+    client = await _client(table_name)
+    await client.put_item(TableName=table_name, Item=_serialize(item))
+
+
+async def update_item(table_name, key, values, return_values=None, remove=None):
+    """Async dynamodb.update_item."""
+    if not aws.NATIVE:
+        return await aio.to_thread(
+            dynamodb.update_item, table_name, key, values, return_values, remove
+        )
+    client = await _client(table_name)
+    kwargs = update_args(values, remove)
+    kwargs["ExpressionAttributeValues"] = _serialize(
+        kwargs["ExpressionAttributeValues"]
+    )
+    if return_values:
+        kwargs["ReturnValues"] = return_values
+    response = await client.update_item(
+        TableName=table_name, Key=_serialize(key), **kwargs
+    )
+    attributes = response.get("Attributes")
+    return _deserialize(attributes) if attributes else None
+
+
+async def _backoff(attempt):
+    delay = min(BATCH_WRITE_MAX_DELAY, BATCH_WRITE_BASE_DELAY * 2**attempt)
+    await asyncio.sleep(random.uniform(0, delay))
+
+
+async def _write_chunk(client, table_name, chunk):
+    counts = {"written": 0, "retried": 0, "failed": 0}
+    requests = [{"PutRequest": {"Item": _serialize(item)}} for item in chunk]
+    attempt = 0
+    while requests:
+        try:
+            response = await client.batch_write_item(
+                RequestItems={table_name: requests}
+            )
+        except ClientError as e:
+            logger.error(f"BatchWriteItem on {table_name} failed: {e}")
+            counts["failed"] += len(requests)
+            return counts
+
+        unprocessed = response.get("UnprocessedItems", {}).get(table_name, [])
+        counts["written"] += len(requests) - len(unprocessed)
+        if not unprocessed:
+            break
+        attempt += 1
+        if attempt >= BATCH_WRITE_MAX_ATTEMPTS:
+            counts["failed"] += len(unprocessed)
+            break
+        counts["retried"] += len(unprocessed)
+        await _backoff(attempt)
+        requests = unprocessed
+    return counts
+
+
+async def batch_write_items(table_name, items, concurrency=10):
+    """
+    Async dynamodb.batch_write_items: up to concurrency 25-item
+    BatchWriteItem calls are in flight at once. Unlike the sync version the
+    items are grouped up front. Returns {"written", "retried", "failed"}
+    counts.
+    """
+    if not aws.NATIVE:
+        return await aio.to_thread(
+            dynamodb.batch_write_items, table_name, items, max_workers=concurrency
+        )
+    client = await _client(table_name)
+    chunks = dynamodb._chunks(items, BATCH_WRITE_SIZE, TABLE_KEYS.get(table_name))
+    results = await aio.gather(
+        (_write_chunk(client, table_name, chunk) for chunk in chunks),
+        limit=concurrency,
+    )
+    totals = {"written": 0, "retried": 0, "failed": 0}
+    for counts in results:
+        for name, value in counts.items():
+            totals[name] += value
+    return totals
+
+
+async def _get_chunk(client, table_name, keys, attributes):
+    request = {"Keys": [_serialize(key) for key in keys]}
+    request.update(projection_args(attributes))
+    items = []
+    attempt = 0
+    while request:
+        response = await client.batch_get_item(RequestItems={table_name: request})
+        items.extend(response.get("Responses", {}).get(table_name, []))
+        request = response.get("UnprocessedKeys", {}).get(table_name)
+        if request:
+            attempt += 1
+            if attempt >= BATCH_WRITE_MAX_ATTEMPTS:
+                raise RuntimeError(f"BatchGetItem on {table_name} kept throttling")
+            await _backoff(attempt)
+    return [_deserialize(item) for item in items]
+
+
+async def batch_get_items(table_name, keys, attributes=None, concurrency=10):
+    """Async dynamodb.batch_get_items, with the 100-key calls made concurrently."""
+    if not aws.NATIVE:
+        return await aio.to_thread(
+            dynamodb.batch_get_items, table_name, keys, attributes
+        )
+    client = await _client(table_name)
+    keys = list(keys)
+    pages = await aio.gather(
+        (
+            _get_chunk(client, table_name, keys[i : i + BATCH_GET_SIZE], attributes)
+            for i in range(0, len(keys), BATCH_GET_SIZE)
+        ),
+        limit=concurrency,
+    )
+    return [item for page in pages for item in page]
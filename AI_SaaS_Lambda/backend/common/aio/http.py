@@ -0,0 +1,28 @@
+import os
+from common import aio
+from common.lazy import lazy_import
+
+# Only loaded by code paths that make async HTTP calls.
+aiohttp = lazy_import("aiohttp")
+
+# Connections shared by every async HTTP call of the container.
+POOL_SIZE = int(os.environ.get("AIO_HTTP_POOL_SIZE", 100))
+POOL_SIZE_PER_HOST = int(os.environ.get("AIO_HTTP_POOL_SIZE_PER_HOST", 0))
+TIMEOUT_SECONDS = float(os.environ.get("AIO_HTTP_TIMEOUT_SECONDS", 30))
+
+_session = None
+
+
+async def get_session():
+    """Returns the shared keep-alive aiohttp.ClientSession of the running loop."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_SIZE, limit_per_host=POOL_SIZE_PER_HOST
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=TIMEOUT_SECONDS),
+        )
+        aio.on_close(_session.close)
+    return _session
@@ -0,0 +1,54 @@
+import json
+import logging
+from common import aio
+from common.aio import http
+from common.dynamodb import json_default
+from common.logging import span
+from common.notify import (
+    TERMINAL_STATUSES,
+    WEBHOOK_SECRET,
+    WEBHOOK_TIMEOUT_SECONDS,
+    is_valid_callback_url,
+    payload,
+    sign,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def _post(item):
+    # Resolving the host blocks, so it runs on the executor.
+    if not await aio.to_thread(is_valid_callback_url, item["callback_url"]):
+        logger.warning(f"Refusing callback for query {item['query_id']}")
+        return False
+    body = json.dumps(payload(item), default=json_default).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if WEBHOOK_SECRET:
+        headers["X-Signature"] = f"sha256={sign(body)}"
+    session = await http.get_session()
+    try:
+        with span("webhook", method="POST"):
+            async with session.post(
+                item["callback_url"],
+                data=body,
+                headers=headers,
+                timeout=http.aiohttp.ClientTimeout(total=WEBHOOK_TIMEOUT_SECONDS),
+            ) as resp:
+                resp.raise_for_status()
+        return True
+    except Exception as e:
+        logger.warning(f"Callback for query {item['query_id']} failed: {e}")
+        return False
+
+
+async def notify_completed(items):
+    """
+    Async notify.notify_completed: every callback is posted at once over the
+    shared session. Returns the number of delivered callbacks.
+    """
+    targets = [
+        item
+        for item in items
+        if item.get("callback_url") and item.get("status") in TERMINAL_STATUSES
+    ]
+    return sum(await aio.gather(_post(item) for item in targets))
@@ -0,0 +1,68 @@
+from common import aio, openai_agent, prompt_budget, rate_limit, response_cache
+from common.aio import http
+from common.logging import span
+from common.openai_agent import MODEL, OPENAI_API_KEY, SYSTEM_PROMPT, openai
+
+
+async def _create(**kwargs):
+    """ChatCompletion.acreate, with retryable provider errors raised as Throttled."""
+    # openai opens a session per call unless one is set for the context.
+    openai.aiosession.set(await http.get_session())
+    try:
+        return await openai.ChatCompletion.acreate(api_key=OPENAI_API_KEY, **kwargs)
+    except openai.error.RateLimitError as e:
+        if e.code == "insufficient_quota":
+            raise
+        raise rate_limit.Throttled(str(e), openai_agent._retry_after(e)) from e
+    except (
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.TryAgain,
+    ) as e:
+        raise rate_limit.Throttled(str(e), openai_agent._retry_after(e)) from e
+
+
+async def complete(system_prompt, user_content, max_tokens=None):
+    """
+    One model call under the shared rate limits (see rate_limit.acall).
+    Returns the answer text.
+    """
+    kwargs = {}
+    max_tokens = max_tokens or openai_agent.MAX_TOKENS
+    if max_tokens:
+        kwargs["max_tokens"] = max_tokens
+    messages = prompt_budget.messages_for(system_prompt, user_content)
+    tokens = prompt_budget.count_tokens(system_prompt + user_content) + (
+        max_tokens or prompt_budget.RESPONSE_TOKENS
+    )
+
+    async def attempt():
+        with span("openai", model=MODEL, stream=False):
+            response = await _create(model=MODEL, messages=messages, **kwargs)
+        return response["choices"][0]["message"]["content"]
+
+    return await rate_limit.acall(attempt, tokens)
+
+
+async def process_query(prompt, dataset, use_cache=True):
+    """
+    Async openai_agent.process_query. Datasets that fit one prompt are
+    answered with one awaited call; larger ones take the threaded
+    map-reduce path on the executor.
+    """
+    key = openai_agent.cache_key(prompt, dataset)
+    if use_cache:
+        cached = await aio.to_thread(response_cache.get, key)
+        if cached is not None:
+            return cached
+
+    budget = prompt_budget.dataset_budget(
+        MODEL, SYSTEM_PROMPT, prompt, response_tokens=openai_agent._response_tokens()
+    )
+    if prompt_budget.count_tokens(dataset, MODEL) <= budget:
+        content = await complete(SYSTEM_PROMPT, f"{prompt}\n\nDataset: {dataset}")
+    else:
+        content = await aio.to_thread(openai_agent._map_reduce, prompt, dataset)
+    await aio.to_thread(response_cache.put, key, content, model=MODEL)
+    return content
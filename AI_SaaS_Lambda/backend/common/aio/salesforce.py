@@ -0,0 +1,136 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from common import salesforce
+from common.aio import http, ssm
+from common.logging import span
+from common.salesforce import API_VERSION, TOKEN_PARAM, TOKEN_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Tasks that find the token stale wait for one refresh instead of each
+# logging in. asyncio locks belong to one loop: (loop, lock).
+_refresh_lock = None
+
+
+class SalesforceError(Exception):
+    def __init__(self, status, body):
+        super().__init__(f"Salesforce returned {status}: {body[:200]}")
+        self.status = status
+
+
+async def _load_persisted_token():
+    if not TOKEN_PARAM:
+        return None
+    try:
+        return json.loads(await ssm.get_parameter(TOKEN_PARAM))
+    except Exception as e:
+        logger.warning(f"Could not load cached Salesforce token: {e}")
+        return None
+
+
+async def _persist_token(token):
+    if not TOKEN_PARAM:
+        return
+    try:
+        await ssm.put_parameter(TOKEN_PARAM, json.dumps(token))
+    except Exception as e:
+        logger.warning(f"Could not persist Salesforce token: {e}")
+
+
+async def _request_token():
+    data = {
+        "grant_type": "password",
+        "client_id": os.environ["SF_CLIENT_ID"],
+        "client_secret": os.environ["SF_CLIENT_SECRET"],
+        "username": os.environ["SF_USERNAME"],
+        "password": os.environ["SF_PASSWORD"],
+    }
+    session = await http.get_session()
+    with span("salesforce", method="POST"):
+        async with session.post(os.environ["SF_AUTH_URL"], data=data) as resp:
+            if resp.status >= 400:
+                raise SalesforceError(resp.status, await resp.text())
+            body = await resp.json()
+    return {
+        "access_token": body["access_token"],
+        "instance_url": body["instance_url"],
+        "expires_at": time.time() + TOKEN_TTL_SECONDS,
+    }
+
+
+def _lock():
+    global _refresh_lock
+    loop = asyncio.get_running_loop()
+    if _refresh_lock is None or _refresh_lock[0] is not loop:
+        _refresh_lock = (loop, asyncio.Lock())
+    return _refresh_lock[1]
+
+
+async def get_salesforce_token(force_refresh=False, rejected=None):
+    """
+    Async salesforce.get_salesforce_token. The token cache is shared with the
+    sync module, so either API reuses a login made by the other. rejected is
+    the access token a 401 was returned for; it is only replaced once.
+    """
+    token = salesforce._token
+    if not force_refresh and salesforce._is_fresh(token):
+        return token["access_token"], token["instance_url"]
+    async with _lock():
+        token = salesforce._token
+        # After a 401 another task may already have replaced the token.
+        stale = force_refresh and (
+            rejected is None or token.get("access_token") == rejected
+        )
+        if not stale and salesforce._is_fresh(token):
+            return token["access_token"], token["instance_url"]
+        if not force_refresh:
+            persisted = await _load_persisted_token()
+            if salesforce._is_fresh(persisted):
+                token = persisted
+        if force_refresh or not salesforce._is_fresh(token):
+            token = await _request_token()
+            await _persist_token(token)
+        with salesforce._token_lock:
+            salesforce._token = token
+        return token["access_token"], token["instance_url"]
+
+
+async def sf_request(method, path, headers=None, **kwargs):
+    """
+    Async salesforce.sf_request that returns the decoded JSON body. Paths are
+    relative to the instance URL; a 401 refreshes the token and retries once.
+    """
+    session = await http.get_session()
+    force_refresh = False
+    rejected = None
+    for attempt in range(2):
+        token, instance_url = await get_salesforce_token(force_refresh, rejected)
+        request_headers = {"Authorization": f"Bearer {token}"}
+        request_headers.update(headers or {})
+        with span("salesforce", method=method):
+            async with session.request(
+                method, f"{instance_url}{path}", headers=request_headers, **kwargs
+            ) as resp:
+                if resp.status == 401 and attempt == 0:
+                    logger.info("Salesforce token rejected, refreshing")
+                    force_refresh, rejected = True, token
+                    continue
+                if resp.status >= 400:
+                    raise SalesforceError(resp.status, await resp.text())
+                return await resp.json()
+
+
+async def stream_records(soql):
+    """Yields every record of a SOQL query, following the REST API's pages."""
+    page = await sf_request(
+        "GET", f"/services/data/{API_VERSION}/query", params={"q": soql}
+    )
+    for record in page.get("records", []):
+        yield record
+    while not page.get("done", True) and page.get("nextRecordsUrl"):
+        page = await sf_request("GET", page["nextRecordsUrl"])
+        for record in page.get("records", []):
+            yield record
@@ -0,0 +1,63 @@
+import logging
+from common import aio, sqs
+from common.aio import aws
+from common.sqs import SEND_BATCH_SIZE, SEND_MAX_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+
+async def send_message(queue, body):
+    if not aws.NATIVE:
+        return await aio.to_thread(sqs.send_message, queue, body)
+    # Queue URLs are resolved (and cached) once per container by the sync module.
+    url = await aio.to_thread(sqs.get_queue_url, queue)
+    client = await aws.client("sqs")
+    response = await client.send_message(QueueUrl=url, MessageBody=body)
+    return response["MessageId"]
+
+
+async def _send_batch(client, url, pending):
+    failed = []
+    for attempt in range(SEND_MAX_ATTEMPTS):
+        response = await client.send_message_batch(
+            QueueUrl=url,
+            Entries=[
+                {"Id": entry_id, "MessageBody": body}
+                for entry_id, body in pending.items()
+            ],
+        )
+        retry = {}
+        for entry in response.get("Failed", []):
+            logger.warning(
+                f"SQS rejected message {entry['Id']}: {entry.get('Message')}"
+            )
+            if entry.get("SenderFault") or attempt == SEND_MAX_ATTEMPTS - 1:
+                failed.append(int(entry["Id"]))
+            else:
+                retry[entry["Id"]] = pending[entry["Id"]]
+        if not retry:
+            break
+        pending = retry
+    return failed
+
+
+async def send_messages(queue, bodies, concurrency=10):
+    """
+    Async sqs.send_messages: the ten-message SendMessageBatch calls are made
+    concurrently. Returns the indexes of the messages that were not sent.
+    """
+    if not aws.NATIVE:
+        return await aio.to_thread(sqs.send_messages, queue, bodies)
+    url = await aio.to_thread(sqs.get_queue_url, queue)
+    client = await aws.client("sqs")
+    batches = [
+        {
+            str(index): bodies[index]
+            for index in range(start, min(start + SEND_BATCH_SIZE, len(bodies)))
+        }
+        for start in range(0, len(bodies), SEND_BATCH_SIZE)
+    ]
+    results = await aio.gather(
+        (_send_batch(client, url, batch) for batch in batches), limit=concurrency
+    )
+    return sorted(index for failed in results for index in failed)
@@ -0,0 +1,39 @@
+import boto3
+from common import aio
+from common.aio import aws
+
+_sync = None
+
+
+def _sync_client():
+    global _sync
+    if _sync is None:
+        _sync = boto3.client("ssm")
+    return _sync
+
+
+async def get_parameter(name, decrypt=True):
+    """Returns the value of an SSM parameter."""
+    if aws.NATIVE:
+        client = await aws.client("ssm")
+        response = await client.get_parameter(Name=name, WithDecryption=decrypt)
+    else:
+        response = await aio.to_thread(
+            _sync_client().get_parameter, Name=name, WithDecryption=decrypt
+        )
+    return response["Parameter"]["Value"]
+
+
+async def put_parameter(name, value, secure=True):
+    """Creates or overwrites an SSM parameter."""
+    kwargs = {
+        "Name": name,
+        "Value": value,
+        "Type": "SecureString" if secure else "String",
+        "Overwrite": True,
+    }
+    if aws.NATIVE:
+        client = await aws.client("ssm")
+        await client.put_parameter(**kwargs)
+    else:
+        await aio.to_thread(_sync_client().put_parameter, **kwargs)
@@ -1,12 +1,45 @@
+import hashlib
+import json
+import logging
 import os
-import jwt
-from jwt import PyJWTError
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from common.lazy import lazy_import
+
+# PyJWT (and the cryptography backend it loads) is only needed once a token
+# is checked; API-key endpoints never pay for it.
+jwt = lazy_import("jwt")
+
+logger = logging.getLogger(__name__)
 
 JWT_SECRET = os.environ.get("JWT_SECRET", "your_jwt_secret")
 JWT_ALGORITHM = os.environ.get("JWT_ALGORITHM", "HS256")
 JWT_EXP_DELTA_SECONDS = int(os.environ.get("JWT_EXP_DELTA_SECONDS", 3600))
 
+# Cognito RS256 tokens are verified against the user pool's JWKS, e.g.
+# https://cognito-idp.<region>.amazonaws.com/<pool_id>/.well-known/jwks.json.
+# JWT_JWKS_FILE loads the key set from disk instead (tests, offline runs).
+JWT_JWKS_URL = os.environ.get("JWT_JWKS_URL")
+JWT_JWKS_FILE = os.environ.get("JWT_JWKS_FILE")
+JWT_AUDIENCE = os.environ.get("JWT_AUDIENCE")  # Cognito app client id
+JWT_ISSUER = os.environ.get("JWT_ISSUER")
+JWKS_REFRESH_SECONDS = int(os.environ.get("JWT_JWKS_REFRESH_SECONDS", 3600))
+# An unknown kid triggers a refresh at most this often (Cognito rotates keys
+# rarely, forged kids must not hammer the endpoint).
+JWKS_MIN_REFRESH_SECONDS = 60
+
+# Verified claims, keyed by token hash, reused until the token expires.
+CLAIMS_CACHE_SIZE = int(os.environ.get("JWT_CACHE_SIZE", 1024))
+# Upper bound for tokens without an exp claim.
+CLAIMS_MAX_AGE_SECONDS = int(os.environ.get("JWT_CACHE_MAX_AGE_SECONDS", 300))
+
+_claims = OrderedDict()
+_claims_lock = threading.Lock()
+_jwks = {"keys": None, "loaded_at": 0.0}
+_jwks_lock = threading.Lock()
+
 
 def check_api_key(event):
     if os.environ.get("MOCK_AWS", "false").lower() == "true":
@@ -22,36 +55,118 @@ def encode_jwt(payload):
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 
+def _fetch_jwks():
+    if JWT_JWKS_FILE:
+        with open(JWT_JWKS_FILE) as f:
+            return json.load(f)
+    # urllib keeps the cold start free of an HTTP client import.
+    from urllib.request import urlopen
+
+    with urlopen(JWT_JWKS_URL, timeout=5) as resp:
+        return json.loads(resp.read())
+
+
+def _load_jwks():
+    """Fetches the key set; keeps the previous one if the fetch fails."""
+    try:
+        keys = jwt.PyJWKSet.from_dict(_fetch_jwks()).keys
+        _jwks["keys"] = {key.key_id: key for key in keys}
+    except Exception as e:
+        logger.warning(f"Could not load JWKS: {e}")
+    _jwks["loaded_at"] = time.time()
+
+
+def get_signing_key(kid):
+    """Returns the JWKS key for kid, refreshing the cached set lazily."""
+    now = time.time()
+    with _jwks_lock:
+        age = now - _jwks["loaded_at"]
+        keys = _jwks["keys"]
+        if age > JWKS_REFRESH_SECONDS:
+            _load_jwks()
+        elif (keys is None or kid not in keys) and age > JWKS_MIN_REFRESH_SECONDS:
+            # A failed load is retried at most this often too: during a JWKS
+            # outage requests must not queue on the lock behind fetch timeouts.
+            _load_jwks()
+        key = (_jwks["keys"] or {}).get(kid)
+    if key is None:
+        raise jwt.InvalidTokenError(f"Unknown signing key {kid}")
+    return key
+
+
+def _verify(token):
+    header = jwt.get_unverified_header(token)
+    if header.get("alg") == "RS256" and (JWT_JWKS_URL or JWT_JWKS_FILE):
+        return jwt.decode(
+            token,
+            get_signing_key(header.get("kid")).key,
+            algorithms=["RS256"],
+            audience=JWT_AUDIENCE,
+            issuer=JWT_ISSUER,
+            options={"verify_aud": bool(JWT_AUDIENCE)},
+        )
+    return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+
+
 # JWT decode/verify function
 def decode_jwt(token):
+    """
+    Verifies a token and returns its claims, or None if it is invalid.
+    Verified claims are cached per token until exp, so repeated checks of
+    the same token skip the signature verification.
+    """
+    key = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    with _claims_lock:
+        cached = _claims.get(key)
+        if cached is not None:
+            payload, expires_at = cached
+            if expires_at > now:
+                _claims.move_to_end(key)
+                return dict(payload)
+            del _claims[key]
+
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
-    except PyJWTError:
+        payload = _verify(token)
+    except jwt.PyJWTError:
         return None
 
+    expires_at = min(payload.get("exp", float("inf")), now + CLAIMS_MAX_AGE_SECONDS)
+    with _claims_lock:
+        _claims[key] = (payload, expires_at)
+        while len(_claims) > CLAIMS_CACHE_SIZE:
+            _claims.popitem(last=False)
+    return dict(payload)
 
-# JWT auth check for Lambda events
-def check_jwt_auth(event):
-    headers = event.get("headers", {})
+
+def clear_cache():
+    """Forgets cached claims and signing keys. Intended for tests."""
+    with _claims_lock:
+        _claims.clear()
+    with _jwks_lock:
+        _jwks.update({"keys": None, "loaded_at": 0.0})
+
+
+def _bearer_token(event):
+    headers = event.get("headers") or {}
     auth_header = headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
-        return False
-    token = auth_header.split(" ", 1)[1]
-    payload = decode_jwt(token)
-    return payload is not None
+        return None
+    return auth_header.split(" ", 1)[1]
+
+
+# JWT auth check for Lambda events
+def check_jwt_auth(event):
+    token = _bearer_token(event)
+    return token is not None and decode_jwt(token) is not None
 
 
 def get_user_roles(event):
     """Decodes the JWT from the event and returns the user's roles."""
-    headers = event.get("headers", {})
-    auth_header = headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
+    token = _bearer_token(event)
+    if token is None:
         return []
 
-    token = auth_header.split(" ", 1)[1]
-    # In a real scenario, you'd use a library that can decode without verification
-    # just to read claims, or verify it fully. We assume decode_jwt does this.
     payload = decode_jwt(token)
 
     if payload and "cognito:groups" in payload:
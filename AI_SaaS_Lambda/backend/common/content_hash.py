@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from itertools import islice
+from botocore.exceptions import ClientError
+from common.dynamodb import batch_write_items, get_table, json_default, parallel_scan
+
+logger = logging.getLogger(__name__)
+
+# Attribute holding the hash of a customer's stored fields.
+HASH_ATTRIBUTE = "content_hash"
+# Fields that change without the customer data changing. SystemModstamp
+# moves on every edit, including edits to fields we do not store.
+VOLATILE_FIELDS = ("SystemModstamp", "LastModifiedDate", HASH_ATTRIBUTE)
+SCAN_SEGMENTS = int(os.environ.get("SF_SYNC_SCAN_SEGMENTS", 4))
+# Records classified and written per round, so a streamed sync holds at
+# most this many in memory.
+WINDOW_SIZE = int(os.environ.get("SF_SYNC_WINDOW_SIZE", 500))
+
+
+def _numbers(value):
+    # json.dumps writes 1.0 and 1 differently; json_default maps an integral
+    # Decimal to an int, so floats are routed through Decimal as well.
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    if isinstance(value, dict):
+        return {k: _numbers(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_numbers(v) for v in value]
+    return value
+
+
+def compute(item):
+    """
+    Hash of the item's normalised fields. Key order, int/float/Decimal
+    spelling and VOLATILE_FIELDS do not change it.
+    """
+    fields = {k: _numbers(v) for k, v in item.items() if k not in VOLATILE_FIELDS}
+    canonical = json.dumps(
+        fields, sort_keys=True, separators=(",", ":"), default=json_default
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def with_hash(item):
+    return dict(item, **{HASH_ATTRIBUTE: compute(item)})
+
+
+def load_index(table_name, key_name="Id"):
+    """Returns {key: content_hash} for every item, from a projected parallel scan."""
+    items = parallel_scan(
+        table_name, SCAN_SEGMENTS, attributes=[key_name, HASH_ATTRIBUTE]
+    )
+    # Items written before hashing was introduced map to None: always rewritten.
+    return {item[key_name]: item.get(HASH_ATTRIBUTE) for item in items}
+
+
+def _put_if_unchanged(table_name, item, expected):
+    """Writes item unless its stored hash moved on since the index was read."""
+    try:
+        get_table(table_name).put_item(
+            Item=item,
+            ConditionExpression="#h = :expected",
+            ExpressionAttributeNames={"#h": HASH_ATTRIBUTE},
+            ExpressionAttributeValues={":expected": expected},
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return False
+
+
+def _windows(items):
+    items = iter(items)
+    while True:
+        window = list(islice(items, WINDOW_SIZE))
+        if not window:
+            return
+        yield window
+
+
+def sync_items(table_name, items, index, key_name="Id", max_workers=4):
+    """
+    Writes the items that are new or changed according to index ({key:
+    content_hash}) and skips the rest, WINDOW_SIZE items at a time.
+
+    Items whose stored copy has a hash are replaced with a conditional put
+    on that hash, so a concurrent writer is never overwritten; such items
+    are counted as conflicts and left for the next run. Items with no
+    stored hash (new keys, rows written before hashing) are batch-written
+    unconditionally, as the sync did before it compared hashes. Returns
+    {"inserted", "updated", "unchanged", "conflicts", "retried", "failed"};
+    retried counts batch items DynamoDB returned as unprocessed.
+    """
+    counts = dict.fromkeys(
+        ("inserted", "updated", "unchanged", "conflicts", "retried", "failed"), 0
+    )
+
+    def write(item):
+        key = item[key_name]
+        try:
+            if _put_if_unchanged(table_name, item, index[key]):
+                return "updated"
+            logger.warning(f"{key} changed during the sync, leaving it as stored")
+            return "conflicts"
+        except Exception as e:
+            logger.error(f"Could not write {key}: {e}")
+            return "failed"
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for window in _windows(items):
+            new, unhashed, changed = [], [], []
+            for item in window:
+                item = with_hash(item)
+                key = item[key_name]
+                if key not in index:
+                    new.append(item)
+                elif index[key] is None:
+                    unhashed.append(item)
+                elif index[key] == item[HASH_ATTRIBUTE]:
+                    counts["unchanged"] += 1
+                else:
+                    changed.append(item)
+
+            for kind, batch in (("inserted", new), ("updated", unhashed)):
+                if batch:
+                    written = batch_write_items(
+                        table_name, batch, max_workers=max_workers
+                    )
+                    counts[kind] += written["written"]
+                    counts["retried"] += written["retried"]
+                    counts["failed"] += written["failed"]
+            for outcome in executor.map(write, changed):
+                counts[outcome] += 1
+    return counts
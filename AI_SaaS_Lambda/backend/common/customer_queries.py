@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+from boto3.dynamodb.conditions import Attr, Key
+from common import dataset_snapshot
+from common.dynamodb import (
+    CUSTOMERS_TABLE,
+    TABLE_INDEXES,
+    parallel_scan,
+    query_all,
+    query_page,
+    scan_page,
+)
+
+logger = logging.getLogger(__name__)
+
+# Equality filters served by an index: query parameter -> attribute, index.
+INDEXED_FILTERS = {
+    "industry": ("Industry", "IndustryIndex"),
+    "type": ("Type", "TypeIndex"),
+}
+# DynamoDB reads one page may use before it is returned short with a
+# continuation token; sparse filters then never hold a request for long.
+MAX_READS_PER_PAGE = int(os.environ.get("CUSTOMERS_MAX_READS_PER_PAGE", 10))
+# How long the planner trusts the snapshot's per-group row counts.
+STATS_TTL_SECONDS = 300
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def parse_filters(params):
+    """Reads the filter query parameters. Raises ValueError on bad numbers."""
+    filters = {}
+    for name in ("industry", "type"):
+        if params.get(name):
+            filters[name] = params[name]
+    for name in ("min_revenue", "max_revenue"):
+        if params.get(name):
+            try:
+                filters[name] = Decimal(params[name])
+            except InvalidOperation:
+                raise ValueError(f"{name} must be a number")
+    return filters
+
+
+def _group_counts():
+    now = time.time()
+    with _stats_lock:
+        if _stats and now - _stats["loaded_at"] < STATS_TTL_SECONDS:
+            return _stats["counts"]
+    try:
+        counts = dataset_snapshot.group_counts() or {}
+    except Exception as e:
+        logger.warning(f"Could not load group counts for the planner: {e}")
+        counts = {}
+    with _stats_lock:
+        _stats.update(counts=counts, loaded_at=now)
+    return counts
+
+
+def _revenue_condition(condition_type, filters):
+    low, high = filters.get("min_revenue"), filters.get("max_revenue")
+    revenue = condition_type("AnnualRevenue")
+    if low is not None and high is not None:
+        return revenue.between(low, high)
+    if low is not None:
+        return revenue.gte(low)
+    if high is not None:
+        return revenue.lte(high)
+    return None
+
+
+def plan(filters):
+    """
+    Chooses how to serve filters. Returns {"index", "key", "filter"}: a query
+    of index with key as KeyConditionExpression, or a scan when index is
+    None; filter holds the conditions the chosen access path cannot apply.
+
+    With several indexed filters the one matching the fewest rows (per the
+    customer snapshot) is used; the revenue range rides on the index's
+    AnnualRevenue sort key.
+
+    The indexes hold only customers that have an AnnualRevenue, so they are
+    used only with a revenue bound (which excludes the others anyway);
+    without one the filters are applied to a scan.
+    """
+    candidates = [name for name in INDEXED_FILTERS if name in filters]
+    if _revenue_condition(Key, filters) is None:
+        candidates = []
+    indexes = TABLE_INDEXES.get(CUSTOMERS_TABLE, {})
+    candidates = [name for name in candidates if INDEXED_FILTERS[name][1] in indexes]
+    if len(candidates) > 1:
+        counts = _group_counts()
+
+        def matching_rows(name):
+            attribute = INDEXED_FILTERS[name][0]
+            return counts.get(attribute, {}).get(filters[name], float("inf"))
+
+        candidates.sort(key=matching_rows)
+
+    if not candidates:
+        conditions = [
+            Attr(INDEXED_FILTERS[name][0]).eq(filters[name])
+            for name in INDEXED_FILTERS
+            if name in filters
+        ]
+        revenue = _revenue_condition(Attr, filters)
+        if revenue is not None:
+            conditions.append(revenue)
+        return {"index": None, "key": None, "filter": _all(conditions)}
+
+    chosen = candidates[0]
+    attribute, index = INDEXED_FILTERS[chosen]
+    key = Key(attribute).eq(filters[chosen])
+    revenue = _revenue_condition(Key, filters)
+    if revenue is not None:
+        key = key & revenue
+    rest = [Attr(INDEXED_FILTERS[name][0]).eq(filters[name]) for name in candidates[1:]]
+    return {"index": index, "key": key, "filter": _all(rest)}
+
+
+def _all(conditions):
+    combined = None
+    for condition in conditions:
+        combined = condition if combined is None else combined & condition
+    return combined
+
+
+def _read_args(query_plan):
+    kwargs = {}
+    if query_plan["key"] is not None:
+        kwargs["KeyConditionExpression"] = query_plan["key"]
+    if query_plan["filter"] is not None:
+        kwargs["FilterExpression"] = query_plan["filter"]
+    return kwargs
+
+
+def describe(query_plan):
+    return query_plan["index"] or "scan"
+
+
+def find_page(filters, limit, start_key=None, attributes=None):
+    """
+    Returns (items, last_key, plan) for one page of matching customers. Reads
+    continue until the page is full, the data ends or MAX_READS_PER_PAGE.
+    """
+    query_plan = plan(filters)
+    kwargs = _read_args(query_plan)
+    items = []
+    for _ in range(MAX_READS_PER_PAGE):
+        # Never ask for more than the page still needs, so last_key is exact.
+        remaining = limit - len(items)
+        if query_plan["index"]:
+            page, start_key = query_page(
+                CUSTOMERS_TABLE,
+                query_plan["index"],
+                limit=remaining,
+                start_key=start_key,
+                attributes=attributes,
+                **kwargs,
+            )
+        else:
+            page, start_key = scan_page(
+                CUSTOMERS_TABLE,
+                limit=remaining,
+                start_key=start_key,
+                attributes=attributes,
+                **kwargs,
+            )
+        items.extend(page)
+        if not start_key or len(items) >= limit:
+            break
+    return items, start_key, query_plan
+
+
+def find_all(filters, attributes=None, total_segments=4):
+    """Returns (items, plan) for every matching customer."""
+    query_plan = plan(filters)
+    kwargs = _read_args(query_plan)
+    if query_plan["index"]:
+        items = query_all(
+            CUSTOMERS_TABLE, query_plan["index"], attributes=attributes, **kwargs
+        )
+    else:
+        items = parallel_scan(
+            CUSTOMERS_TABLE, total_segments, attributes=attributes, **kwargs
+        )
+    return items, query_plan
+
+
+def clear_stats():
+    """Forgets the cached group counts. Intended for tests."""
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,297 @@
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from botocore.exceptions import ClientError
+from common.dynamodb import (
+    CUSTOMERS_TABLE,
+    SYNC_STATE_TABLE,
+    get_table,
+    parallel_scan,
+)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ID = "customers_snapshot"
+SNAPSHOT_FIELDS = ("Id", "Name", "Industry", "Type", "AnnualRevenue")
+TOP_N = int(os.environ.get("SNAPSHOT_TOP_N", 10))
+SAMPLE_SIZE = int(os.environ.get("SNAPSHOT_SAMPLE_SIZE", 20))
+TOKEN_BUDGET = int(os.environ.get("SNAPSHOT_TOKEN_BUDGET", 1500))
+# How long the worker trusts its warm copy before checking the stored version.
+CHECK_INTERVAL_SECONDS = float(os.environ.get("SNAPSHOT_CHECK_SECONDS", 30))
+SCAN_SEGMENTS = int(os.environ.get("SNAPSHOT_SCAN_SEGMENTS", 4))
+
+EMPTY_DATASET = "No customer data snapshot is available yet."
+
+# Warm copy used by the AI worker: {"version", "text", "checked_at"}.
+_cached = {}
+_cache_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    """Rough token count for English text (about four characters per token)."""
+    return (len(text) + 3) // 4
+
+
+def _number(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def _row(item):
+    """Compact, JSON-safe projection of a customer item."""
+    return {k: _number(item[k]) for k in SNAPSHOT_FIELDS if item.get(k) is not None}
+
+
+def _revenue(row):
+    return row.get("AnnualRevenue") or 0
+
+
+def empty_state():
+    return {"count": 0, "by_industry": {}, "by_type": {}, "top": [], "sample": []}
+
+
+def _add_to_groups(state, row, sign):
+    revenue = _revenue(row)
+    for groups, field in (
+        (state["by_industry"], "Industry"),
+        (state["by_type"], "Type"),
+    ):
+        name = row.get(field) or "Unknown"
+        group = groups.setdefault(name, {"count": 0, "revenue": 0})
+        group["count"] += sign
+        group["revenue"] += sign * revenue
+        if group["count"] <= 0:
+            del groups[name]
+
+
+def build_state(items):
+    """Builds aggregates, top-N by AnnualRevenue and a row sample in one pass."""
+    state = empty_state()
+    top = []
+    sample = []
+    for index, item in enumerate(items):
+        row = _row(item)
+        state["count"] += 1
+        _add_to_groups(state, row, 1)
+        # Keep twice the displayed size so incremental updates can drop entries.
+        entry = (_revenue(row), row["Id"], row)
+        if len(top) < TOP_N * 2:
+            heapq.heappush(top, entry)
+        elif entry > top[0]:
+            heapq.heapreplace(top, entry)
+        # Reservoir sampling keeps the sample uniform without a second pass.
+        if len(sample) < SAMPLE_SIZE:
+            sample.append(row)
+        else:
+            slot = random.randint(0, index)
+            if slot < SAMPLE_SIZE:
+                sample[slot] = row
+    state["top"] = [row for _, _, row in sorted(top, reverse=True)]
+    state["sample"] = sample
+    return state
+
+
+def _rank(row):
+    return (_revenue(row), row["Id"])
+
+
+def apply_changes(state, changes):
+    """
+    Applies (old_item, new_item) pairs to a state in place. old_item is None
+    for inserts. Returns False when the state can no longer be kept exact
+    (too few top entries are known) and a full rebuild is needed.
+    """
+    for old_item, new_item in changes:
+        new_row = _row(new_item)
+        if old_item is not None:
+            _add_to_groups(state, _row(old_item), -1)
+        else:
+            state["count"] += 1
+        _add_to_groups(state, new_row, 1)
+
+        # "top" always holds the exact top-K customers for some K <= 2 * TOP_N.
+        top = [row for row in state["top"] if row["Id"] != new_row["Id"]]
+        knows_everyone = len(top) == state["count"] - 1
+        if knows_everyone or not top or _rank(new_row) >= _rank(top[-1]):
+            top.append(new_row)
+            top.sort(key=_rank, reverse=True)
+            top = top[: TOP_N * 2]
+        state["top"] = top
+
+        sample = state["sample"]
+        for index, row in enumerate(sample):
+            if row["Id"] == new_row["Id"]:
+                sample[index] = new_row
+                break
+        else:
+            if len(sample) < SAMPLE_SIZE:
+                sample.append(new_row)
+    return len(state["top"]) >= min(TOP_N, state["count"])
+
+
+def _format_row(row):
+    return json.dumps(row, separators=(",", ":"), default=str)
+
+
+def render(state, token_budget=TOKEN_BUDGET):
+    """Renders a state as compact text that fits in token_budget."""
+    lines = [f"Customers: {state['count']}"]
+    for title, groups in (
+        ("By Industry", state["by_industry"]),
+        ("By Type", state["by_type"]),
+    ):
+        ranked = sorted(groups.items(), key=lambda kv: kv[1]["count"], reverse=True)
+        parts = [
+            f"{name}={g['count']} (revenue {g['revenue']:,.0f})" for name, g in ranked
+        ]
+        lines.append(f"{title}: " + "; ".join(parts))
+    lines.append(f"Top {TOP_N} by AnnualRevenue:")
+    lines.extend(_format_row(row) for row in state["top"][:TOP_N])
+    lines.append("Sample rows:")
+    lines.extend(_format_row(row) for row in state["sample"])
+
+    text = ""
+    for line in lines:
+        candidate = f"{text}\n{line}" if text else line
+        if estimate_tokens(candidate) > token_budget:
+            break
+        text = candidate
+    return text
+
+
+def _save(state, expected_version):
+    """Writes a new snapshot version, failing if someone else wrote first."""
+    version = (expected_version or 0) + 1
+    item = {
+        "state_id": SNAPSHOT_ID,
+        "version": version,
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "state": json.dumps(state, separators=(",", ":")),
+        "text": render(state),
+    }
+    if expected_version is None:
+        condition = "attribute_not_exists(state_id)"
+        values = None
+    else:
+        condition = "version = :expected"
+        values = {":expected": expected_version}
+    kwargs = {"Item": item, "ConditionExpression": condition}
+    if values:
+        kwargs["ExpressionAttributeValues"] = values
+    get_table(SYNC_STATE_TABLE).put_item(**kwargs)
+    return version
+
+
+def _load_item(consistent=False):
+    return (
+        get_table(SYNC_STATE_TABLE)
+        .get_item(Key={"state_id": SNAPSHOT_ID}, ConsistentRead=consistent)
+        .get("Item")
+    )
+
+
+def rebuild_snapshot():
+    """Rebuilds the snapshot from a full scan of the Customers table."""
+    items = parallel_scan(CUSTOMERS_TABLE, SCAN_SEGMENTS, attributes=SNAPSHOT_FIELDS)
+    state = build_state(items)
+    for _ in range(3):
+        current = _load_item(consistent=True)
+        expected = int(current["version"]) if current else None
+        try:
+            version = _save(state, expected)
+            logger.info(f"Rebuilt customer snapshot v{version} ({state['count']} rows)")
+            return version
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+    raise RuntimeError("Could not store the customer snapshot")
+
+
+def update_snapshot(changes):
+    """
+    Applies (old_item, new_item) pairs written by a Salesforce poll. Falls
+    back to a full rebuild if there is no snapshot yet, the change set cannot
+    be applied exactly, or a concurrent writer got there first.
+    """
+    changes = list(changes)
+    if not changes:
+        return None
+    current = _load_item(consistent=True)
+    if current is None:
+        return rebuild_snapshot()
+    state = json.loads(current["state"])
+    if not apply_changes(state, changes):
+        return rebuild_snapshot()
+    try:
+        return _save(state, int(current["version"]))
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return rebuild_snapshot()
+
+
+def group_counts():
+    """Customers per Industry and per Type from the stored snapshot, or None."""
+    item = (
+        get_table(SYNC_STATE_TABLE)
+        .get_item(
+            Key={"state_id": SNAPSHOT_ID},
+            ProjectionExpression="#s",
+            ExpressionAttributeNames={"#s": "state"},
+        )
+        .get("Item")
+    )
+    if item is None:
+        return None
+    state = json.loads(item["state"])
+    return {
+        "Industry": {name: g["count"] for name, g in state["by_industry"].items()},
+        "Type": {name: g["count"] for name, g in state["by_type"].items()},
+    }
+
+
+def load_snapshot_text():
+    """
+    Returns the rendered snapshot for prompts. The text is kept warm in memory
+    and only re-read when the stored version changes.
+    """
+    now = time.time()
+    with _cache_lock:
+        if _cached and now - _cached["checked_at"] < CHECK_INTERVAL_SECONDS:
+            return _cached["text"]
+
+    table = get_table(SYNC_STATE_TABLE)
+    head = table.get_item(
+        Key={"state_id": SNAPSHOT_ID},
+        ProjectionExpression="version",
+    ).get("Item")
+    if head is None:
+        return EMPTY_DATASET
+
+    version = int(head["version"])
+    with _cache_lock:
+        if _cached.get("version") == version:
+            _cached["checked_at"] = now
+            return _cached["text"]
+
+    item = _load_item()
+    text = item["text"] if item else EMPTY_DATASET
+    with _cache_lock:
+        _cached.update(
+            {"version": int(item["version"]) if item else version, "text": text}
+        )
+        _cached["checked_at"] = now
+    return text
+
+
+def clear_cache():
+    """Forgets the warm snapshot. Intended for tests."""
+    with _cache_lock:
+        _cached.clear()
@@ -1,56 +1,186 @@
+import base64
+import json
+from decimal import Decimal
+import logging
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import boto3
+from boto3.dynamodb.types import Binary, TypeDeserializer, TypeSerializer
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
 
 MOCK_AWS = os.environ.get("MOCK_AWS", "false").lower() == "true"
 CUSTOMERS_TABLE = os.environ.get("CUSTOMERS_TABLE", "Customers")
 AI_QUERIES_TABLE = os.environ.get("AI_QUERIES_TABLE", "AIQueries")
+AI_RESPONSE_CACHE_TABLE = os.environ.get("AI_RESPONSE_CACHE_TABLE", "AIResponseCache")
+SYNC_STATE_TABLE = os.environ.get("SYNC_STATE_TABLE", "SyncState")
+MOCK_ENDPOINT_URL = "http://127.0.0.1:4566"  # "http://host.docker.internal:4566"
 
+# Size of the botocore HTTP connection pool shared by every Table of a resource.
+MAX_POOL_CONNECTIONS = int(os.environ.get("DYNAMODB_MAX_POOL_CONNECTIONS", 10))
 
-def get_table(table_name):
-    if MOCK_AWS:
-        dynamodb = boto3.resource(
-            "dynamodb",
-            region_name=os.environ.get("AWS_REGION", "us-east-1"),
-            endpoint_url="http://127.0.0.1:4566",  # "http://host.docker.internal:4566",
-        )
+# BatchWriteItem accepts at most 25 requests per call, BatchGetItem 100 keys.
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+BATCH_WRITE_MAX_ATTEMPTS = int(os.environ.get("DYNAMODB_BATCH_MAX_ATTEMPTS", 8))
+BATCH_WRITE_BASE_DELAY = 0.05
+BATCH_WRITE_MAX_DELAY = 2.0
 
-        try:
-            table = dynamodb.Table(table_name)
-            table.load()
-            print(f"Table {table_name} already exists.")
-        except dynamodb.meta.client.exceptions.ResourceNotFoundException:
-            print(f"Creating table {table_name}...")
-
-            if table_name == CUSTOMERS_TABLE:
-                table = dynamodb.create_table(
-                    TableName=table_name,
-                    KeySchema=[{"AttributeName": "Id", "KeyType": "HASH"}],
-                    AttributeDefinitions=[
-                        {"AttributeName": "Id", "AttributeType": "S"}
-                    ],
-                    BillingMode="PAY_PER_REQUEST",
-                )
-            elif table_name == AI_QUERIES_TABLE:
-                table = dynamodb.create_table(
-                    TableName=table_name,
-                    KeySchema=[{"AttributeName": "query_id", "KeyType": "HASH"}],
-                    AttributeDefinitions=[
-                        {"AttributeName": "query_id", "AttributeType": "S"}
-                    ],
-                    BillingMode="PAY_PER_REQUEST",
+# Hash key of each table that can be provisioned on demand in MOCK_AWS mode.
+TABLE_KEYS = {
+    CUSTOMERS_TABLE: "Id",
+    AI_QUERIES_TABLE: "query_id",
+    AI_RESPONSE_CACHE_TABLE: "cache_key",
+    SYNC_STATE_TABLE: "state_id",
+}
+# Global secondary indexes: name -> (hash key, range key). Keep in sync with
+# template.yaml; MOCK_AWS provisioning adds missing ones to existing tables.
+TABLE_INDEXES = {
+    CUSTOMERS_TABLE: {
+        "IndustryIndex": ("Industry", "AnnualRevenue"),
+        "TypeIndex": ("Type", "AnnualRevenue"),
+    },
+}
+NUMBER_ATTRIBUTES = {"AnnualRevenue"}
+
+# Process-wide registry. Module globals survive across warm Lambda invocations,
+# so the resource, its connection pool and the Table objects are built only once.
+_resources = {}
+_tables = {}
+_registry_lock = threading.Lock()
+
+
+def _region():
+    return os.environ.get("AWS_REGION", "us-east-1")
+
+
+def get_resource():
+    """Returns the shared boto3 DynamoDB resource, creating it on first use."""
+    key = (_region(), MOCK_AWS)
+    resource = _resources.get(key)
+    if resource is not None:
+        return resource
+
+    with _registry_lock:
+        resource = _resources.get(key)
+        if resource is None:
+            config = Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+            if MOCK_AWS:
+                resource = boto3.resource(
+                    "dynamodb",
+                    region_name=_region(),
+                    endpoint_url=MOCK_ENDPOINT_URL,
+                    config=config,
                 )
             else:
-                raise ValueError(f"Table {table_name} not found")
+                resource = boto3.resource(
+                    "dynamodb", region_name=_region(), config=config
+                )
+            _resources[key] = resource
+    return resource
+
+
+def _attribute_definitions(names):
+    return [
+        {
+            "AttributeName": name,
+            "AttributeType": "N" if name in NUMBER_ATTRIBUTES else "S",
+        }
+        for name in dict.fromkeys(names)
+    ]
+
+
+def _index_definition(index_name, keys):
+    hash_key, range_key = keys
+    return {
+        "IndexName": index_name,
+        "KeySchema": [
+            {"AttributeName": hash_key, "KeyType": "HASH"},
+            {"AttributeName": range_key, "KeyType": "RANGE"},
+        ],
+        "Projection": {"ProjectionType": "ALL"},
+    }
+
+
+def _add_missing_indexes(table, table_name):
+    existing = {index["IndexName"] for index in table.global_secondary_indexes or []}
+    for index_name, keys in TABLE_INDEXES.get(table_name, {}).items():
+        if index_name in existing:
+            continue
+        print(f"Adding index {index_name} to {table_name}...")
+        # One index per UpdateTable call.
+        table.meta.client.update_table(
+            TableName=table_name,
+            AttributeDefinitions=_attribute_definitions(keys),
+            GlobalSecondaryIndexUpdates=[
+                {"Create": _index_definition(index_name, keys)}
+            ],
+        )
+    table.reload()
+
+
+def _provision_table(dynamodb, table_name):
+    """Creates a missing table in MOCK_AWS mode. Runs at most once per table."""
+    try:
+        table = dynamodb.Table(table_name)
+        table.load()
+        print(f"Table {table_name} already exists.")
+        _add_missing_indexes(table, table_name)
+    except dynamodb.meta.client.exceptions.ResourceNotFoundException:
+        print(f"Creating table {table_name}...")
 
-            table.wait_until_exists()
-            print(f"Table {table_name} created.")
+        hash_key = TABLE_KEYS.get(table_name)
+        if hash_key is None:
+            raise ValueError(f"Table {table_name} not found")
 
-    else:
-        dynamodb = boto3.resource(
-            "dynamodb", region_name=os.environ.get("AWS_REGION", "us-east-1")
+        indexes = TABLE_INDEXES.get(table_name, {})
+        kwargs = {}
+        if indexes:
+            kwargs["GlobalSecondaryIndexes"] = [
+                _index_definition(name, keys) for name, keys in indexes.items()
+            ]
+        table = dynamodb.create_table(
+            TableName=table_name,
+            KeySchema=[{"AttributeName": hash_key, "KeyType": "HASH"}],
+            AttributeDefinitions=_attribute_definitions(
+                [hash_key] + [key for keys in indexes.values() for key in keys]
+            ),
+            BillingMode="PAY_PER_REQUEST",
+            **kwargs,
         )
+        table.wait_until_exists()
+        print(f"Table {table_name} created.")
+    return table
+
+
+def get_table(table_name):
+    """Returns a cached Table, provisioning it lazily in MOCK_AWS mode."""
+    table = _tables.get(table_name)
+    if table is not None:
+        return table
+
+    dynamodb = get_resource()
+    with _registry_lock:
+        table = _tables.get(table_name)
+        if table is None:
+            if MOCK_AWS:
+                table = _provision_table(dynamodb, table_name)
+            else:
+                table = dynamodb.Table(table_name)
+            _tables[table_name] = table
+    return table
+
 
-    return dynamodb.Table(table_name)
+def reset_registry():
+    """Drops every cached resource and Table. Intended for tests."""
+    with _registry_lock:
+        _resources.clear()
+        _tables.clear()
 
 
 def put_item(table_name, item):
@@ -64,14 +194,270 @@ def get_item(table_name, key):
     return response.get("Item")
 
 
-def scan_table(table_name):
+def update_args(values, remove=None):
+    """Builds UpdateItem kwargs that set values and remove the named attributes."""
+    names = {f"#u{i}": name for i, name in enumerate(values)}
+    removed = {f"#r{i}": name for i, name in enumerate(remove or [])}
+    expression = "SET " + ", ".join(f"{n} = :{n[1:]}" for n in names)
+    if removed:
+        expression += " REMOVE " + ", ".join(removed)
+    return {
+        "UpdateExpression": expression,
+        "ExpressionAttributeNames": dict(names, **removed),
+        "ExpressionAttributeValues": {
+            f":{n[1:]}": values[name] for n, name in names.items()
+        },
+    }
+
+
+def update_item(table_name, key, values, return_values=None, remove=None):
+    """
+    Sets the given attributes on one item (and removes the attributes named
+    in remove) with a single UpdateItem call. With return_values (e.g.
+    "ALL_NEW") the returned attributes are passed on.
+    """
+    kwargs = {"ReturnValues": return_values} if return_values else {}
+    table = get_table(table_name)
+    response = table.update_item(Key=key, **update_args(values, remove), **kwargs)
+    return response.get("Attributes")
+
+
+def batch_put_items(table_name, items, overwrite_by_pkeys=None):
+    """Writes items through a batch_writer and returns how many were written."""
     table = get_table(table_name)
-    return table.scan().get("Items", [])
+    count = 0
+    with table.batch_writer(overwrite_by_pkeys=overwrite_by_pkeys) as batch:
+        for item in items:
+            batch.put_item(Item=item)
+            count += 1
+    return count
+
+
+def _chunks(items, size, key_name=None):
+    """Lazily groups an iterable into lists of at most size items."""
+    chunk = {}
+    for item in items:
+        # BatchWriteItem rejects two requests for the same key, keep the last one.
+        key = item.get(key_name) if key_name else None
+        chunk[key if key is not None else len(chunk)] = item
+        if len(chunk) == size:
+            yield list(chunk.values())
+            chunk = {}
+    if chunk:
+        yield list(chunk.values())
+
+
+def _write_chunk(table_name, chunk):
+    counts = {"written": 0, "retried": 0, "failed": 0}
+    requests = [{"PutRequest": {"Item": item}} for item in chunk]
+    attempt = 0
+    while requests:
+        try:
+            response = get_resource().batch_write_item(
+                RequestItems={table_name: requests}
+            )
+        except ClientError as e:
+            logger.error(f"BatchWriteItem on {table_name} failed: {e}")
+            counts["failed"] += len(requests)
+            return counts
+
+        unprocessed = response.get("UnprocessedItems", {}).get(table_name, [])
+        counts["written"] += len(requests) - len(unprocessed)
+        if not unprocessed:
+            break
+        attempt += 1
+        if attempt >= BATCH_WRITE_MAX_ATTEMPTS:
+            counts["failed"] += len(unprocessed)
+            break
+        counts["retried"] += len(unprocessed)
+        # Exponential backoff with full jitter, as recommended for throttling.
+        delay = min(BATCH_WRITE_MAX_DELAY, BATCH_WRITE_BASE_DELAY * 2**attempt)
+        time.sleep(random.uniform(0, delay))
+        requests = unprocessed
+    return counts
+
+
+def batch_write_items(table_name, items, max_workers=1):
+    """
+    Writes an iterable of items with 25-item BatchWriteItem calls.
+
+    UnprocessedItems are retried with jittered exponential backoff. With
+    max_workers > 1 chunks are written concurrently; the iterable is still
+    consumed lazily. Returns {"written", "retried", "failed"} counts.
+    """
+    get_table(table_name)  # provisions the table in MOCK_AWS mode
+    totals = {"written": 0, "retried": 0, "failed": 0}
+
+    def add(counts):
+        for name, value in counts.items():
+            totals[name] += value
+
+    chunks = _chunks(items, BATCH_WRITE_SIZE, TABLE_KEYS.get(table_name))
+    if max_workers <= 1:
+        for chunk in chunks:
+            add(_write_chunk(table_name, chunk))
+        return totals
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for chunk in chunks:
+            pending.add(executor.submit(_write_chunk, table_name, chunk))
+            # Bound the number of chunks held in memory.
+            if len(pending) >= max_workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    add(future.result())
+        for future in pending:
+            add(future.result())
+    return totals
+
+
+def batch_get_items(table_name, keys, attributes=None):
+    """Fetches items by key with 100-key BatchGetItem calls, in no particular order."""
+    get_table(table_name)  # provisions the table in MOCK_AWS mode
+    items = []
+    keys = list(keys)
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {"Keys": keys[start : start + BATCH_GET_SIZE]}
+        request.update(projection_args(attributes))
+        attempt = 0
+        while request:
+            response = get_resource().batch_get_item(RequestItems={table_name: request})
+            items.extend(response.get("Responses", {}).get(table_name, []))
+            request = response.get("UnprocessedKeys", {}).get(table_name)
+            if request:
+                attempt += 1
+                if attempt >= BATCH_WRITE_MAX_ATTEMPTS:
+                    raise RuntimeError(f"BatchGetItem on {table_name} kept throttling")
+                delay = min(BATCH_WRITE_MAX_DELAY, BATCH_WRITE_BASE_DELAY * 2**attempt)
+                time.sleep(random.uniform(0, delay))
+    return items
+
+
+def projection_args(attributes):
+    """Builds ProjectionExpression kwargs, aliasing names to dodge reserved words."""
+    if not attributes:
+        return {}
+    names = {f"#p{i}": name for i, name in enumerate(attributes)}
+    return {
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names,
+    }
+
+
+def encode_cursor(last_evaluated_key):
+    """Turns a LastEvaluatedKey into an opaque, URL-safe continuation token."""
+    serializer = TypeSerializer()
+    typed = {k: serializer.serialize(v) for k, v in last_evaluated_key.items()}
+    raw = json.dumps(typed, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor. Raises ValueError on a malformed token."""
+    try:
+        typed = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        deserializer = TypeDeserializer()
+        return {k: deserializer.deserialize(v) for k, v in typed.items()}
+    except Exception as e:
+        raise ValueError(f"Invalid continuation token: {e}")
+
+
+def scan_page(table_name, limit=None, start_key=None, attributes=None, **kwargs):
+    """Scans one page and returns (items, last_evaluated_key or None)."""
+    scan_kwargs = dict(kwargs)
+    scan_kwargs.update(projection_args(attributes))
+    if limit:
+        scan_kwargs["Limit"] = limit
+    if start_key:
+        scan_kwargs["ExclusiveStartKey"] = start_key
+    response = get_table(table_name).scan(**scan_kwargs)
+    return response.get("Items", []), response.get("LastEvaluatedKey")
+
+
+def query_page(
+    table_name, index_name=None, limit=None, start_key=None, attributes=None, **kwargs
+):
+    """Queries one page (of an index, if given) and returns (items, last_key)."""
+    query_kwargs = dict(kwargs)
+    query_kwargs.update(projection_args(attributes))
+    if index_name:
+        query_kwargs["IndexName"] = index_name
+    if limit:
+        query_kwargs["Limit"] = limit
+    if start_key:
+        query_kwargs["ExclusiveStartKey"] = start_key
+    response = get_table(table_name).query(**query_kwargs)
+    return response.get("Items", []), response.get("LastEvaluatedKey")
+
+
+def query_all(table_name, index_name=None, attributes=None, **kwargs):
+    """Returns every item matching the query, following LastEvaluatedKey."""
+    items = []
+    start_key = None
+    while True:
+        page, start_key = query_page(
+            table_name, index_name, start_key=start_key, attributes=attributes, **kwargs
+        )
+        items.extend(page)
+        if not start_key:
+            return items
+
+
+def _scan_all(table_name, attributes=None, **kwargs):
+    items = []
+    start_key = None
+    while True:
+        page, start_key = scan_page(
+            table_name, start_key=start_key, attributes=attributes, **kwargs
+        )
+        items.extend(page)
+        if not start_key:
+            return items
+
+
+def scan_table(table_name, attributes=None):
+    """Returns every item of the table, following LastEvaluatedKey."""
+    return _scan_all(table_name, attributes=attributes)
+
+
+def parallel_scan(
+    table_name, total_segments=4, attributes=None, max_workers=None, **kwargs
+):
+    """
+    Scans all segments of the table concurrently and returns every item.
+    Extra arguments (e.g. FilterExpression) are passed to every Scan call.
+    """
+    if total_segments <= 1:
+        return _scan_all(table_name, attributes=attributes, **kwargs)
+
+    def scan_segment(segment):
+        return _scan_all(
+            table_name,
+            attributes=attributes,
+            Segment=segment,
+            TotalSegments=total_segments,
+            **kwargs,
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers or total_segments) as executor:
+        segments = list(executor.map(scan_segment, range(total_segments)))
+    return [item for segment in segments for item in segment]
+
+
+def json_default(value):
+    """json.dumps hook for the Decimal numbers, sets and binaries boto3 returns."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, Binary):
+        value = value.value
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
 
 
 def get_dynamodb_table(table_name):
-    """Returns a Boto3 DynamoDB Table resource."""
-    # In a real app with LocalStack, you might add endpoint_url logic here
-    # based on an environment variable, but for mock this is sufficient.
-    dynamodb_resource = boto3.resource("dynamodb")
-    return dynamodb_resource.Table(table_name)
+    """Returns a Boto3 DynamoDB Table resource from the shared registry."""
+    return get_table(table_name)
@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from common.dynamodb import AI_RESPONSE_CACHE_TABLE, SYNC_STATE_TABLE, get_table
+from common.response_cache import fingerprint
+from common.responses import dumps
+
+logger = logging.getLogger(__name__)
+
+# Customers is only written by the Salesforce sync and poll, and each
+# commit bumps this counter, so (version, query) identifies a listing. The
+# generic write helpers (dynamodb.put_item, batch_write_items, the aio
+# variants) do not know about it: any other writer to Customers must call
+# bump_version() after its writes, or listings stay stale until it does.
+VERSION_ID = "customers_version"
+# How long a container trusts its last read of the version. Writers see
+# their own bump at once; other containers within this many seconds.
+VERSION_CHECK_SECONDS = float(os.environ.get("LISTING_VERSION_CHECK_SECONDS", 5))
+LOCAL_CACHE_SIZE = int(os.environ.get("LISTING_CACHE_SIZE", 64))
+# Larger listings (e.g. full exports) are not kept in memory.
+MAX_CACHED_ITEMS = int(os.environ.get("LISTING_CACHE_MAX_ITEMS", 5000))
+# Optional tier shared by all containers, in the AIResponseCache table.
+SHARED_CACHE = os.environ.get("LISTING_SHARED_CACHE", "false").lower() == "true"
+SHARED_TTL_SECONDS = int(os.environ.get("LISTING_SHARED_TTL_SECONDS", 86400))
+# DynamoDB items are capped at 400 KB.
+MAX_SHARED_BYTES = 350_000
+
+_version = {}
+_local = OrderedDict()
+_lock = threading.Lock()
+_stats = {"local_hits": 0, "shared_hits": 0, "misses": 0}
+
+
+def _version_key():
+    return {"state_id": VERSION_ID}
+
+
+def bump_version():
+    """
+    Marks the Customers table as changed. Every writer to Customers calls it
+    after each committed write, including one-off and test writes.
+    """
+    response = get_table(SYNC_STATE_TABLE).update_item(
+        Key=_version_key(),
+        UpdateExpression="ADD #v :one",
+        ExpressionAttributeNames={"#v": "version"},
+        ExpressionAttributeValues={":one": 1},
+        ReturnValues="UPDATED_NEW",
+    )
+    version = int(response["Attributes"]["version"])
+    with _lock:
+        _version.update(value=version, checked_at=time.time())
+    return version
+
+
+def current_version():
+    """The table version, re-read at most every VERSION_CHECK_SECONDS."""
+    now = time.time()
+    with _lock:
+        if _version and now - _version["checked_at"] < VERSION_CHECK_SECONDS:
+            return _version["value"]
+    item = get_table(SYNC_STATE_TABLE).get_item(Key=_version_key()).get("Item")
+    version = int(item["version"]) if item else 0
+    with _lock:
+        _version.update(value=version, checked_at=now)
+    return version
+
+
+def cache_key(version, params):
+    return f"listing:{version}:{fingerprint(params or {})}"
+
+
+def etag(version, params):
+    # Weak: the same listing may be sent as JSON, NDJSON or compressed.
+    return f'W/"{fingerprint(cache_key(version, params))[:32]}"'
+
+
+def get(version, params):
+    """Returns the cached {"items", "headers"} of a listing, or None."""
+    key = cache_key(version, params)
+    with _lock:
+        entry = _local.get(key)
+        if entry is not None:
+            _local.move_to_end(key)
+            _stats["local_hits"] += 1
+            return entry
+
+    if SHARED_CACHE:
+        try:
+            item = (
+                get_table(AI_RESPONSE_CACHE_TABLE)
+                .get_item(Key={"cache_key": key})
+                .get("Item")
+            )
+        except Exception as e:
+            logger.warning(f"Shared listing cache read failed: {e}")
+            item = None
+        if item and item.get("expires_at", 0) > time.time():
+            entry = json.loads(zlib.decompress(item["listing"].value))
+            _put_local(key, entry)
+            with _lock:
+                _stats["shared_hits"] += 1
+            return entry
+
+    with _lock:
+        _stats["misses"] += 1
+    return None
+
+
+def _put_local(key, entry):
+    with _lock:
+        _local[key] = entry
+        _local.move_to_end(key)
+        while len(_local) > LOCAL_CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def put(version, params, items, headers):
+    """Caches a listing computed at version."""
+    if len(items) > MAX_CACHED_ITEMS:
+        return
+    key = cache_key(version, params)
+    entry = {"items": items, "headers": headers}
+    _put_local(key, entry)
+    if not SHARED_CACHE:
+        return
+    blob = zlib.compress(dumps(entry))
+    if len(blob) > MAX_SHARED_BYTES:
+        return
+    try:
+        get_table(AI_RESPONSE_CACHE_TABLE).put_item(
+            Item={
+                "cache_key": key,
+                "listing": blob,
+                "expires_at": int(time.time()) + SHARED_TTL_SECONDS,
+            }
+        )
+    except Exception as e:
+        # The cache is an optimisation; the listing was already computed.
+        logger.warning(f"Shared listing cache write failed: {e}")
+
+
+def get_stats():
+    with _lock:
+        return dict(_stats, local_entries=len(_local))
+
+
+def clear():
+    """Empties the local tier and forgets the version. Intended for tests."""
+    with _lock:
+        _local.clear()
+        _version.clear()
+        for name in _stats:
+            _stats[name] = 0
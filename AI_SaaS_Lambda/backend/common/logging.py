@@ -1,7 +1,236 @@
+import functools
+import json
 import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Metrics go to stdout in CloudWatch Embedded Metric Format, one record per
+# invocation. Every span feeds them; individual spans are only logged for a
+# sampled share of invocations, or when they are slow or fail.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "AISaaS")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.05))
+SLOW_SPAN_MS = float(os.environ.get("SLOW_SPAN_MS", 1000))
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+# CloudWatch takes at most 100 values per metric in one EMF record; beyond
+# that a uniform sample of the values is kept.
+MAX_METRIC_VALUES = 100
+MAX_BUFFERED_SPANS = 500
+
+_invocation = {}
+_local = threading.local()
+_lock = threading.Lock()
+_metrics = {}
+_spans = []
+_instrumented = False
+_cold_start = True
+
+
+def correlation():
+    """Ids attached to every log line: the invocation's plus the thread's."""
+    ids = {k: v for k, v in _invocation.items() if k != "sampled" and v}
+    ids.update(getattr(_local, "fields", {}))
+    return ids
+
+
+@contextmanager
+def bind(**fields):
+    """Adds correlation fields (e.g. query_id) to the logs of this thread."""
+    previous = getattr(_local, "fields", {})
+    _local.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        _local.fields = previous
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "timestamp": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(correlation())
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def put_metric(name, value, unit="Milliseconds"):
+    """Adds one value to the metric flushed at the end of the invocation."""
+    with _lock:
+        metric = _metrics.setdefault(name, {"unit": unit, "values": [], "seen": 0})
+        metric["seen"] += 1
+        if len(metric["values"]) < MAX_METRIC_VALUES:
+            metric["values"].append(value)
+        else:
+            slot = random.randrange(metric["seen"])
+            if slot < MAX_METRIC_VALUES:
+                metric["values"][slot] = value
+
+
+def _record(name, ms, fields, error=False):
+    put_metric(name, ms)
+    if _invocation.get("sampled") or error or ms >= SLOW_SPAN_MS:
+        entry = {"span": name, "ms": round(ms, 2), **fields, **correlation()}
+        if error:
+            entry["error"] = True
+        with _lock:
+            if len(_spans) < MAX_BUFFERED_SPANS:
+                _spans.append(entry)
+
+
+@contextmanager
+def span(name, **fields):
+    """Times the block and records it under the metric name."""
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        _record(name, (time.perf_counter() - start) * 1000, fields, error)
+
+
+def timed(name):
+    """Decorator form of span."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_session(session, name):
+    """Records every response of a requests.Session under the metric name."""
+
+    def on_response(response, *args, **kwargs):
+        _record(
+            name,
+            response.elapsed.total_seconds() * 1000,
+            {"method": response.request.method, "status": response.status_code},
+            error=response.status_code >= 500,
+        )
+
+    session.hooks["response"].append(on_response)
+    return session
+
+
+def _instrument_botocore():
+    """Wraps every AWS API call in a span named after its service."""
+    from botocore.client import BaseClient
+
+    original = BaseClient._make_api_call
+
+    @functools.wraps(original)
+    def _make_api_call(self, operation_name, api_params):
+        with span(self.meta.service_model.service_name, operation=operation_name):
+            return original(self, operation_name, api_params)
+
+    BaseClient._make_api_call = _make_api_call
+
+
+def instrument():
+    """Installs the automatic AWS spans once per container."""
+    global _instrumented
+    with _lock:
+        if _instrumented:
+            return
+        _instrumented = True
+    _instrument_botocore()
+
+
+def _emit(entry):
+    sys.stdout.write(json.dumps(entry, default=str) + "\n")
+
+
+def flush():
+    """Writes the buffered spans and one EMF record, then resets the buffers."""
+    with _lock:
+        metrics = dict(_metrics)
+        spans = list(_spans)
+        _metrics.clear()
+        _spans.clear()
+    if not METRICS_ENABLED:
+        return
+    for entry in spans:
+        _emit(entry)
+    if not metrics:
+        return
+    function = _invocation.get("function", "unknown")
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["function"]],
+                    "Metrics": [
+                        {"Name": name, "Unit": metric["unit"]}
+                        for name, metric in metrics.items()
+                    ],
+                }
+            ],
+        },
+        "function": function,
+    }
+    if _invocation.get("request_id"):
+        record["request_id"] = _invocation["request_id"]
+    for name, metric in metrics.items():
+        record[name] = metric["values"]
+    _emit(record)
+
+
+def instrument_handler(func):
+    """
+    Decorates a lambda_handler: binds the request id, times the invocation,
+    decides whether its spans are logged, and flushes metrics at the end.
+    """
+    function = func.__module__.split(".")[0]
+
+    @functools.wraps(func)
+    def wrapper(event, context):
+        global _cold_start
+        instrument()
+        _invocation.clear()
+        _invocation.update(
+            function=function,
+            request_id=getattr(context, "aws_request_id", None),
+            sampled=random.random() < TRACE_SAMPLE_RATE,
+        )
+        if _cold_start:
+            _cold_start = False
+            put_metric("cold_start", 1, unit="Count")
+        try:
+            with span("handler"):
+                return func(event, context)
+        finally:
+            flush()
+            _invocation.clear()
+
+    return wrapper
 
 
 def setup_logger():
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
+    if LOG_FORMAT == "json":
+        # The Lambda runtime installs the root handler; only its format changes.
+        for handler in logger.handlers:
+            if not isinstance(handler.formatter, JsonFormatter):
+                handler.setFormatter(JsonFormatter())
+    instrument()
     return logger
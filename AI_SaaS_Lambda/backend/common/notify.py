@@ -0,0 +1,126 @@
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from common.dynamodb import MOCK_AWS, json_default
+from common.lazy import lazy_import
+from common.logging import instrument_session
+
+# Only loaded when a callback is actually sent.
+requests = lazy_import("requests")
+
+logger = logging.getLogger(__name__)
+
+# Shared secret used to sign webhook bodies (X-Signature: sha256=<hex>).
+WEBHOOK_SECRET = os.environ.get("AI_WEBHOOK_SECRET")
+WEBHOOK_TIMEOUT_SECONDS = float(os.environ.get("AI_WEBHOOK_TIMEOUT_SECONDS", 3))
+WEBHOOK_MAX_WORKERS = int(os.environ.get("AI_WEBHOOK_MAX_WORKERS", 5))
+
+TERMINAL_STATUSES = ("COMPLETED", "FAILED")
+
+_session = None
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = instrument_session(requests.Session(), "webhook")
+    return _session
+
+
+def _is_internal(address):
+    address = ipaddress.ip_address(address.split("%")[0])
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return (
+        address.is_loopback
+        or address.is_private
+        or address.is_link_local
+        or address.is_reserved
+        or address.is_multicast
+        or address.is_unspecified
+    )
+
+
+def _resolves_to_public(host, port):
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError):
+        return False
+    return bool(infos) and not any(_is_internal(info[4][0]) for info in infos)
+
+
+def is_valid_callback_url(url):
+    """
+    Callbacks must be https and resolve only to public addresses, so query
+    results are never posted to the Lambda runtime API, instance metadata
+    or VPC-internal hosts. MOCK_AWS mode allows plain http and any host.
+    """
+    if not isinstance(url, str):
+        return False
+    parsed = urlparse(url)
+    schemes = ("https", "http") if MOCK_AWS else ("https",)
+    if parsed.scheme not in schemes or not parsed.hostname:
+        return False
+    if MOCK_AWS:
+        return True
+    try:
+        port = parsed.port or 443
+    except ValueError:
+        return False
+    return _resolves_to_public(parsed.hostname, port)
+
+
+def sign(body):
+    return hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+
+def payload(item):
+    """The part of a query item sent to callbacks and status clients."""
+    return {k: v for k, v in item.items() if k not in ("callback_url", "expires_at")}
+
+
+def _post(item):
+    # Checked again at send time: the host may resolve differently by now.
+    if not is_valid_callback_url(item["callback_url"]):
+        logger.warning(f"Refusing callback for query {item['query_id']}")
+        return False
+    body = json.dumps(payload(item), default=json_default).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if WEBHOOK_SECRET:
+        headers["X-Signature"] = f"sha256={sign(body)}"
+    try:
+        resp = _get_session().post(
+            item["callback_url"],
+            data=body,
+            headers=headers,
+            timeout=WEBHOOK_TIMEOUT_SECONDS,
+        )
+        resp.raise_for_status()
+        return True
+    except Exception as e:
+        logger.warning(f"Callback for query {item['query_id']} failed: {e}")
+        return False
+
+
+def notify_completed(items):
+    """
+    POSTs every finished query item that carries a callback_url to it.
+    Delivery is best effort: failures are logged and clients can still fall
+    back to the status endpoint. Returns the number of delivered callbacks.
+    """
+    targets = [
+        item
+        for item in items
+        if item.get("callback_url") and item.get("status") in TERMINAL_STATUSES
+    ]
+    if not targets:
+        return 0
+    workers = max(1, min(WEBHOOK_MAX_WORKERS, len(targets)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(_post, targets))
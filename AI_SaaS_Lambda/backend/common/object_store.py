@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+import boto3
+from common.dynamodb import MOCK_AWS, MOCK_ENDPOINT_URL
+
+logger = logging.getLogger(__name__)
+
+# Where payloads too large for a DynamoDB item are kept. S3 in production;
+# a local directory (tests, local runs) when only AI_PAYLOAD_DIR is set.
+PAYLOAD_BUCKET = os.environ.get("AI_PAYLOAD_BUCKET")
+PAYLOAD_PREFIX = os.environ.get("AI_PAYLOAD_PREFIX", "ai-queries/")
+PAYLOAD_DIR = os.environ.get("AI_PAYLOAD_DIR")
+
+_store = None
+_lock = threading.Lock()
+
+
+class S3Store:
+    """Objects in one S3 bucket under a key prefix."""
+
+    def __init__(self, bucket, prefix=""):
+        self.bucket = bucket
+        self.prefix = prefix
+        if MOCK_AWS:
+            self.client = boto3.client(
+                "s3",
+                region_name="us-east-1",
+                endpoint_url=MOCK_ENDPOINT_URL,
+                aws_access_key_id="test",
+                aws_secret_access_key="test",
+            )
+        else:
+            self.client = boto3.client("s3")
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def get(self, key):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        return response["Body"].read()
+
+
+class LocalStore:
+    """Objects as files below a directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.abspath(self.root) + os.sep):
+            raise ValueError(f"Invalid object key: {key}")
+        return path
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name so readers never see a partial file.
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def get(self, key):
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+
+def get_store():
+    """
+    Returns the configured store (anything with put(key, data) and get(key)),
+    or None when neither AI_PAYLOAD_BUCKET nor AI_PAYLOAD_DIR is set.
+    """
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                if PAYLOAD_BUCKET:
+                    _store = S3Store(PAYLOAD_BUCKET, PAYLOAD_PREFIX)
+                elif PAYLOAD_DIR:
+                    _store = LocalStore(os.path.abspath(PAYLOAD_DIR))
+    return _store
+
+
+def set_store(store):
+    """Replaces the store, e.g. with a LocalStore in tests. None resets it."""
+    global _store
+    with _lock:
+        _store = store
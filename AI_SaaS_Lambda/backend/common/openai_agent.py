@@ -1,18 +1,178 @@
-import openai
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from common import prompt_budget, rate_limit, response_cache
+from common.lazy import lazy_import
+from common.logging import span
 
-openai.api_key = os.environ.get("OPENAI_API_KEY")
+# openai 0.28 pulls in aiohttp; answers served from the cache never need it.
+openai = lazy_import("openai")
 
+logger = logging.getLogger(__name__)
 
-def process_query(prompt, dataset):
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a helpful assistant for our SaaS platform. Analyze user queries and the provided data to give customer insight.",
-            },
-            {"role": "user", "content": f"{prompt}\n\nDataset: {dataset}"},
-        ],
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+
+MODEL = os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
+SYSTEM_PROMPT = "You are a helpful assistant for our SaaS platform. Analyze user queries and the provided data to give customer insight."
+# Optional completion cap; also lets streaming report a progress percentage.
+MAX_TOKENS = int(os.environ.get("OPENAI_MAX_TOKENS", 0))
+
+# Map-reduce over datasets that do not fit in one prompt. Every map answer is
+# capped, and so is the number of parts, which bounds cost and latency.
+MAP_CONCURRENCY = int(os.environ.get("OPENAI_MAP_CONCURRENCY", 4))
+MAX_MAP_CHUNKS = int(os.environ.get("OPENAI_MAX_MAP_CHUNKS", 8))
+MAP_RESPONSE_TOKENS = int(os.environ.get("OPENAI_MAP_RESPONSE_TOKENS", 300))
+# Reduce rounds before the findings are sent as they are.
+MAX_REDUCE_ROUNDS = 3
+MAP_SYSTEM_PROMPT = (
+    f"{SYSTEM_PROMPT} You see one part of a larger dataset. Extract only the "
+    "facts and figures from this part that help answer the question, "
+    "concisely; the parts are combined afterwards."
+)
+REDUCE_SYSTEM_PROMPT = (
+    f"{SYSTEM_PROMPT} You are given findings drawn from different parts of "
+    "the same dataset. Combine them into one answer to the question."
+)
+
+
+def _retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _create(**kwargs):
+    """ChatCompletion.create, with retryable provider errors raised as Throttled."""
+    try:
+        return openai.ChatCompletion.create(api_key=OPENAI_API_KEY, **kwargs)
+    except openai.error.RateLimitError as e:
+        if e.code == "insufficient_quota":
+            raise  # billing, not throughput: retrying cannot help
+        raise rate_limit.Throttled(str(e), _retry_after(e)) from e
+    except (
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.TryAgain,
+    ) as e:
+        raise rate_limit.Throttled(str(e), _retry_after(e)) from e
+
+
+def _complete(system_prompt, user_content, max_tokens=None, on_partial=None):
+    kwargs = {}
+    max_tokens = max_tokens or MAX_TOKENS
+    if max_tokens:
+        kwargs["max_tokens"] = max_tokens
+    if on_partial is not None:
+        kwargs["stream"] = True
+    messages = prompt_budget.messages_for(system_prompt, user_content)
+    # Quota is charged for the prompt plus the answer the model may produce.
+    tokens = prompt_budget.count_tokens(system_prompt + user_content) + (
+        max_tokens or prompt_budget.RESPONSE_TOKENS
     )
-    return response["choices"][0]["message"]["content"]
+
+    def attempt():
+        # Streamed answers are timed until their last chunk.
+        with span("openai", model=MODEL, stream=on_partial is not None):
+            response = _create(model=MODEL, messages=messages, **kwargs)
+            if on_partial is None:
+                return response["choices"][0]["message"]["content"]
+            content = ""
+            for chunk in response:
+                delta = chunk["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    content += delta
+                    on_partial(content)
+            return content
+
+    return rate_limit.call(attempt, tokens)
+
+
+def _response_tokens():
+    return MAX_TOKENS or prompt_budget.RESPONSE_TOKENS
+
+
+def _map_reduce(prompt, dataset, on_partial=None, depth=1):
+    """Answers each part of the dataset concurrently, then merges the answers."""
+    budget = prompt_budget.dataset_budget(
+        MODEL, MAP_SYSTEM_PROMPT, prompt, response_tokens=MAP_RESPONSE_TOKENS
+    )
+    if budget < prompt_budget.MIN_CHUNK_TOKENS:
+        raise prompt_budget.PromptTooLong(
+            f"The prompt leaves {budget} tokens per dataset part; shorten it"
+        )
+    chunks = prompt_budget.split_dataset(dataset, budget, MODEL)
+    total = len(chunks)
+    if total > MAX_MAP_CHUNKS:
+        logger.warning(f"Dataset needs {total} parts, analysing {MAX_MAP_CHUNKS}")
+        chunks = chunks[:MAX_MAP_CHUNKS]
+
+    def answer_part(numbered):
+        index, chunk = numbered
+        content = f"{prompt}\n\nDataset (part {index} of {total}): {chunk}"
+        return _complete(MAP_SYSTEM_PROMPT, content, max_tokens=MAP_RESPONSE_TOKENS)
+
+    workers = max(1, min(MAP_CONCURRENCY, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        partials = list(executor.map(answer_part, enumerate(chunks, start=1)))
+
+    findings = "\n\n".join(
+        f"Part {index}: {partial}" for index, partial in enumerate(partials, start=1)
+    )
+    if len(chunks) < total:
+        findings += f"\n\n(Only {len(chunks)} of {total} parts were analysed.)"
+
+    reduce_budget = prompt_budget.dataset_budget(
+        MODEL, REDUCE_SYSTEM_PROMPT, prompt, response_tokens=_response_tokens()
+    )
+    too_long = prompt_budget.count_tokens(findings, MODEL) > reduce_budget
+    if too_long and depth < MAX_REDUCE_ROUNDS:
+        # Too many findings for one call: reduce them in another round.
+        return _map_reduce(prompt, findings, on_partial=on_partial, depth=depth + 1)
+    return _complete(
+        REDUCE_SYSTEM_PROMPT,
+        f"{prompt}\n\nFindings: {findings}",
+        on_partial=on_partial,
+    )
+
+
+def answer(prompt, dataset, on_partial=None):
+    """
+    Calls the model once when the dataset fits the prompt budget, otherwise
+    map-reduces it over budget-sized parts.
+    """
+    budget = prompt_budget.dataset_budget(
+        MODEL, SYSTEM_PROMPT, prompt, response_tokens=_response_tokens()
+    )
+    if prompt_budget.count_tokens(dataset, MODEL) <= budget:
+        return _complete(
+            SYSTEM_PROMPT, f"{prompt}\n\nDataset: {dataset}", on_partial=on_partial
+        )
+    return _map_reduce(prompt, dataset, on_partial=on_partial)
+
+
+def cache_key(prompt, dataset):
+    """Response cache key of one prompt against one dataset."""
+    return response_cache.make_key(MODEL, SYSTEM_PROMPT, prompt, dataset)
+
+
+def process_query(prompt, dataset, use_cache=True, on_partial=None):
+    """
+    Answers a prompt against a dataset. Identical requests are served from
+    the response cache unless use_cache is False; fresh answers always
+    refresh the cache.
+
+    With on_partial the model's token stream is consumed and on_partial is
+    called with the text received so far after every chunk.
+    """
+    key = cache_key(prompt, dataset)
+    if use_cache:
+        cached = response_cache.get(key)
+        if cached is not None:
+            return cached
+
+    content = answer(prompt, dataset, on_partial=on_partial)
+    response_cache.put(key, content, model=MODEL)
+    return content
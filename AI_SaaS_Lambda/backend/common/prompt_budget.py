@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Context window of the configured model and the share reserved for its answer.
+CONTEXT_TOKENS = int(os.environ.get("OPENAI_CONTEXT_TOKENS", 4096))
+RESPONSE_TOKENS = int(os.environ.get("OPENAI_RESPONSE_TOKENS", 800))
+# Per-message framing overhead of the chat format, plus a safety margin for
+# the character-based estimate used when tiktoken is not installed.
+MESSAGE_OVERHEAD_TOKENS = 8
+SAFETY_MARGIN = 0.9
+# Smallest dataset part worth a model call. A prompt that leaves less than
+# this per part is rejected instead of map-reduced over slivers.
+MIN_CHUNK_TOKENS = int(os.environ.get("OPENAI_MIN_CHUNK_TOKENS", 256))
+
+
+class PromptTooLong(ValueError):
+    """The prompt leaves too little of the context window for the dataset."""
+
+
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+def _encoder(model):
+    """Returns a tiktoken encoding for model, or None without tiktoken."""
+    with _encoders_lock:
+        if model not in _encoders:
+            try:
+                import tiktoken
+
+                try:
+                    _encoders[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _encoders[model] = tiktoken.get_encoding("cl100k_base")
+            except ImportError:
+                _encoders[model] = None
+        return _encoders[model]
+
+
+def count_tokens(text, model=None):
+    """Exact token count with tiktoken, otherwise about four characters per token."""
+    encoder = _encoder(model) if model else None
+    if encoder is None:
+        return (len(text) + 3) // 4
+    return len(encoder.encode(text))
+
+
+def messages_for(system_prompt, user_content):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_content},
+    ]
+
+
+def dataset_budget(model, system_prompt, prompt, response_tokens=RESPONSE_TOKENS):
+    """Tokens left for the dataset once the prompts and the answer are paid for."""
+    fixed = (
+        count_tokens(system_prompt, model)
+        + count_tokens(prompt, model)
+        + 3 * MESSAGE_OVERHEAD_TOKENS
+    )
+    return max(0, int((CONTEXT_TOKENS - response_tokens - fixed) * SAFETY_MARGIN))
+
+
+def _split_line(line, budget, model):
+    """Splits a single over-long line into pieces of at most budget tokens."""
+    pieces = []
+    # Shrink a character window until it fits; tokens never exceed characters.
+    size = max(1, budget * 4)
+    while line:
+        piece = line[:size]
+        while size > 1 and count_tokens(piece, model) > budget:
+            size = max(1, size // 2)
+            piece = line[:size]
+        pieces.append(piece)
+        line = line[len(piece) :]
+    return pieces
+
+
+def split_dataset(dataset, budget, model=None):
+    """
+    Splits dataset text into chunks of at most budget tokens. Chunks break
+    at line boundaries so rows are never cut in half unless a single row is
+    larger than the budget.
+    """
+    if budget < 2:
+        raise ValueError(f"Cannot split a dataset into {budget}-token chunks")
+    chunks = []
+    current, current_tokens = [], 0
+    for line in dataset.splitlines():
+        tokens = count_tokens(line, model) + 1
+        if tokens > budget:
+            pieces = _split_line(line, budget - 1, model)
+        else:
+            pieces = [line]
+        for piece in pieces:
+            piece_tokens = count_tokens(piece, model) + 1
+            if current and current_tokens + piece_tokens > budget:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
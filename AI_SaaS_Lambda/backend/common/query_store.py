@@ -0,0 +1,131 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from boto3.dynamodb.types import Binary
+from common import object_store
+from common.dynamodb import AI_QUERIES_TABLE, batch_get_items, get_item, update_item
+
+logger = logging.getLogger(__name__)
+
+# Attributes that carry model output and may be large.
+PAYLOAD_FIELDS = ("response", "error")
+# Text of at least this many UTF-8 bytes is stored zlib-compressed (as a
+# Binary attribute). DynamoDB bills writes per started KB.
+COMPRESS_MIN_BYTES = int(os.environ.get("AI_QUERY_COMPRESS_MIN_BYTES", 1024))
+# Compressed payloads above this go to the object store and the item keeps
+# only a reference; items are capped at 400 KB including the prompt.
+OFFLOAD_MIN_BYTES = int(os.environ.get("AI_QUERY_OFFLOAD_MIN_BYTES", 100_000))
+# Records expire this long after their last write (DynamoDB TTL on expires_at).
+TTL_SECONDS = int(float(os.environ.get("AI_QUERY_TTL_DAYS", 30)) * 86400)
+TTL_ATTRIBUTE = "expires_at"
+# Offloaded payloads are immutable, so readers keep the last few decoded.
+OFFLOAD_CACHE_SIZE = 16
+
+_offloaded = OrderedDict()
+_lock = threading.Lock()
+
+
+def expires_at():
+    return int(time.time()) + TTL_SECONDS
+
+
+def _encode_text(query_id, field, text):
+    data = text.encode("utf-8")
+    if len(data) < COMPRESS_MIN_BYTES:
+        return text
+    compressed = zlib.compress(data)
+    if len(compressed) < OFFLOAD_MIN_BYTES:
+        return Binary(compressed) if len(compressed) < len(data) else text
+    store = object_store.get_store()
+    if store is None:
+        logger.warning(
+            f"{field} of {query_id} is {len(compressed)} bytes compressed and "
+            "no object store is configured; storing it in the item"
+        )
+        return Binary(compressed)
+    # Content-addressed, so rewrites of a streamed answer never clash.
+    key = f"{query_id}/{field}-{hashlib.sha256(data).hexdigest()[:16]}.z"
+    store.put(key, compressed)
+    return {"object_key": key, "size": len(data)}
+
+
+def encode(query_id, values):
+    """
+    Returns values with each text payload field in its stored form: plain,
+    compressed or offloaded. Already encoded values are passed through.
+    """
+    encoded = dict(values)
+    for field in PAYLOAD_FIELDS:
+        if isinstance(encoded.get(field), str):
+            encoded[field] = _encode_text(query_id, field, encoded[field])
+    return encoded
+
+
+def _load(key):
+    with _lock:
+        text = _offloaded.get(key)
+        if text is not None:
+            _offloaded.move_to_end(key)
+            return text
+    text = zlib.decompress(object_store.get_store().get(key)).decode("utf-8")
+    with _lock:
+        _offloaded[key] = text
+        while len(_offloaded) > OFFLOAD_CACHE_SIZE:
+            _offloaded.popitem(last=False)
+    return text
+
+
+def decode(item):
+    """Returns a copy of a stored item with its payload fields as text."""
+    if item is None:
+        return None
+    decoded = dict(item)
+    for field in PAYLOAD_FIELDS:
+        value = decoded.get(field)
+        if isinstance(value, Binary):
+            decoded[field] = zlib.decompress(value.value).decode("utf-8")
+        elif isinstance(value, dict) and "object_key" in value:
+            decoded[field] = _load(value["object_key"])
+    return decoded
+
+
+def update(query_id, values, remove=None, return_values=None):
+    """
+    Sets values on one query record with UpdateItem, encoding its payload
+    fields and refreshing its TTL. With return_values the decoded item is
+    returned.
+    """
+    values = dict(encode(query_id, values), **{TTL_ATTRIBUTE: expires_at()})
+    item = update_item(
+        AI_QUERIES_TABLE, {"query_id": query_id}, values, return_values, remove
+    )
+    return decode(item)
+
+
+def finish(item):
+    """
+    Stores the final status of a query: status and response or error only.
+    The prompt stays as submitted, and stale partial fields are removed.
+    """
+    values = {k: v for k, v in item.items() if k == "status" or k in PAYLOAD_FIELDS}
+    remove = ["progress"] + [field for field in PAYLOAD_FIELDS if field not in values]
+    update(item["query_id"], values, remove=remove)
+
+
+def get(query_id):
+    return decode(get_item(AI_QUERIES_TABLE, {"query_id": query_id}))
+
+
+def batch_get(query_ids):
+    keys = [{"query_id": query_id} for query_id in query_ids]
+    return [decode(item) for item in batch_get_items(AI_QUERIES_TABLE, keys)]
+
+
+def clear_cache():
+    """Forgets decoded offloaded payloads. Intended for tests."""
+    with _lock:
+        _offloaded.clear()
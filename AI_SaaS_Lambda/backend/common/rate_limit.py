@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Provider quota available to one container (requests and tokens per
+# minute); 0 disables that bucket. Divide the account quota by the number of
+# worker containers expected to run at once.
+RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", 3500))
+TPM_LIMIT = int(os.environ.get("OPENAI_TPM_LIMIT", 90000))
+# Model calls in flight at once: grows by one per limit's worth of successes
+# and is cut by DECREASE_FACTOR on every throttled call (AIMD).
+INITIAL_CONCURRENCY = int(os.environ.get("OPENAI_INITIAL_CONCURRENCY", 4))
+MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", 16))
+DECREASE_FACTOR = 0.5
+# Retries of a throttled call, and the total time one call may spend waiting
+# before it is handed back to SQS instead.
+MAX_ATTEMPTS = int(os.environ.get("OPENAI_MAX_ATTEMPTS", 5))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20.0
+MAX_WAIT_SECONDS = float(os.environ.get("OPENAI_MAX_THROTTLE_WAIT_SECONDS", 60))
+# How often async callers recheck a full concurrency limit.
+ACQUIRE_POLL_SECONDS = 0.01
+
+
+class Throttled(Exception):
+    """The provider rejected or timed out a call that may succeed later."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RetryableError(Exception):
+    """A call stayed throttled through every retry; the work should be retried later."""
+
+
+class TokenBucket:
+    """
+    Per-minute budget refilled continuously. Callers reserve what they need
+    up front and sleep off any deficit, so waiting callers queue fairly.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """Takes amount from the bucket and returns the seconds to wait first."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.level -= min(amount, self.capacity)
+            return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, amount):
+        """Returns a reservation that was not spent."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.level = min(self.capacity, self.level + min(amount, self.capacity))
+
+    def pause(self, seconds):
+        """Empties the bucket for seconds, e.g. after a Retry-After."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.level = min(self.level, -seconds * self.rate)
+
+
+class AdaptiveConcurrency:
+    """Additive-increase, multiplicative-decrease limit on calls in flight."""
+
+    def __init__(self, initial, maximum):
+        self.limit = float(max(1, min(initial, maximum)))
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        """Non-blocking acquire, for async callers that poll."""
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+# Shared by every thread of the container, across warm invocations.
+_requests = None
+_tokens = None
+_concurrency = None
+_stats = {"calls": 0, "throttled": 0, "exhausted": 0}
+_stats_lock = threading.Lock()
+_init_lock = threading.Lock()
+
+
+def _limiters():
+    global _requests, _tokens, _concurrency
+    with _init_lock:
+        if _concurrency is None:
+            _requests = TokenBucket(RPM_LIMIT) if RPM_LIMIT else None
+            _tokens = TokenBucket(TPM_LIMIT) if TPM_LIMIT else None
+            _concurrency = AdaptiveConcurrency(INITIAL_CONCURRENCY, MAX_CONCURRENCY)
+    return _requests, _tokens, _concurrency
+
+
+def _reserve(tokens):
+    requests_bucket, tokens_bucket, _ = _limiters()
+    wait = requests_bucket.reserve(1) if requests_bucket else 0.0
+    if tokens_bucket and tokens:
+        wait = max(wait, tokens_bucket.reserve(tokens))
+    return wait
+
+
+def _refund(tokens):
+    requests_bucket, tokens_bucket, _ = _limiters()
+    if requests_bucket:
+        requests_bucket.refund(1)
+    if tokens_bucket and tokens:
+        tokens_bucket.refund(tokens)
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _pause(seconds):
+    for bucket in _limiters()[:2]:
+        if bucket:
+            bucket.pause(seconds)
+
+
+def backoff(attempt, retry_after=None):
+    """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+    delay = random.uniform(
+        0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+    )
+    return max(delay, retry_after or 0.0)
+
+
+class _Attempts:
+    """
+    Retry bookkeeping shared by call() and acall(): what to wait before each
+    attempt, when to give up, and what a throttled attempt costs.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.started = time.monotonic()
+        self.attempt = 0
+        self.delay = 0.0
+        self.error = None
+
+    def next_wait(self):
+        """Reserves the next attempt. Returns the seconds to wait, or None to give up."""
+        if self.attempt >= MAX_ATTEMPTS:
+            return None
+        # A Retry-After pause shows up in the reservation too; wait once.
+        wait = max(self.delay, _reserve(self.tokens))
+        if time.monotonic() - self.started + wait > MAX_WAIT_SECONDS:
+            # Nothing will be sent: leave the quota to the callers still waiting.
+            _refund(self.tokens)
+            return None
+        return wait
+
+    def throttled(self, error):
+        """Records a rejected attempt; its quota is returned before the retry."""
+        _count("throttled")
+        _refund(self.tokens)
+        if error.retry_after:
+            # Hold back every caller, not just this one.
+            _pause(error.retry_after)
+        self.error = error
+        self.delay = backoff(self.attempt, error.retry_after)
+        self.attempt += 1
+        logger.warning(
+            f"Model call throttled ({error}), attempt {self.attempt}/{MAX_ATTEMPTS}"
+        )
+
+    def exhausted(self):
+        _count("exhausted")
+        reason = self.error or "client-side rate limit"
+        return RetryableError(f"Model call still throttled: {reason}")
+
+
+def call(fn, tokens=0):
+    """
+    Runs fn() within the request/token buckets and the adaptive concurrency
+    limit. fn raises Throttled for 429s and timeouts; those calls are retried
+    with backoff until MAX_ATTEMPTS or MAX_WAIT_SECONDS run out, and then
+    RetryableError is raised.
+    """
+    _, _, concurrency = _limiters()
+    attempts = _Attempts(tokens)
+    while True:
+        wait = attempts.next_wait()
+        if wait is None:
+            raise attempts.exhausted() from attempts.error
+        if wait:
+            time.sleep(wait)
+
+        concurrency.acquire()
+        throttled = False
+        try:
+            _count("calls")
+            return fn()
+        except Throttled as e:
+            throttled = True
+            attempts.throttled(e)
+        finally:
+            concurrency.release(throttled)
+
+
+async def acall(fn, tokens=0):
+    """
+    Async call: awaits fn() under the same buckets and concurrency limit,
+    which are shared with threads using call().
+    """
+    _, _, concurrency = _limiters()
+    attempts = _Attempts(tokens)
+    while True:
+        wait = attempts.next_wait()
+        if wait is None:
+            raise attempts.exhausted() from attempts.error
+        if wait:
+            await asyncio.sleep(wait)
+
+        while not concurrency.try_acquire():
+            await asyncio.sleep(ACQUIRE_POLL_SECONDS)
+        throttled = False
+        try:
+            _count("calls")
+            return await fn()
+        except Throttled as e:
+            throttled = True
+            attempts.throttled(e)
+        finally:
+            concurrency.release(throttled)
+
+
+def get_stats():
+    limit = _concurrency.limit if _concurrency else float(INITIAL_CONCURRENCY)
+    with _stats_lock:
+        return dict(_stats, concurrency_limit=limit)
+
+
+def reset():
+    """Drops the limiter state (used by tests)."""
+    global _requests, _tokens, _concurrency
+    with _init_lock:
+        _requests = _tokens = _concurrency = None
+    with _stats_lock:
+        _stats.update(calls=0, throttled=0, exhausted=0)
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from common.dynamodb import get_table, AI_RESPONSE_CACHE_TABLE
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL_SECONDS = int(os.environ.get("AI_CACHE_TTL_SECONDS", 86400))
+LOCAL_CACHE_SIZE = int(os.environ.get("AI_CACHE_LOCAL_SIZE", 256))
+PERSISTENT_CACHE = os.environ.get("AI_CACHE_PERSISTENT", "true").lower() == "true"
+
+# In-process LRU tier: cache_key -> (expires_at, response). Lives as long as
+# the warm Lambda container and is shared by the worker threads.
+_local = OrderedDict()
+_lock = threading.Lock()
+_stats = {"local_hits": 0, "persistent_hits": 0, "misses": 0, "writes": 0}
+
+
+def normalize_prompt(prompt):
+    """Collapses whitespace so trivially different prompts share an entry."""
+    return " ".join(prompt.split())
+
+
+def fingerprint(value):
+    """Returns a stable sha256 hex digest for a string or JSON-able value."""
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def make_key(model, system_prompt, prompt, dataset):
+    """Content-addressed key for one model call."""
+    parts = [
+        model,
+        fingerprint(system_prompt),
+        normalize_prompt(prompt),
+        fingerprint(dataset),
+    ]
+    return fingerprint(parts)
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def _get_local(key, now):
+    with _lock:
+        entry = _local.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at <= now:
+            del _local[key]
+            return None
+        _local.move_to_end(key)
+        _stats["local_hits"] += 1
+        return response
+
+
+def _put_local(key, response, expires_at):
+    with _lock:
+        _local[key] = (expires_at, response)
+        _local.move_to_end(key)
+        while len(_local) > LOCAL_CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def get(key):
+    """Returns a cached response or None, checking the LRU tier first."""
+    now = time.time()
+    response = _get_local(key, now)
+    if response is not None:
+        return response
+
+    if PERSISTENT_CACHE:
+        try:
+            item = (
+                get_table(AI_RESPONSE_CACHE_TABLE)
+                .get_item(Key={"cache_key": key})
+                .get("Item")
+            )
+        except Exception as e:
+            logger.warning(f"Response cache read failed: {e}")
+            item = None
+        # DynamoDB deletes expired items lazily, so check the TTL ourselves.
+        if item and "response" in item and int(item.get("expires_at", 0)) > now:
+            _put_local(key, item["response"], int(item["expires_at"]))
+            _count("persistent_hits")
+            return item["response"]
+
+    _count("misses")
+    return None
+
+
+def put(key, response, model=None):
+    """Stores a response in both tiers. Persistent write errors are not fatal."""
+    expires_at = int(time.time()) + CACHE_TTL_SECONDS
+    _put_local(key, response, expires_at)
+    _count("writes")
+    if not PERSISTENT_CACHE:
+        return
+    item = {"cache_key": key, "response": response, "expires_at": expires_at}
+    if model:
+        item["model"] = model
+    try:
+        get_table(AI_RESPONSE_CACHE_TABLE).put_item(Item=item)
+    except Exception as e:
+        logger.warning(f"Response cache write failed: {e}")
+
+
+def get_stats():
+    """Returns a copy of the hit/miss counters."""
+    with _lock:
+        stats = dict(_stats)
+        stats["local_entries"] = len(_local)
+    return stats
+
+
+def clear():
+    """Empties the LRU tier and resets the counters. Intended for tests."""
+    with _lock:
+        _local.clear()
+        for name in _stats:
+            _stats[name] = 0
@@ -0,0 +1,148 @@
+import base64
+import json
+import logging
+import os
+import zlib
+from common.dynamodb import json_default
+from common.logging import span
+
+# Optional accelerators: orjson encodes several times faster than the stdlib
+# and brotli adds "br" to the negotiable encodings.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Bodies smaller than this are not worth the compression round trip.
+MIN_COMPRESS_BYTES = int(os.environ.get("RESPONSE_MIN_COMPRESS_BYTES", 1024))
+GZIP_LEVEL = int(os.environ.get("RESPONSE_GZIP_LEVEL", 5))
+JSON_TYPE = "application/json"
+NDJSON_TYPE = "application/x-ndjson"
+
+
+def header(event, name):
+    """Case-insensitive request header lookup."""
+    headers = event.get("headers") or {}
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def request_body(event):
+    """
+    Parses the JSON request body. API Gateway base64-encodes bodies once
+    binary media types are enabled, which compressed responses need.
+    """
+    body = event.get("body") or "{}"
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body)
+    return json.loads(body)
+
+
+def dumps(value, sort_keys=False):
+    """
+    Encodes value (DynamoDB items included) to compact UTF-8 JSON bytes in
+    one pass; Decimal and set values are converted by the encoder hook.
+    """
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS if sort_keys else 0
+        try:
+            return orjson.dumps(value, default=json_default, option=option)
+        except TypeError:
+            pass  # e.g. integers beyond 64 bits; the stdlib handles them
+    return json.dumps(
+        value,
+        default=json_default,
+        sort_keys=sort_keys,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    ).encode("utf-8")
+
+
+def ndjson_lines(items):
+    """Yields one encoded line per item."""
+    for item in items:
+        yield dumps(item) + b"\n"
+
+
+def accepted_encoding(event):
+    """Picks br or gzip from Accept-Encoding (honouring q=0), or None."""
+    accepted = {}
+    for part in (header(event, "Accept-Encoding") or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        if name:
+            accepted[name.lower()] = quality
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def wants_ndjson(event):
+    return NDJSON_TYPE in (header(event, "Accept") or "")
+
+
+def compress(chunks, encoding):
+    """Compresses an iterable of byte chunks incrementally."""
+    if encoding == "br":
+        compressor = brotli.Compressor()
+        out = [compressor.process(chunk) for chunk in chunks]
+        out.append(compressor.finish())
+    else:
+        # wbits 31 writes a gzip header and trailer.
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        out = [compressor.compress(chunk) for chunk in chunks]
+        out.append(compressor.flush())
+    return b"".join(out)
+
+
+def respond(event, value=None, status=200, headers=None, body=None):
+    """
+    Builds an API Gateway proxy response. Lists are sent as NDJSON when the
+    client accepts it, and bodies are compressed when Accept-Encoding allows
+    and they are large enough. A pre-encoded body (bytes) skips encoding.
+    """
+    headers = dict(headers or {})
+    encoding = accepted_encoding(event)
+    with span("serialize"):
+        if body is None and isinstance(value, list) and wants_ndjson(event):
+            headers["Content-Type"] = NDJSON_TYPE
+            chunks = ndjson_lines(value)
+            if encoding:
+                # Listings are large: compress line by line, never join twice.
+                payload = compress(chunks, encoding)
+            else:
+                payload = b"".join(chunks)
+        else:
+            headers.setdefault("Content-Type", JSON_TYPE)
+            payload = dumps(value) if body is None else body
+            if encoding and len(payload) < MIN_COMPRESS_BYTES:
+                encoding = None
+            if encoding:
+                payload = compress([payload], encoding)
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        headers["Vary"] = "Accept-Encoding"
+        return {
+            "statusCode": status,
+            "headers": headers,
+            "body": base64.b64encode(payload).decode("ascii"),
+            "isBase64Encoded": True,
+        }
+    return {"statusCode": status, "headers": headers, "body": payload.decode("utf-8")}
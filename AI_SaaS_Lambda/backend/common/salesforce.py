@@ -1,8 +1,97 @@
+import csv
+import json
+from decimal import Decimal
+import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import time
+import boto3
+from common.logging import instrument_session
 
+logger = logging.getLogger(__name__)
 
-def get_salesforce_token():
+API_VERSION = os.environ.get("SF_API_VERSION", "v58.0")
+# Queries whose first REST page reports more rows than this switch to Bulk API 2.0.
+BULK_THRESHOLD = int(os.environ.get("SF_BULK_THRESHOLD", 10000))
+BULK_POLL_SECONDS = float(os.environ.get("SF_BULK_POLL_SECONDS", 2))
+BULK_TIMEOUT_SECONDS = float(os.environ.get("SF_BULK_TIMEOUT_SECONDS", 600))
+BULK_MAX_RECORDS = int(os.environ.get("SF_BULK_MAX_RECORDS", 50000))
+# Bulk results are CSV, so numeric columns arrive as text.
+BULK_NUMERIC_FIELDS = ("AnnualRevenue", "NumberOfEmployees")
+
+HTTP_POOL_SIZE = int(os.environ.get("SF_HTTP_POOL_SIZE", 10))
+HTTP_TIMEOUT_SECONDS = float(os.environ.get("SF_HTTP_TIMEOUT_SECONDS", 30))
+# The password grant does not report an expiry, so assume the org's session
+# timeout and refresh a little before it.
+TOKEN_TTL_SECONDS = int(os.environ.get("SF_TOKEN_TTL_SECONDS", 3600))
+TOKEN_REFRESH_MARGIN_SECONDS = int(
+    os.environ.get("SF_TOKEN_REFRESH_MARGIN_SECONDS", 300)
+)
+# Optional SSM SecureString used to share the token between Lambda containers.
+TOKEN_PARAM = os.environ.get("SF_TOKEN_PARAM")
+
+CONTACTS_SOQL = "SELECT Id, Name, Email FROM Contact"
+
+# Kept at module scope so warm invocations reuse the TCP/TLS connections and
+# the access token.
+_session = None
+_session_lock = threading.Lock()
+_token = {}
+_token_lock = threading.Lock()
+_ssm = None
+
+
+def get_session():
+    """Returns the shared keep-alive requests.Session for Salesforce calls."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = instrument_session(session, "salesforce")
+    return _session
+
+
+def _get_ssm():
+    global _ssm
+    if _ssm is None:
+        _ssm = boto3.client("ssm")
+    return _ssm
+
+
+def _load_persisted_token():
+    if not TOKEN_PARAM:
+        return None
+    try:
+        param = _get_ssm().get_parameter(Name=TOKEN_PARAM, WithDecryption=True)
+        return json.loads(param["Parameter"]["Value"])
+    except Exception as e:
+        logger.warning(f"Could not load cached Salesforce token: {e}")
+        return None
+
+
+def _persist_token(token):
+    if not TOKEN_PARAM:
+        return
+    try:
+        _get_ssm().put_parameter(
+            Name=TOKEN_PARAM,
+            Value=json.dumps(token),
+            Type="SecureString",
+            Overwrite=True,
+        )
+    except Exception as e:
+        logger.warning(f"Could not persist Salesforce token: {e}")
+
+
+def _request_token():
     url = os.environ["SF_AUTH_URL"]
     data = {
         "grant_type": "password",
@@ -11,16 +100,188 @@ def get_salesforce_token():
         "username": os.environ["SF_USERNAME"],
         "password": os.environ["SF_PASSWORD"],
     }
-    resp = requests.post(url, data=data)
+    resp = get_session().post(url, data=data, timeout=HTTP_TIMEOUT_SECONDS)
     resp.raise_for_status()
-    return resp.json()["access_token"], resp.json()["instance_url"]
+    body = resp.json()
+    return {
+        "access_token": body["access_token"],
+        "instance_url": body["instance_url"],
+        "expires_at": time.time() + TOKEN_TTL_SECONDS,
+    }
 
 
-def fetch_customers():
-    token, instance_url = get_salesforce_token()
-    headers = {"Authorization": f"Bearer {token}"}
-    url = f"{instance_url}/services/data/v52.0/query"
-    params = {"q": "SELECT Id, Name, Email FROM Contact"}
-    resp = requests.get(url, headers=headers, params=params)
-    resp.raise_for_status()
-    return resp.json()["records"]
+def _is_fresh(token):
+    return (
+        bool(token) and token["expires_at"] - TOKEN_REFRESH_MARGIN_SECONDS > time.time()
+    )
+
+
+def get_salesforce_token(force_refresh=False):
+    """
+    Returns (access_token, instance_url). The token is cached in memory (and
+    optionally in SSM) and renewed shortly before it is assumed to expire.
+    """
+    global _token
+    with _token_lock:
+        if not force_refresh and not _is_fresh(_token):
+            persisted = _load_persisted_token()
+            if _is_fresh(persisted):
+                _token = persisted
+        if force_refresh or not _is_fresh(_token):
+            _token = _request_token()
+            _persist_token(_token)
+        return _token["access_token"], _token["instance_url"]
+
+
+def invalidate_token():
+    """Forgets the in-memory token so the next call logs in again."""
+    global _token
+    with _token_lock:
+        _token = {}
+
+
+def sf_request(method, path, headers=None, **kwargs):
+    """
+    Sends an authenticated request through the shared session. Paths are
+    relative to the instance URL. A 401 refreshes the token and retries once.
+    """
+    kwargs.setdefault("timeout", HTTP_TIMEOUT_SECONDS)
+    force_refresh = False
+    for attempt in range(2):
+        token, instance_url = get_salesforce_token(force_refresh=force_refresh)
+        request_headers = {"Authorization": f"Bearer {token}"}
+        request_headers.update(headers or {})
+        resp = get_session().request(
+            method, f"{instance_url}{path}", headers=request_headers, **kwargs
+        )
+        if resp.status_code == 401 and attempt == 0:
+            logger.info("Salesforce token rejected, refreshing")
+            resp.close()
+            force_refresh = True
+            continue
+        resp.raise_for_status()
+        return resp
+
+
+def iter_query_pages(soql):
+    """Yields the JSON body of each REST query page, following nextRecordsUrl."""
+    page = sf_request(
+        "GET", f"/services/data/{API_VERSION}/query", params={"q": soql}
+    ).json()
+    yield page
+    while not page.get("done", True) and page.get("nextRecordsUrl"):
+        page = sf_request("GET", page["nextRecordsUrl"]).json()
+        yield page
+
+
+def _iter_lines(resp):
+    """Yields newline-terminated text lines from a streamed response."""
+    resp.encoding = resp.encoding or "utf-8"
+    buffer = ""
+    for chunk in resp.iter_content(chunk_size=65536, decode_unicode=True):
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line + "\n"
+    if buffer:
+        yield buffer
+
+
+def _bulk_row(row):
+    """Converts a Bulk API CSV row to the shape returned by the REST API."""
+    record = {}
+    for key, value in row.items():
+        if value == "":
+            # Bulk API writes nulls as empty columns.
+            continue
+        if key in BULK_NUMERIC_FIELDS:
+            value = float(value)
+        record[key] = value
+    return record
+
+
+def iter_bulk_query(soql):
+    """Runs a Bulk API 2.0 query job and yields its CSV rows one at a time."""
+    jobs_path = f"/services/data/{API_VERSION}/jobs/query"
+    resp = sf_request("POST", jobs_path, json={"operation": "query", "query": soql})
+    job_id = resp.json()["id"]
+
+    deadline = time.time() + BULK_TIMEOUT_SECONDS
+    while True:
+        state = sf_request("GET", f"{jobs_path}/{job_id}").json()["state"]
+        if state == "JobComplete":
+            break
+        if state in ("Failed", "Aborted"):
+            raise RuntimeError(f"Salesforce bulk job {job_id} ended in state {state}")
+        if time.time() > deadline:
+            raise TimeoutError(f"Salesforce bulk job {job_id} did not complete")
+        time.sleep(BULK_POLL_SECONDS)
+
+    locator = None
+    while True:
+        params = {"maxRecords": BULK_MAX_RECORDS}
+        if locator:
+            params["locator"] = locator
+        resp = sf_request(
+            "GET",
+            f"{jobs_path}/{job_id}/results",
+            headers={"Accept": "text/csv"},
+            params=params,
+            stream=True,
+        )
+        try:
+            for row in csv.DictReader(_iter_lines(resp)):
+                yield _bulk_row(row)
+        finally:
+            resp.close()
+        locator = resp.headers.get("Sforce-Locator")
+        if not locator or locator == "null":
+            return
+
+
+def stream_records(soql, bulk=None):
+    """
+    Lazily yields every record matched by a SOQL query.
+
+    bulk=True forces a Bulk API 2.0 job, bulk=False the paginated REST API.
+    With bulk=None the REST API is tried first and the query is handed over
+    to Bulk API 2.0 when the reported totalSize exceeds SF_BULK_THRESHOLD.
+    """
+    if bulk:
+        yield from iter_bulk_query(soql)
+        return
+
+    pages = iter_query_pages(soql)
+    first = next(pages)
+    if (
+        bulk is None
+        and not first.get("done", True)
+        and first.get("totalSize", 0) > BULK_THRESHOLD
+    ):
+        pages.close()
+        yield from iter_bulk_query(soql)
+        return
+
+    yield from first.get("records", [])
+    for page in pages:
+        yield from page.get("records", [])
+
+
+def clean_record(record):
+    """
+    Converts a Salesforce record into a DynamoDB item: drops the attributes
+    metadata and null fields, and turns floats into Decimal for boto3.
+    """
+    item = {}
+    for key, value in record.items():
+        if value is None or key == "attributes":
+            continue
+        if isinstance(value, float):
+            value = Decimal(str(value))
+        item[key] = value
+    return item
+
+
+def fetch_customers(bulk=None):
+    """Returns a generator over every Salesforce Contact."""
+    return stream_records(CONTACTS_SOQL, bulk=bulk)
@@ -0,0 +1,125 @@
+import logging
+import os
+import time
+from botocore.exceptions import ClientError
+from common import query_store
+from common.dynamodb import AI_RESPONSE_CACHE_TABLE, get_table
+
+logger = logging.getLogger(__name__)
+
+# How long an owner may compute before its lease can be taken over. Keep it
+# above the worker timeout and below the queue's visibility timeout.
+LEASE_SECONDS = int(os.environ.get("AI_LEASE_SECONDS", 130))
+ACQUIRE_ATTEMPTS = 3
+
+
+class Coalesced(Exception):
+    """The query was linked to an identical query that is already running."""
+
+    def __init__(self, owner):
+        super().__init__(f"Waiting for query {owner}")
+        self.owner = owner
+
+
+def _lease_key(cache_key):
+    # Leases share the response cache table (and its TTL) under their own prefix.
+    return {"cache_key": f"lease:{cache_key}"}
+
+
+def _conditional_failed(error):
+    return error.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
+
+def acquire(cache_key, query_id):
+    """
+    Makes query_id the owner of the computation for cache_key, or links it to
+    the current owner. Returns normally for the owner and raises Coalesced
+    for a waiter. Expired leases are taken over with their waiters.
+    """
+    table = get_table(AI_RESPONSE_CACHE_TABLE)
+    for _ in range(ACQUIRE_ATTEMPTS):
+        now = int(time.time())
+        try:
+            # UpdateItem rather than PutItem keeps the waiters of a taken-over lease.
+            table.update_item(
+                Key=_lease_key(cache_key),
+                UpdateExpression="SET #o = :me, lease_expires_at = :lease, expires_at = :ttl",
+                ConditionExpression=(
+                    "attribute_not_exists(cache_key) "
+                    "OR lease_expires_at < :now OR #o = :me"
+                ),
+                ExpressionAttributeNames={"#o": "owner"},
+                ExpressionAttributeValues={
+                    ":me": query_id,
+                    ":now": now,
+                    ":lease": now + LEASE_SECONDS,
+                    ":ttl": now + LEASE_SECONDS * 2,
+                },
+            )
+            return
+        except ClientError as e:
+            if not _conditional_failed(e):
+                raise
+
+        lease = table.get_item(Key=_lease_key(cache_key), ConsistentRead=True).get(
+            "Item"
+        )
+        if lease is None:
+            continue  # released in the meantime
+        try:
+            table.update_item(
+                Key=_lease_key(cache_key),
+                UpdateExpression="ADD waiters :ids",
+                ConditionExpression="#o = :owner AND lease_expires_at >= :now",
+                ExpressionAttributeNames={"#o": "owner"},
+                ExpressionAttributeValues={
+                    ":ids": {query_id},
+                    ":owner": lease["owner"],
+                    ":now": now,
+                },
+            )
+            raise Coalesced(lease["owner"])
+        except ClientError as e:
+            if not _conditional_failed(e):
+                raise
+    # Heavy contention on one key: computing again is cheaper than waiting.
+    logger.warning(f"Could not settle the lease for {cache_key}, computing anyway")
+
+
+def release(cache_key, query_id):
+    """Drops the lease held by query_id and returns the waiting query_ids."""
+    try:
+        response = get_table(AI_RESPONSE_CACHE_TABLE).delete_item(
+            Key=_lease_key(cache_key),
+            ConditionExpression="#o = :me",
+            ExpressionAttributeNames={"#o": "owner"},
+            ExpressionAttributeValues={":me": query_id},
+            ReturnValues="ALL_OLD",
+        )
+    except ClientError as e:
+        if not _conditional_failed(e):
+            raise
+        # Our lease expired and was taken over; the new owner resolves waiters.
+        return []
+    return sorted(response.get("Attributes", {}).get("waiters", []))
+
+
+def resolve_waiters(waiters, result):
+    """
+    Copies the owner's final status onto each waiting query and returns the
+    updated items.
+    """
+    values = {k: v for k, v in result.items() if k in ("status", "response", "error")}
+    values["coalesced_with"] = result["query_id"]
+    if waiters:
+        # Encoded once: every waiter references the owner's offloaded payload.
+        values = query_store.encode(result["query_id"], values)
+    resolved = []
+    for query_id in waiters:
+        try:
+            item = query_store.update(query_id, values, return_values="ALL_NEW")
+            resolved.append(item)
+        except Exception as e:
+            # Its redelivered message will pick the answer up from the cache.
+            logger.error(f"Could not resolve coalesced query {query_id}: {e}")
+    return resolved
@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+import boto3
+from common.dynamodb import MOCK_AWS, MOCK_ENDPOINT_URL
+
+logger = logging.getLogger(__name__)
+
+# SendMessageBatch accepts at most 10 entries per call.
+SEND_BATCH_SIZE = 10
+SEND_MAX_ATTEMPTS = int(os.environ.get("SQS_SEND_MAX_ATTEMPTS", 3))
+
+# Kept at module scope so warm invocations reuse the client, its connection
+# pool and the resolved queue URLs.
+_client = None
+_queue_urls = {}
+_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the shared SQS client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                if MOCK_AWS:
+                    _client = boto3.client(
+                        "sqs",
+                        region_name="us-east-1",
+                        endpoint_url=MOCK_ENDPOINT_URL,
+                        aws_access_key_id="test",
+                        aws_secret_access_key="test",
+                    )
+                else:
+                    _client = boto3.client("sqs")
+    return _client
+
+
+def get_queue_url(queue):
+    """
+    Resolves a queue name or URL once per container. In MOCK_AWS mode the
+    queue is created on first use.
+    """
+    url = _queue_urls.get(queue)
+    if url is not None:
+        return url
+
+    client = get_client()
+    with _lock:
+        url = _queue_urls.get(queue)
+        if url is None:
+            if MOCK_AWS:
+                name = queue.rstrip("/").rsplit("/", 1)[-1]
+                url = client.create_queue(QueueName=name)["QueueUrl"]
+                print(f"Que created {url}")
+            elif queue.startswith("https://"):
+                url = queue
+            else:
+                url = client.get_queue_url(QueueName=queue)["QueueUrl"]
+            _queue_urls[queue] = url
+    return url
+
+
+def send_message(queue, body):
+    """Sends one message body and returns its MessageId."""
+    response = get_client().send_message(
+        QueueUrl=get_queue_url(queue), MessageBody=body
+    )
+    return response["MessageId"]
+
+
+def send_messages(queue, bodies):
+    """
+    Sends message bodies with SendMessageBatch, ten per call. Entries that
+    fail on the service side are retried; sender faults are not. Returns the
+    indexes (into bodies) of the messages that could not be sent.
+    """
+    url = get_queue_url(queue)
+    failed = []
+    for start in range(0, len(bodies), SEND_BATCH_SIZE):
+        pending = {
+            str(index): bodies[index]
+            for index in range(start, min(start + SEND_BATCH_SIZE, len(bodies)))
+        }
+        for attempt in range(SEND_MAX_ATTEMPTS):
+            response = get_client().send_message_batch(
+                QueueUrl=url,
+                Entries=[
+                    {"Id": entry_id, "MessageBody": body}
+                    for entry_id, body in pending.items()
+                ],
+            )
+            retry = {}
+            for entry in response.get("Failed", []):
+                logger.warning(
+                    f"SQS rejected message {entry['Id']}: {entry.get('Message')}"
+                )
+                if entry.get("SenderFault") or attempt == SEND_MAX_ATTEMPTS - 1:
+                    failed.append(int(entry["Id"]))
+                else:
+                    retry[entry["Id"]] = pending[entry["Id"]]
+            if not retry:
+                break
+            pending = retry
+    return sorted(failed)
+
+
+def reset():
+    """Drops the cached client and queue URLs. Intended for tests."""
+    global _client
+    with _lock:
+        _client = None
+        _queue_urls.clear()
@@ -1,15 +1,110 @@
 import os
 import json
-from common.dynamodb import scan_table
+from common.dynamodb import (
+    decode_cursor,
+    encode_cursor,
+    parallel_scan,
+    scan_page,
+)
+from common import customer_queries, listing_cache
 from common.auth import check_api_key
-from common.logging import setup_logger
+from common.logging import instrument_handler, setup_logger
+from common.responses import header, respond
 
 logger = setup_logger()
 TABLE = os.environ["CUSTOMERS_TABLE"]
+DEFAULT_PAGE_SIZE = int(os.environ.get("CUSTOMERS_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("CUSTOMERS_MAX_PAGE_SIZE", 1000))
+# Number of Segment/TotalSegments workers used for full exports.
+SCAN_SEGMENTS = int(os.environ.get("CUSTOMERS_SCAN_SEGMENTS", 4))
 
 
+def list_customers(params):
+    """
+    Computes one listing for the query parameters. Returns (items, headers);
+    raises ValueError for invalid parameters.
+    """
+    fields = [f.strip() for f in params.get("fields", "").split(",") if f.strip()]
+    filters = customer_queries.parse_filters(params)
+
+    if params.get("export", "").lower() == "true":
+        if filters:
+            items, query_plan = customer_queries.find_all(
+                filters, attributes=fields, total_segments=SCAN_SEGMENTS
+            )
+            plan_name = customer_queries.describe(query_plan)
+            logger.info(f"Exported {len(items)} filtered customers via {plan_name}")
+            return items, {"X-Query-Plan": plan_name}
+        items = parallel_scan(TABLE, SCAN_SEGMENTS, attributes=fields)
+        logger.info(f"Exported {len(items)} customers in {SCAN_SEGMENTS} segments")
+        return items, {}
+
+    limit = int(params.get("limit") or DEFAULT_PAGE_SIZE)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    start_key = (
+        decode_cursor(params["next_token"]) if params.get("next_token") else None
+    )
+
+    headers = {}
+    if filters:
+        items, last_key, query_plan = customer_queries.find_page(
+            filters, min(limit, MAX_PAGE_SIZE), start_key=start_key, attributes=fields
+        )
+        headers["X-Query-Plan"] = customer_queries.describe(query_plan)
+    else:
+        items, last_key = scan_page(
+            TABLE,
+            limit=min(limit, MAX_PAGE_SIZE),
+            start_key=start_key,
+            attributes=fields,
+        )
+    if last_key:
+        headers["X-Next-Token"] = encode_cursor(last_key)
+    return items, headers
+
+
+@instrument_handler
 def lambda_handler(event, context):
+    """
+    Lists customers one page at a time.
+
+    Query parameters:
+      limit      - page size (default CUSTOMERS_PAGE_SIZE, capped at MAX_PAGE_SIZE)
+      next_token - continuation token from the previous page's X-Next-Token header
+      fields     - comma separated attribute names to return
+      export     - "true" returns the whole table using a parallel segment scan
+      industry, type, min_revenue, max_revenue
+                 - filters; industry/type with a revenue bound are served
+                   from the Industry/Type indexes (X-Query-Plan names the
+                   index, or "scan")
+
+    Send "Accept: application/x-ndjson" for one customer per line, and
+    Accept-Encoding for a gzip (or br) compressed body.
+
+    Listings are cached per Customers version (bumped by the Salesforce
+    writers; other writers must call listing_cache.bump_version()) and
+    carry an ETag; a matching If-None-Match gets a 304 without
+    reading the table.
+    """
     if not check_api_key(event):
         return {"statusCode": 403, "body": "Forbidden"}
-    items = scan_table(TABLE)
-    return {"statusCode": 200, "body": json.dumps(items)}
+
+    params = event.get("queryStringParameters") or {}
+    version = listing_cache.current_version()
+    tag = listing_cache.etag(version, params)
+    if header(event, "If-None-Match") == tag:
+        return {"statusCode": 304, "headers": {"ETag": tag}, "body": ""}
+
+    cached = listing_cache.get(version, params)
+    if cached is not None:
+        headers = dict(cached["headers"])
+        headers.update({"ETag": tag, "X-Cache": "hit"})
+        return respond(event, cached["items"], headers=headers)
+
+    try:
+        items, headers = list_customers(params)
+    except ValueError as e:
+        return {"statusCode": 400, "body": json.dumps({"error": str(e)})}
+    listing_cache.put(version, params, items, headers)
+    return respond(event, items, headers=dict(headers, ETag=tag))
@@ -1,96 +1,181 @@
 import os
 import json
-import boto3
-from datetime import datetime, timedelta, timezone
-import requests
-from urllib.parse import urlencode
 
 # Assuming these common functions exist and are accessible
-from common.salesforce import get_salesforce_token
-from common.dynamodb import get_dynamodb_table
-
-# Name for the SSM parameter that stores the last poll timestamp
-SSM_PARAM_NAME = os.environ.get(
-    "LAST_POLL_TIMESTAMP_PARAM", "/AISAAS/LastSalesforcePollTime"
+from common import aio, content_hash
+from common.aio import aws
+from common.aio import dynamodb as aio_dynamodb
+from common.salesforce import clean_record
+from common.dynamodb import batch_get_items, batch_write_items
+from common.listing_cache import bump_version
+from common.logging import instrument_handler
+from common.dataset_snapshot import SNAPSHOT_FIELDS, rebuild_snapshot, update_snapshot
+from common.change_capture import (
+    CheckpointConflict,
+    advance,
+    iter_changes,
+    load_checkpoint,
+    save_checkpoint,
 )
-CUSTOMERS_TABLE_NAME = os.environ.get("CUSTOMERS_TABLE", "Customers")
 
-ssm = boto3.client("ssm")
+CUSTOMERS_TABLE_NAME = os.environ.get("CUSTOMERS_TABLE", "Customers")
+SOBJECT = "Account"
+FIELDS = ["Name", "Type", "Industry", "AnnualRevenue"]
+CHUNK_SIZE = int(os.environ.get("SF_POLL_CHUNK_SIZE", 100))
+# BatchWriteItem calls of one chunk in flight at once.
+WRITE_CONCURRENCY = int(os.environ.get("SF_POLL_WRITE_CONCURRENCY", 4))
+# Stop taking new chunks when less than this much of the Lambda timeout is left.
+TIME_RESERVE_MS = int(os.environ.get("SF_POLL_TIME_RESERVE_MS", 15000))
+# Larger change sets rebuild the AI dataset snapshot instead of patching it.
+SNAPSHOT_INCREMENTAL_LIMIT = int(os.environ.get("SNAPSHOT_INCREMENTAL_LIMIT", 5000))
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _previous_items(items):
+    """
+    Reads the stored version of each item: its content hash tells whether
+    it changed, and its fields let the snapshot be patched.
+    """
+    keys = [{"Id": item["Id"]} for item in items]
+    attributes = SNAPSHOT_FIELDS + (content_hash.HASH_ATTRIBUTE,)
+    stored = batch_get_items(CUSTOMERS_TABLE_NAME, keys, attributes=attributes)
+    return {item["Id"]: item for item in stored}
 
 
-def get_last_poll_time():
-    """Gets the last poll timestamp from SSM Parameter Store."""
+def _changed_items(chunk, previous, counts):
+    """
+    Returns the items whose content hash differs from the stored one and
+    tallies them. SystemModstamp also moves for edits to fields we do not
+    store, so many polled records turn out unchanged.
+    """
+    name = content_hash.HASH_ATTRIBUTE
+    changed = []
+    for item in chunk:
+        stored = previous.get(item["Id"])
+        if stored is None:
+            counts["inserted"] += 1
+        elif stored.get(name) != item[name]:
+            counts["updated"] += 1
+        else:
+            counts["unchanged"] += 1
+            continue
+        changed.append(item)
+    return changed
+
+
+def write_chunk(chunk):
+    """
+    Writes a chunk with concurrent 25-item BatchWriteItem calls. Raises when
+    any item was not written, so the chunk is never checkpointed.
+    """
+    if aws.NATIVE:
+        counts = aio.run(
+            aio_dynamodb.batch_write_items(
+                CUSTOMERS_TABLE_NAME, chunk, concurrency=WRITE_CONCURRENCY
+            )
+        )
+    else:
+        # The async helper would only run this on the loop's executor.
+        counts = batch_write_items(
+            CUSTOMERS_TABLE_NAME, chunk, max_workers=WRITE_CONCURRENCY
+        )
+    if counts["failed"]:
+        raise RuntimeError(f"{counts['failed']} of {len(chunk)} records not written")
+
+
+def refresh_snapshot(changes):
+    """Brings the AI dataset snapshot up to date. Failures only log a warning."""
     try:
-        param = ssm.get_parameter(Name=SSM_PARAM_NAME, WithDecryption=False)
-        return param["Parameter"]["Value"]
-    except ssm.exceptions.ParameterNotFound:
-        # If parameter is not found, default to 1 day ago and create it
-        print(f"SSM Parameter {SSM_PARAM_NAME} not found. Defaulting to 1 day ago.")
-        one_day_ago = (datetime.now(timezone.utc) - timedelta(days=1)).isoformat()
-        update_last_poll_time(one_day_ago)
-        return one_day_ago
+        if changes is None:
+            rebuild_snapshot()
+        else:
+            update_snapshot(changes)
+    except Exception as e:
+        print(f"Could not refresh the customer snapshot: {e}")
 
 
-def update_last_poll_time(timestamp_str):
-    """Updates the last poll timestamp in SSM Parameter Store."""
-    print(f"Updating last poll time in SSM to: {timestamp_str}")
-    ssm.put_parameter(
-        Name=SSM_PARAM_NAME, Value=timestamp_str, Type="String", Overwrite=True
-    )
+def _out_of_time(context):
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return False
+    return context.get_remaining_time_in_millis() < TIME_RESERVE_MS
 
 
+@instrument_handler
 def lambda_handler(event, context):
     """
     This function polls Salesforce for recently updated customer records
     and syncs them to DynamoDB. It's triggered by a schedule.
+
+    Changes are read in SystemModstamp/Id order and committed in chunks.
+    After each chunk the checkpoint (the last modstamp seen and the Ids
+    already processed at it) is stored in DynamoDB, so a run that times out
+    resumes from its last committed chunk.
     """
     print("Starting Salesforce poll...")
-    current_time = datetime.now(timezone.utc)
-    last_poll_time = get_last_poll_time()
+    checkpoint = load_checkpoint(SOBJECT)
+    print(f"Querying Salesforce for records changed since: {checkpoint['modstamp']}")
 
+    count = 0
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    changes = []
+    complete = True
     try:
-        token, instance_url = get_salesforce_token()
-
-        # SOQL query for recently modified accounts. Format is YYYY-MM-DDThh:mm:ssZ
-        soql_query = f"SELECT Id, Name, Type, Industry, AnnualRevenue FROM Account WHERE LastModifiedDate > {last_poll_time}"
-
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        }
-        query_params = urlencode({"q": soql_query})
-        sf_url = f"{instance_url}/services/data/v58.0/query/?{query_params}"
-
-        print(f"Querying Salesforce for records modified after: {last_poll_time}")
-        resp = requests.get(sf_url, headers=headers)
-        resp.raise_for_status()
-
-        records = resp.json().get("records", [])
-        print(f"Found {len(records)} records to update.")
-
-        if records:
-            customers_table = get_dynamodb_table(CUSTOMERS_TABLE_NAME)
-            with customers_table.batch_writer() as batch:
-                for record in records:
-                    item = {
-                        k: v
-                        for k, v in record.items()
-                        if v is not None and k != "attributes"
-                    }
-                    batch.put_item(Item=item)
-            print(f"Successfully synced {len(records)} records to DynamoDB.")
-
-        # On success (even if no records), update the poll time for the next run
-        update_last_poll_time(current_time.isoformat())
-
-        return {
-            "statusCode": 200,
-            "body": json.dumps(
-                {"message": f"Successfully synced {len(records)} records."}
-            ),
-        }
-
+        # Records are streamed page by page (or from a Bulk API 2.0 job for large
+        # change sets), so memory use stays flat.
+        records = iter_changes(SOBJECT, FIELDS, checkpoint)
+        items = (clean_record(record) for record in records)
+        for chunk in _chunks(items, CHUNK_SIZE):
+            chunk = [content_hash.with_hash(item) for item in chunk]
+            previous = _previous_items(chunk)
+            changed = _changed_items(chunk, previous, counts)
+            if changed:
+                write_chunk(changed)
+                # Before the checkpoint: a failed bump makes the next run redo it.
+                bump_version()
+                if changes is not None:
+                    if len(changes) + len(changed) > SNAPSHOT_INCREMENTAL_LIMIT:
+                        changes = None
+                    else:
+                        changes.extend((previous.get(i["Id"]), i) for i in changed)
+            checkpoint = save_checkpoint(SOBJECT, advance(checkpoint, chunk))
+            count += len(chunk)
+            if _out_of_time(context):
+                print("Approaching the Lambda timeout, stopping at the checkpoint.")
+                complete = False
+                break
+    except CheckpointConflict as e:
+        # Another poll run is active; it owns the window from here on.
+        print(f"Stopping: {e}")
+        complete = False
     except Exception as e:
         print(f"An error occurred: {e}")
-        # Do not update poll time on failure, so the next run retries from the same point
+        # Committed chunks are checkpointed, so the next run resumes after them.
+        if counts["inserted"] or counts["updated"]:
+            refresh_snapshot(changes)
         raise e
+
+    print(f"Successfully synced {count} records to DynamoDB: {counts}")
+    if counts["inserted"] or counts["updated"]:
+        refresh_snapshot(changes)
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "message": f"Successfully synced {count} records.",
+                "complete": complete,
+                "checkpoint": checkpoint["modstamp"],
+                **counts,
+            }
+        ),
+    }
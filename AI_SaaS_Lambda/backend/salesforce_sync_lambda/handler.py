@@ -1,17 +1,26 @@
 import os
 import json
-from common.salesforce import fetch_customers
-from common.dynamodb import put_item
+from common.salesforce import clean_record, fetch_customers
+from common import content_hash
+from common.dataset_snapshot import rebuild_snapshot
+from common.listing_cache import bump_version
 from common.auth import is_admin
-from common.logging import setup_logger
+from common.logging import instrument_handler, setup_logger
+from common.responses import request_body
 
 logger = setup_logger()
+# Number of changed customers written concurrently.
+WRITE_WORKERS = int(os.environ.get("SF_SYNC_WRITE_WORKERS", 4))
 
 
+@instrument_handler
 def lambda_handler(event, context):
     """
     Handles manual Salesforce sync requests.
     Only allows access to users with the 'admins' role.
+
+    Only new and changed customers are written: each record's content hash
+    is compared with an index of the stored hashes, loaded once per sync.
     """
     if not is_admin(event):
         return {
@@ -22,16 +31,42 @@ def lambda_handler(event, context):
         }
 
     try:
-        customers = fetch_customers()
+        body = request_body(event)
+        # Admins can force Bulk API 2.0 for initial loads; otherwise it is chosen
+        # automatically from the size of the result set.
+        bulk = True if body.get("bulk") else None
         table_name = os.environ["CUSTOMERS_TABLE"]
-        for customer in customers:
-            put_item(table_name, customer)
+        index = content_hash.load_index(table_name)
+        customers = (clean_record(c) for c in fetch_customers(bulk=bulk))
+        counts = None
+        try:
+            counts = content_hash.sync_items(
+                table_name, customers, index, max_workers=WRITE_WORKERS
+            )
+        finally:
+            # Even a failed sync may have written some customers; a sync that
+            # changed nothing leaves cached listings valid.
+            if counts is None or counts["inserted"] or counts["updated"]:
+                bump_version()
 
-        logger.info(f"Synced {len(customers)} customers from Salesforce.")
+        logger.info(f"Synced customers from Salesforce: {counts}")
+        if counts["failed"]:
+            logger.error(f"{counts['failed']} customers could not be written.")
+        written = counts["inserted"] + counts["updated"]
+        if written:
+            try:
+                rebuild_snapshot()
+            except Exception as e:
+                logger.warning(f"Could not rebuild the customer snapshot: {e}")
         return {
             "statusCode": 200,
             "body": json.dumps(
-                {"message": f"Successfully synced {len(customers)} customers."}
+                {
+                    "message": f"Successfully synced {written} customers.",
+                    "written": written,
+                    "retried": counts["retried"],
+                    **counts,
+                }
             ),
         }
     except Exception as e:
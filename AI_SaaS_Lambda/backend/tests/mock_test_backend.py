@@ -14,8 +14,6 @@ os.environ["AWS_DEFAULT_REGION"] = "us-east-1"  # Mock region
 os.environ["AI_QUERIES_TABLE"] = "AIQueries"
 os.environ["CUSTOMERS_TABLE"] = "Customers"
 os.environ["AI_SQS_QUEUE"] = "ai-query-queue"  # Mock queue name
-# Required for Salesforce polling lambda
-os.environ["LAST_POLL_TIMESTAMP_PARAM"] = "/AISAAS/LastSalesforcePollTime"
 # Mock secrets and credentials
 os.environ["OPENAI_API_KEY"] = "MOCK_OPENAI_KEY"  # No need for a real key in mock tests
 os.environ["SF_CLIENT_ID"] = "MOCK_SF_ID"
@@ -23,6 +21,8 @@ os.environ["SF_CLIENT_SECRET"] = "MOCK_SF_SECRET"
 os.environ["SF_USERNAME"] = "MOCK_SF_USER"
 os.environ["SF_PASSWORD"] = "MOCK_SF_PASS"
 os.environ["SF_AUTH_URL"] = "http://salesforce.mock/token"
+# Keep EMF records out of the test output; test_instrumentation turns them on.
+os.environ["METRICS_ENABLED"] = "false"
 
 
 # --- Mock JWTs for RBAC Testing ---
@@ -32,14 +32,50 @@ MOCK_USER_TOKEN = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJzdWIiOiI5ODc2NTQzMjEi
 
 
 import json
-from unittest.mock import patch, MagicMock
+import uuid
+import jwt
+from unittest.mock import AsyncMock, patch, MagicMock
 
 # from datetime import datetime, timezone
 import boto3
 
 # --- Imports from our application ---
+from common import logging as instrumentation
 from common.logging import setup_logger
-from common.dynamodb import get_item, put_item
+from common import (
+    auth,
+    change_capture,
+    content_hash,
+    customer_queries,
+    listing_cache,
+    dataset_snapshot,
+    notify,
+    openai_agent,
+    object_store,
+    prompt_budget,
+    query_store,
+    rate_limit,
+    response_cache,
+    responses,
+    single_flight,
+    sqs,
+)
+from common.openai_agent import process_query
+from common.salesforce import (
+    get_salesforce_token,
+    invalidate_token,
+    sf_request,
+    stream_records,
+)
+from common.dynamodb import (
+    batch_write_items,
+    get_item,
+    get_table,
+    put_item,
+    reset_registry,
+    update_item,
+)
+from ai_agent_lambda import handler as ai_agent_module
 from ai_agent_lambda.handler import lambda_handler as ai_agent_handler
 from ai_worker_lambda.handler import lambda_handler as ai_worker_handler
 from ai_query_status_lambda.handler import lambda_handler as ai_query_status_handler
@@ -47,7 +83,6 @@ from customers_lambda.handler import lambda_handler as customers_handler
 from salesforce_sync_lambda.handler import lambda_handler as salesforce_sync_handler
 from salesforce_poll_lambda.handler import lambda_handler as salesforce_poll_handler
 
-
 logger = setup_logger()
 
 
@@ -117,8 +152,9 @@ def test_ai_flow(mock_openai_create):
     # 3. Simulate AI Worker processing SQS
     logger.info("2. Simulating AI Worker processing (with OpenAI call mocked)")
     mock_sqs_message_body = json.dumps({"query_id": query_id, "prompt": "Hello, AI!"})
-    event = {"Records": [{"body": mock_sqs_message_body}]}
-    ai_worker_handler(event, None)
+    event = {"Records": [{"messageId": "msg-1", "body": mock_sqs_message_body}]}
+    worker_response = ai_worker_handler(event, None)
+    assert worker_response == {"batchItemFailures": []}
     print("AI Worker processed the message.")
 
     # 4. Check AI query status
@@ -133,6 +169,564 @@ def test_ai_flow(mock_openai_create):
     assert body["response"] == "This is a mock AI response."
 
 
+def test_ai_batch_submit_flow():
+    """Tests batched submission: one BatchWriteItem and SendMessageBatch calls."""
+    print("\n--- Testing AI Batch Submission ---")
+
+    prompts = [f"Batch prompt {i}" for i in range(12)]
+    event = {"resource": "/ai/query/batch", "body": json.dumps({"prompts": prompts})}
+    client = sqs.get_client()
+    with patch.object(
+        client, "send_message_batch", wraps=client.send_message_batch
+    ) as mock_send_batch:
+        response = ai_agent_handler(event, None)
+    assert response["statusCode"] == 202
+    body = json.loads(response["body"])
+    assert len(body["query_ids"]) == len(prompts)
+    assert {q["status"] for q in body["queries"]} == {"QUEUED"}
+    # 12 messages need two SendMessageBatch calls of at most 10 entries.
+    assert mock_send_batch.call_count == 2
+
+    for query_id, prompt in zip(body["query_ids"], prompts):
+        item = get_item("AIQueries", {"query_id": query_id})
+        assert item["status"] == "QUEUED" and item["prompt"] == prompt
+
+    # The client and the queue URL are resolved once and reused.
+    assert sqs.get_client() is client
+    with patch.object(client, "create_queue") as mock_create_queue:
+        ai_agent_handler({"body": json.dumps({"prompt": "One more"})}, None)
+    mock_create_queue.assert_not_called()
+
+    too_many = {"prompts": ["x"] * (ai_agent_module.MAX_BATCH_PROMPTS + 1)}
+    event = {"resource": "/ai/query/batch", "body": json.dumps(too_many)}
+    assert ai_agent_handler(event, None)["statusCode"] == 400
+    event = {"resource": "/ai/query/batch", "body": json.dumps({"prompts": []})}
+    assert ai_agent_handler(event, None)["statusCode"] == 400
+    print("Batch submission verified.")
+
+
+def test_ai_status_delivery():
+    """Tests ETag/304, long-poll, batch status lookup and webhook callbacks."""
+    print("\n--- Testing AI Status Delivery ---")
+    import threading
+    import time
+
+    query_id = str(uuid.uuid4())
+    put_item("AIQueries", {"query_id": query_id, "prompt": "p", "status": "QUEUED"})
+
+    logger.info("1. Unchanged items answer 304 Not Modified")
+    event = {"pathParameters": {"id": query_id}}
+    first = ai_query_status_handler(event, None)
+    etag = first["headers"]["ETag"]
+    event["headers"] = {"If-None-Match": etag}
+    assert ai_query_status_handler(event, None)["statusCode"] == 304
+
+    logger.info("2. A long-poll returns as soon as the query completes")
+
+    def complete():
+        time.sleep(0.3)
+        put_item(
+            "AIQueries",
+            {
+                "query_id": query_id,
+                "prompt": "p",
+                "status": "COMPLETED",
+                "response": "r",
+            },
+        )
+
+    writer = threading.Thread(target=complete)
+    writer.start()
+    event["queryStringParameters"] = {"wait": "5"}
+    started = time.time()
+    with patch("ai_query_status_lambda.handler.POLL_INTERVAL_SECONDS", 0.05):
+        response = ai_query_status_handler(event, None)
+    writer.join()
+    assert response["statusCode"] == 200
+    assert json.loads(response["body"])["status"] == "COMPLETED"
+    assert time.time() - started < 3
+
+    logger.info("3. Many statuses are fetched with one BatchGetItem")
+    event = {
+        "httpMethod": "POST",
+        "resource": "/ai/query/status",
+        "body": json.dumps({"query_ids": [query_id, "missing-id"]}),
+    }
+    body = json.loads(ai_query_status_handler(event, None)["body"])
+    assert [q["query_id"] for q in body["queries"]] == [query_id]
+    assert body["missing"] == ["missing-id"]
+    not_an_object = dict(event, body="[1]")
+    assert ai_query_status_handler(not_an_object, None)["statusCode"] == 400
+
+    logger.info("4. Finished queries with a callback_url are pushed to it")
+    event = {
+        "body": json.dumps(
+            {"prompt": "Notify me", "callback_url": "http://callback.mock/hook"}
+        )
+    }
+    assert ai_agent_handler(event, None)["statusCode"] == 202
+    bad = {"body": json.dumps({"prompt": "x", "callback_url": "ftp://nope"})}
+    assert ai_agent_handler(bad, None)["statusCode"] == 400
+
+    message = {
+        "query_id": str(uuid.uuid4()),
+        "prompt": "Notify me",
+        "callback_url": "http://callback.mock/hook",
+    }
+    session = MagicMock()
+    with patch(
+        "ai_worker_lambda.handler.process_query", return_value="done"
+    ), patch.object(notify, "_get_session", return_value=session), patch.object(
+        notify, "WEBHOOK_SECRET", "hook-secret"
+    ):
+        ai_worker_handler(
+            {"Records": [{"messageId": "m1", "body": json.dumps(message)}]}, None
+        )
+    session.post.assert_called_once()
+    args, kwargs = session.post.call_args
+    assert args[0] == "http://callback.mock/hook"
+    sent = json.loads(kwargs["data"])
+    assert sent["status"] == "COMPLETED" and "callback_url" not in sent
+    assert kwargs["headers"]["X-Signature"].startswith("sha256=")
+
+    logger.info("5. Callbacks to internal addresses are refused")
+    import socket
+    from common import aio
+    from common.aio import notify as aio_notify
+
+    internal = [
+        "https://127.0.0.1/hook",
+        "https://localhost/hook",
+        "https://169.254.169.254/latest",
+        "https://10.0.0.8/hook",
+        "https://[::1]/hook",
+        "https://[::ffff:192.168.0.1]/hook",
+        "http://example.com/hook",
+    ]
+    public = [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("93.184.216.34", 443))]
+    with patch.object(notify, "MOCK_AWS", False):
+        assert not any(notify.is_valid_callback_url(url) for url in internal)
+        with patch("common.notify.socket.getaddrinfo", return_value=public):
+            assert notify.is_valid_callback_url("https://example.com/hook")
+        item = dict(message, status="COMPLETED", callback_url=internal[0])
+        session = MagicMock()
+        with patch.object(notify, "_get_session", return_value=session):
+            assert notify.notify_completed([item]) == 0
+        with patch("common.aio.http.get_session") as mock_session:
+            assert aio.run(aio_notify.notify_completed([item])) == 0
+        session.post.assert_not_called()
+        mock_session.assert_not_called()
+    print("Status delivery verified.")
+
+
+@patch("common.openai_agent.openai.ChatCompletion.create")
+def test_ai_streaming_flow(mock_openai_create):
+    """Tests that streamed answers are flushed to the item while they arrive."""
+    print("\n--- Testing AI Streaming Flow ---")
+
+    query_id = str(uuid.uuid4())
+    put_item("AIQueries", {"query_id": query_id, "prompt": "p", "status": "QUEUED"})
+    words = [f"word{i} " for i in range(40)]
+    seen = []
+
+    def stream(**kwargs):
+        assert kwargs["stream"] is True
+        for index, word in enumerate(words):
+            if index == 30:
+                # What a client polling mid-stream would get back.
+                status = ai_query_status_handler(
+                    {"pathParameters": {"id": query_id}}, None
+                )
+                seen.append(json.loads(status["body"]))
+            yield {"choices": [{"delta": {"content": word}}]}
+
+    mock_openai_create.side_effect = stream
+    message = {"query_id": query_id, "prompt": f"Stream {query_id}", "stream": True}
+    event = {"Records": [{"messageId": "m1", "body": json.dumps(message)}]}
+    with patch("ai_worker_lambda.handler.STREAM_FLUSH_SECONDS", 0), patch(
+        "ai_worker_lambda.handler.STREAM_FLUSH_MIN_CHARS", 50
+    ), patch.object(query_store, "update", wraps=query_store.update) as mock_update:
+        assert ai_worker_handler(event, None) == {"batchItemFailures": []}
+
+    # About 7 characters per word: a flush every 50 characters, not per token.
+    flushes = [
+        c for c in mock_update.call_args_list if c[0][1]["status"] == "STREAMING"
+    ]
+    assert 3 <= len(flushes) <= 6
+    assert seen[0]["status"] == "STREAMING"
+    assert "".join(words).startswith(seen[0]["response"])
+    assert seen[0]["progress"]["tokens"] > 0
+
+    item = get_item("AIQueries", {"query_id": query_id})
+    assert item["status"] == "COMPLETED"
+    assert item["response"] == "".join(words)
+    assert "progress" not in item
+    print("Streaming flow verified.")
+
+
+@patch("common.openai_agent.openai.ChatCompletion.create")
+def test_prompt_budget_map_reduce(mock_openai_create):
+    """Tests budgeted prompts and map-reduce over datasets that do not fit."""
+    print("\n--- Testing Prompt Budget and Map-Reduce ---")
+
+    def reply(**kwargs):
+        system, user = (
+            kwargs["messages"][0]["content"],
+            kwargs["messages"][1]["content"],
+        )
+        if system == openai_agent.MAP_SYSTEM_PROMPT:
+            assert kwargs["max_tokens"] == openai_agent.MAP_RESPONSE_TOKENS
+            return {"choices": [{"message": {"content": f"finding ({len(user)})"}}]}
+        return {"choices": [{"message": {"content": "merged answer"}}]}
+
+    mock_openai_create.side_effect = reply
+    rows = "\n".join(f'{{"Id":"C{i:05d}","Name":"Customer {i}"}}' for i in range(1500))
+
+    logger.info("1. Chunks respect the token budget and keep rows whole")
+    chunks = prompt_budget.split_dataset(rows, 500)
+    assert all(prompt_budget.count_tokens(chunk) <= 500 for chunk in chunks)
+    assert "\n".join(chunks) == rows
+    long_row = prompt_budget.split_dataset("x" * 5000, 100)
+    assert all(prompt_budget.count_tokens(chunk) <= 100 for chunk in long_row)
+
+    logger.info("2. A small dataset is answered with one call")
+    assert openai_agent.answer("Q?", "Customers: 3") == "merged answer"
+    assert mock_openai_create.call_count == 1
+
+    logger.info("3. A large dataset is mapped over parts and merged once")
+    mock_openai_create.reset_mock()
+    assert openai_agent.answer("Q?", rows) == "merged answer"
+    systems = [
+        c[1]["messages"][0]["content"] for c in mock_openai_create.call_args_list
+    ]
+    maps = systems.count(openai_agent.MAP_SYSTEM_PROMPT)
+    assert 1 < maps <= openai_agent.MAX_MAP_CHUNKS
+    assert systems[-1] == openai_agent.REDUCE_SYSTEM_PROMPT
+    assert len(systems) == maps + 1
+    for call in mock_openai_create.call_args_list:
+        messages = call[1]["messages"]
+        tokens = sum(prompt_budget.count_tokens(m["content"]) for m in messages)
+        assert tokens <= prompt_budget.CONTEXT_TOKENS
+
+    logger.info("4. A prompt that fills the context is rejected before any call")
+    mock_openai_create.reset_mock()
+    try:
+        openai_agent.answer("Why? " * 4000, rows)
+        assert False, "an over-long prompt must be rejected"
+    except prompt_budget.PromptTooLong:
+        pass
+    mock_openai_create.assert_not_called()
+    print("Prompt budgeting verified.")
+
+
+@patch("ai_worker_lambda.handler.process_query")
+def test_query_storage(mock_process_query):
+    """Tests partial updates, compressed and offloaded payloads, and TTLs."""
+    print("\n--- Testing AI Query Storage ---")
+    import tempfile
+    import time
+    from boto3.dynamodb.types import Binary
+
+    object_store.set_store(object_store.LocalStore(tempfile.mkdtemp()))
+    query_store.clear_cache()
+
+    def run(answer):
+        submitted = ai_agent_handler({"body": json.dumps({"prompt": "Report"})}, None)
+        query_id = json.loads(submitted["body"])["query_id"]
+        mock_process_query.return_value = answer
+        # The worker's final write must not touch the submitted prompt.
+        message = {"query_id": query_id, "prompt": "Report", "no_cache": True}
+        event = {"Records": [{"messageId": "m1", "body": json.dumps(message)}]}
+        with patch.object(query_store, "update_item", wraps=update_item) as update:
+            assert ai_worker_handler(event, None) == {"batchItemFailures": []}
+        update.assert_called_once()
+        assert "prompt" not in update.call_args[0][2]
+        status = ai_query_status_handler({"pathParameters": {"id": query_id}}, None)
+        body = json.loads(status["body"])
+        assert body["status"] == "COMPLETED" and body["response"] == answer
+        assert "expires_at" not in body
+        return get_item("AIQueries", {"query_id": query_id})
+
+    logger.info("1. Short answers are stored as text, with a TTL")
+    stored = run("Short answer.")
+    assert stored["response"] == "Short answer." and stored["prompt"] == "Report"
+    assert stored["expires_at"] > time.time() + query_store.TTL_SECONDS - 60
+
+    logger.info("2. Long answers are compressed")
+    answer = "Revenue grew in every region. " * 200
+    stored = run(answer)
+    assert isinstance(stored["response"], Binary)
+    assert len(stored["response"].value) < len(answer) // 10
+
+    logger.info("3. Very large answers are offloaded to the object store")
+    answer = " ".join(uuid.uuid4().hex for _ in range(500))
+    with patch.object(query_store, "OFFLOAD_MIN_BYTES", 1000):
+        stored = run(answer)
+    reference = stored["response"]
+    assert reference["size"] == len(answer)
+    assert object_store.get_store().get(reference["object_key"])
+    object_store.set_store(None)
+    print("AI query storage verified.")
+
+
+@patch("ai_worker_lambda.handler.query_store.finish")
+@patch("ai_worker_lambda.handler.process_query", return_value="Batched answer")
+def test_ai_worker_batch_flow(mock_process_query, mock_finish):
+    """Tests concurrent batch processing and partial batch failure reporting."""
+    print("\n--- Testing AI Worker Batch Flow ---")
+
+    logger.info("1. Submitting a batch with one malformed record")
+    records = [
+        {
+            "messageId": f"msg-{i}",
+            "body": json.dumps({"query_id": f"q-{i}", "prompt": f"Hi {i}"}),
+        }
+        for i in range(3)
+    ]
+    records.append({"messageId": "msg-bad", "body": "not json"})
+    response = ai_worker_handler({"Records": records}, None)
+
+    logger.info("2. Verifying only the malformed record is redelivered")
+    assert response == {"batchItemFailures": [{"itemIdentifier": "msg-bad"}]}
+    assert mock_process_query.call_count == 3
+    assert mock_finish.call_count == 3
+    written = [c[0][0] for c in mock_finish.call_args_list]
+    assert sorted(item["query_id"] for item in written) == ["q-0", "q-1", "q-2"]
+    assert all(item["status"] == "COMPLETED" for item in written)
+
+
+@patch("common.openai_agent.openai.ChatCompletion.create")
+def test_single_flight_flow(mock_openai_create):
+    """Tests that identical in-flight queries share one model call."""
+    print("\n--- Testing Single-Flight Coalescing ---")
+    import time
+
+    def slow_answer(**kwargs):
+        time.sleep(0.5)
+        return {"choices": [{"message": {"content": "Shared insight."}}]}
+
+    mock_openai_create.side_effect = slow_answer
+    response_cache.clear()
+    prompt = f"Churn risk? {uuid.uuid4()}"
+    records = [
+        {
+            "messageId": f"sf-msg-{i}",
+            "body": json.dumps({"query_id": f"sf-{i}", "prompt": prompt}),
+        }
+        for i in range(2)
+    ]
+
+    logger.info("1. Two identical queries in one batch call the model once")
+    response = ai_worker_handler({"Records": records}, None)
+    assert mock_openai_create.call_count == 1
+    assert len(response["batchItemFailures"]) == 1
+    waiter_msg = response["batchItemFailures"][0]["itemIdentifier"]
+    waiter = f"sf-{waiter_msg[-1]}"
+    owner = "sf-1" if waiter == "sf-0" else "sf-0"
+    item = get_item("AIQueries", {"query_id": waiter})
+    assert item["status"] == "COMPLETED"
+    assert item["response"] == "Shared insight."
+    assert item["coalesced_with"] == owner
+
+    logger.info("2. The waiter's redelivered message is acknowledged without work")
+    redelivered = dict(
+        records[int(waiter[-1])], attributes={"ApproximateReceiveCount": "2"}
+    )
+    assert ai_worker_handler({"Records": [redelivered]}, None) == {
+        "batchItemFailures": []
+    }
+    assert mock_openai_create.call_count == 1
+
+    logger.info("3. A live lease links new duplicates, a stale one is taken over")
+    key = openai_agent.cache_key(f"Another {uuid.uuid4()}", "dataset")
+    single_flight.acquire(key, "sf-owner")
+    try:
+        single_flight.acquire(key, "sf-late")
+        assert False, "a live lease must coalesce"
+    except single_flight.Coalesced as e:
+        assert e.owner == "sf-owner"
+    with patch("common.single_flight.time.time", return_value=time.time() + 3600):
+        single_flight.acquire(key, "sf-takeover")
+    assert single_flight.release(key, "sf-owner") == []
+    assert single_flight.release(key, "sf-takeover") == ["sf-late"]
+
+    logger.info("4. Waiters are announced even when the owner's write fails")
+    prompt = f"Churn risk? {uuid.uuid4()}"
+    records = [
+        {
+            "messageId": f"sfn-msg-{i}",
+            "body": json.dumps(
+                {"query_id": f"sfn-{i}", "prompt": prompt, "callback_url": "http://x"}
+            ),
+        }
+        for i in range(2)
+    ]
+    with patch(
+        "ai_worker_lambda.handler.query_store.finish", side_effect=Exception("down")
+    ), patch("ai_worker_lambda.handler.notify_completed") as mock_notify:
+        response = ai_worker_handler({"Records": records}, None)
+    assert len(response["batchItemFailures"]) == 2
+    announced = [i["query_id"] for c in mock_notify.call_args_list for i in c[0][0]]
+    assert len(announced) == 1 and announced[0].startswith("sfn-")
+    print("Single-flight coalescing verified.")
+
+
+@patch("common.rate_limit.time.sleep")
+@patch("common.openai_agent.openai.ChatCompletion.create")
+def test_rate_limited_worker(mock_openai_create, mock_sleep):
+    """Tests throttling backoff, AIMD concurrency and retryable SQS failures."""
+    print("\n--- Testing Rate-Limited Worker ---")
+    import openai
+
+    def throttled(retry_after="2"):
+        return openai.error.RateLimitError(
+            "Rate limit reached", headers={"retry-after": retry_after}
+        )
+
+    rate_limit.reset()
+    answer = {"choices": [{"message": {"content": "After backoff."}}]}
+    put_item("AIQueries", {"query_id": "rl-0", "status": "QUEUED"})
+
+    def record(i):
+        body = {"query_id": f"rl-{i}", "prompt": "Throttled?", "no_cache": True}
+        return {"messageId": f"rl-msg-{i}", "body": json.dumps(body)}
+
+    logger.info("1. A 429 is retried after its Retry-After and then succeeds")
+    mock_openai_create.side_effect = [throttled(), answer]
+    assert ai_worker_handler({"Records": [record(0)]}, None) == {
+        "batchItemFailures": []
+    }
+    assert mock_openai_create.call_count == 2
+    assert mock_sleep.call_args[0][0] >= 2
+    assert get_item("AIQueries", {"query_id": "rl-0"})["status"] == "COMPLETED"
+    stats = rate_limit.get_stats()
+    assert stats["throttled"] == 1
+    assert stats["concurrency_limit"] < rate_limit.INITIAL_CONCURRENCY
+
+    logger.info("2. A call throttled on every attempt goes back to SQS, not FAILED")
+    put_item("AIQueries", {"query_id": "rl-1", "status": "QUEUED"})
+    mock_openai_create.side_effect = throttled("0")
+    assert ai_worker_handler({"Records": [record(1)]}, None) == {
+        "batchItemFailures": [{"itemIdentifier": "rl-msg-1"}]
+    }
+    assert get_item("AIQueries", {"query_id": "rl-1"})["status"] == "QUEUED"
+    assert rate_limit.get_stats()["exhausted"] == 1
+
+    logger.info("3. The token bucket makes callers wait once the quota is spent")
+    bucket = rate_limit.TokenBucket(60)
+    assert bucket.reserve(60) == 0.0
+    assert 0.9 < bucket.reserve(1) <= 1.0
+
+    logger.info("4. Rejected and abandoned reservations go back to the bucket")
+
+    def gives_up(fn):
+        try:
+            rate_limit.call(fn, tokens=300)
+        except rate_limit.RetryableError:
+            return True
+        return False
+
+    def rejected():
+        raise rate_limit.Throttled("429")
+
+    rate_limit.reset()
+    with patch.object(rate_limit, "TPM_LIMIT", 600), patch.object(
+        rate_limit, "MAX_WAIT_SECONDS", 1
+    ):
+        _, tokens, _ = rate_limit._limiters()
+        assert gives_up(rejected)
+        assert tokens.level > 599
+        # With the quota spent each caller faces a 30 s wait and gives up.
+        tokens.reserve(600)
+        assert all(gives_up(lambda: "never sent") for _ in range(3))
+        assert tokens.level > -1
+    rate_limit.reset()
+    print("Rate limiting verified.")
+
+
+@patch("common.openai_agent.openai.ChatCompletion.create")
+def test_ai_response_cache(mock_openai_create):
+    """Tests that repeated prompts are answered from the response cache."""
+    print("\n--- Testing AI Response Cache ---")
+    mock_openai_create.return_value = {
+        "choices": [{"message": {"content": "Cached insight."}}]
+    }
+    response_cache.clear()
+    prompt = f"Top industries? {uuid.uuid4()}"
+
+    logger.info("1. First call goes to the model")
+    assert process_query(prompt, "dataset-v1") == "Cached insight."
+    assert mock_openai_create.call_count == 1
+
+    logger.info("2. Same prompt (modulo whitespace) is a cache hit")
+    assert process_query(f"  {prompt} ", "dataset-v1") == "Cached insight."
+    assert mock_openai_create.call_count == 1
+    assert response_cache.get_stats()["local_hits"] == 1
+
+    logger.info("3. A new dataset or a bypass flag calls the model again")
+    process_query(prompt, "dataset-v2")
+    process_query(prompt, "dataset-v1", use_cache=False)
+    assert mock_openai_create.call_count == 3
+
+
+def test_jwt_cache_and_jwks():
+    """Tests the verified-claims cache and RS256 verification against a JWKS."""
+    print("\n--- Testing JWT Cache and JWKS ---")
+    import tempfile
+    import time
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from jwt.algorithms import RSAAlgorithm
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": "test-key", "alg": "RS256", "use": "sig"})
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({"keys": [jwk]}, f)
+
+    def cognito_token(kid="test-key", **claims):
+        claims.setdefault("exp", int(time.time()) + 3600)
+        return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+    auth.clear_cache()
+    with patch.object(auth, "JWT_JWKS_FILE", f.name), patch.object(
+        auth, "JWT_AUDIENCE", "app-client"
+    ), patch.object(auth.jwt, "decode", wraps=jwt.decode) as mock_decode:
+        logger.info("1. A Cognito token is verified once, then served from cache")
+        token = cognito_token(aud="app-client", **{"cognito:groups": ["admins"]})
+        event = {"headers": {"Authorization": f"Bearer {token}"}}
+        assert auth.is_admin(event)
+        assert auth.is_admin(event)
+        assert auth.check_jwt_auth(event)
+        assert mock_decode.call_count == 1
+
+        logger.info("2. Wrong audience, unknown kid and expired tokens are rejected")
+        assert auth.decode_jwt(cognito_token(aud="other-client")) is None
+        assert auth.decode_jwt(cognito_token(kid="rotated", aud="app-client")) is None
+        assert auth.decode_jwt(cognito_token(aud="app-client", exp=1)) is None
+
+        logger.info("3. Cached claims expire with the token")
+        verified = mock_decode.call_count
+        with patch("common.auth.time.time", return_value=time.time() + 7200):
+            auth.decode_jwt(token)
+        assert mock_decode.call_count == verified + 1
+
+    logger.info("4. A failed JWKS load is not retried on every request")
+    auth.clear_cache()
+    with patch.object(auth, "JWT_JWKS_URL", "https://jwks.invalid"), patch.object(
+        auth, "_fetch_jwks", side_effect=OSError("down")
+    ) as mock_fetch:
+        for _ in range(3):
+            assert auth.decode_jwt(cognito_token(aud="app-client")) is None
+    assert mock_fetch.call_count == 1
+
+    logger.info("5. HS256 tokens still verify with the shared secret")
+    assert auth.decode_jwt(auth.encode_jwt({"sub": "u1"}))["sub"] == "u1"
+    assert auth.decode_jwt("not-a-token") is None
+    auth.clear_cache()
+    os.unlink(f.name)
+    print("JWT cache and JWKS verification verified.")
+
+
 @patch("common.auth.decode_jwt")
 def test_rbac_flow(mock_decode_jwt):
     """Tests Role-Based Access Control on protected endpoints."""
@@ -153,7 +747,9 @@ def test_rbac_flow(mock_decode_jwt):
     logger.info("1. Testing access for ADMIN user (should SUCCEED)")
     admin_event = {"headers": {"Authorization": f"Bearer {MOCK_ADMIN_TOKEN}"}}
     # We patch the Salesforce call since we're only testing RBAC logic here
-    with patch("salesforce_sync_lambda.handler.fetch_customers", return_value=[]):
+    with patch(
+        "salesforce_sync_lambda.handler.fetch_customers", return_value=[]
+    ), patch("salesforce_sync_lambda.handler.rebuild_snapshot"):
         response = salesforce_sync_handler(admin_event, None)
         print("Admin Response:", response)
         assert response["statusCode"] == 200
@@ -173,37 +769,55 @@ def test_rbac_flow(mock_decode_jwt):
     assert response["statusCode"] == 403
 
 
-@patch("salesforce_poll_lambda.handler.get_dynamodb_table")
-@patch("salesforce_poll_lambda.handler.requests.get")
-@patch("salesforce_poll_lambda.handler.get_salesforce_token")
-@patch("salesforce_poll_lambda.handler.ssm")
+@patch("salesforce_poll_lambda.handler.update_snapshot")
+@patch("salesforce_poll_lambda.handler.batch_get_items")
+@patch("common.aio.dynamodb.batch_write_items", new_callable=AsyncMock)
+@patch("common.salesforce.get_session")
+@patch("common.salesforce.get_salesforce_token")
+@patch("salesforce_poll_lambda.handler.save_checkpoint")
+@patch("salesforce_poll_lambda.handler.load_checkpoint")
 def test_salesforce_poll_flow(
-    mock_ssm, mock_get_sf_token, mock_requests_get, mock_get_table
+    mock_load_checkpoint,
+    mock_save_checkpoint,
+    mock_get_sf_token,
+    mock_session,
+    mock_write,
+    mock_batch_get_items,
+    mock_update_snapshot,
 ):
     """Tests the scheduled Salesforce polling flow using mocks."""
     print("\n--- Testing Salesforce Poll Flow ---")
 
     # 1. Setup mocks for external dependencies
-    logger.info("1. Setting up mocks for Salesforce, SSM, and DynamoDB")
-    mock_ssm.get_parameter.return_value = {
-        "Parameter": {"Value": "2023-01-01T00:00:00Z"}
+    logger.info("1. Setting up mocks for Salesforce, the checkpoint, and DynamoDB")
+    mock_load_checkpoint.return_value = {
+        "modstamp": "2023-01-01T00:00:00.000+0000",
+        "ids": [],
+        "version": 3,
     }
+    mock_save_checkpoint.side_effect = lambda sobject, cp: dict(cp, version=4)
     mock_get_sf_token.return_value = ("mock-token", "http://salesforce.mock")
     mock_sf_response = MagicMock()
     mock_sf_response.json.return_value = {
         "records": [
-            {"Id": "SF001", "Name": "Updated Corp"},
-            {"Id": "SF002", "Name": "New LLC"},
+            {
+                "Id": "SF001",
+                "Name": "Updated Corp",
+                "SystemModstamp": "2023-01-02T00:00:00.000+0000",
+            },
+            {
+                "Id": "SF002",
+                "Name": "New LLC",
+                "SystemModstamp": "2023-01-02T00:00:05.000+0000",
+            },
         ]
     }
     mock_sf_response.raise_for_status.return_value = None
-    mock_requests_get.return_value = mock_sf_response
+    mock_sf_response.status_code = 200
+    mock_session.return_value.request.return_value = mock_sf_response
 
-    # Setup mock for the DynamoDB table and its batch_writer context manager
-    mock_table = MagicMock()
-    mock_batch_writer = MagicMock()
-    mock_table.batch_writer.return_value.__enter__.return_value = mock_batch_writer
-    mock_get_table.return_value = mock_table
+    mock_write.return_value = {"written": 2, "retried": 0, "failed": 0}
+    mock_batch_get_items.return_value = [{"Id": "SF001", "Name": "Old Corp"}]
 
     # 2. Execute the polling handler
     logger.info("2. Executing the polling handler")
@@ -214,43 +828,367 @@ def test_salesforce_poll_flow(
 
     # 3. Verify the mock interactions
     logger.info("3. Verifying mock calls")
-    mock_table.batch_writer.assert_called_once()
-    assert mock_batch_writer.put_item.call_count == 2
-    mock_batch_writer.put_item.assert_any_call(
-        Item={"Id": "SF001", "Name": "Updated Corp"}
-    )
-    mock_ssm.put_parameter.assert_called_once()
+    soql = mock_session.return_value.request.call_args[1]["params"]["q"]
+    assert "WHERE SystemModstamp >= 2023-01-01T00:00:00Z" in soql
+    assert soql.endswith("ORDER BY SystemModstamp, Id")
+    mock_write.assert_awaited_once()
+    written = mock_write.call_args[0][1]
+    assert len(written) == 2
+    updated = {
+        "Id": "SF001",
+        "Name": "Updated Corp",
+        "SystemModstamp": "2023-01-02T00:00:00.000+0000",
+    }
+    updated = content_hash.with_hash(updated)
+    assert updated in written
+    saved = mock_save_checkpoint.call_args[0][1]
+    assert saved["modstamp"] == "2023-01-02T00:00:05.000+0000"
+    assert saved["ids"] == ["SF002"]
+    changes = mock_update_snapshot.call_args[0][0]
+    assert changes[0] == ({"Id": "SF001", "Name": "Old Corp"}, updated)
+    assert changes[1][0] is None
+
 
+@patch("salesforce_poll_lambda.handler.update_snapshot")
+@patch("salesforce_poll_lambda.handler.batch_get_items", return_value=[])
+@patch("common.aio.dynamodb.batch_write_items", new_callable=AsyncMock)
+@patch("common.change_capture.stream_records")
+def test_salesforce_poll_resume(
+    mock_stream_records, mock_write, mock_batch_get_items, mock_update_snapshot
+):
+    """Tests that a timed-out poll resumes from its DynamoDB checkpoint."""
+    print("\n--- Testing Salesforce Poll Resume ---")
+    get_table("SyncState").delete_item(Key={"state_id": "salesforce_changes:Account"})
+    start = {"modstamp": "2024-05-01T00:00:00.000+0000", "ids": [], "version": None}
+    change_capture.save_checkpoint("Account", start)
+    stamps = ["2024-05-01T10:00:00.100+0000", "2024-05-01T10:00:00.100Z"]
+    stamps.append("2024-05-01T10:00:01.000+0000")
+    records = [
+        {"Id": f"R{i}", "Name": "Resumed", "SystemModstamp": stamp}
+        for i, stamp in enumerate(stamps)
+    ]
+    # Salesforce returns every record at or after the second-level bound.
+    mock_stream_records.side_effect = lambda soql, bulk=None: (dict(r) for r in records)
+    mock_write.return_value = {"written": 1, "retried": 0, "failed": 0}
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 1000
+
+    logger.info("1. A run that is out of time stops after its first chunk")
+    with patch("salesforce_poll_lambda.handler.CHUNK_SIZE", 1):
+        body = json.loads(salesforce_poll_handler({}, context)["body"])
+    assert body["complete"] is False
+    assert mock_write.await_count == 1
+
+    logger.info("2. The next run resumes after the committed record")
+    body = json.loads(salesforce_poll_handler({}, None)["body"])
+    assert body["complete"] is True
+    written = [item["Id"] for c in mock_write.call_args_list for item in c[0][1]]
+    assert written == ["R0", "R1", "R2"]
+
+    logger.info("3. Nothing is re-read once the checkpoint has caught up")
+    body = json.loads(salesforce_poll_handler({}, None)["body"])
+    assert "Successfully synced 0 records" in body["message"]
+    assert body["checkpoint"] == "2024-05-01T10:00:01.000+0000"
+
+
+def _sf_response(json_body=None, chunks=None, headers=None, status_code=200):
+    response = MagicMock()
+    response.json.return_value = json_body
+    response.raise_for_status.return_value = None
+    response.status_code = status_code
+    response.encoding = "utf-8"
+    response.iter_content.return_value = chunks or []
+    response.headers = headers or {}
+    return response
+
+
+@patch("common.salesforce.time.sleep")
+@patch("common.salesforce.get_session")
+@patch("common.salesforce.get_salesforce_token")
+def test_salesforce_streaming(mock_token, mock_session, mock_sleep):
+    """Tests nextRecordsUrl pagination and the Bulk API 2.0 CSV stream."""
+    print("\n--- Testing Salesforce Streaming ---")
+    mock_token.return_value = ("mock-token", "http://salesforce.mock")
+    mock_request = mock_session.return_value.request
+
+    logger.info("1. REST pages are followed through nextRecordsUrl")
+    mock_request.side_effect = [
+        _sf_response(
+            {
+                "totalSize": 3,
+                "done": False,
+                "nextRecordsUrl": "/services/data/v58.0/query/01g-2000",
+                "records": [{"Id": "A1"}, {"Id": "A2"}],
+            }
+        ),
+        _sf_response({"totalSize": 3, "done": True, "records": [{"Id": "A3"}]}),
+    ]
+    records = stream_records("SELECT Id FROM Account", bulk=False)
+    assert [r["Id"] for r in records] == ["A1", "A2", "A3"]
+    assert mock_request.call_args_list[1][0][1].endswith("/query/01g-2000")
+
+    logger.info("2. Bulk API 2.0 results are parsed from chunked CSV pages")
+    mock_request.reset_mock()
+    mock_request.side_effect = [
+        _sf_response({"id": "750JOB"}),
+        _sf_response({"state": "InProgress"}),
+        _sf_response({"state": "JobComplete"}),
+        _sf_response(
+            chunks=['"Id","Name","AnnualRevenue"\n"B1","Multi\nLine', ' Co","12.5"\n'],
+            headers={"Sforce-Locator": "LOC1"},
+        ),
+        _sf_response(
+            chunks=['"Id","Name","AnnualRevenue"\n"B2","Empty Revenue",""\n'],
+            headers={"Sforce-Locator": "null"},
+        ),
+    ]
+    records = list(stream_records("SELECT Id FROM Account", bulk=True))
+    assert records == [
+        {"Id": "B1", "Name": "Multi\nLine Co", "AnnualRevenue": 12.5},
+        {"Id": "B2", "Name": "Empty Revenue"},
+    ]
+    assert mock_request.call_args_list[0][0][0] == "POST"
+    assert mock_request.call_args_list[-1][1]["params"]["locator"] == "LOC1"
 
+
+@patch("common.salesforce.get_session")
+def test_salesforce_token_cache(mock_session):
+    """Tests that the OAuth token is reused and refreshed after a 401."""
+    print("\n--- Testing Salesforce Token Cache ---")
+    invalidate_token()
+    session = mock_session.return_value
+    session.post.side_effect = [
+        _sf_response({"access_token": "T1", "instance_url": "http://sf.mock"}),
+        _sf_response({"access_token": "T2", "instance_url": "http://sf.mock"}),
+    ]
+
+    logger.info("1. Warm calls reuse the cached token")
+    assert get_salesforce_token() == ("T1", "http://sf.mock")
+    assert get_salesforce_token() == ("T1", "http://sf.mock")
+    assert session.post.call_count == 1
+
+    logger.info("2. A 401 refreshes the token and retries the request once")
+    session.request.side_effect = [
+        _sf_response(status_code=401),
+        _sf_response({"records": []}),
+    ]
+    sf_request("GET", "/services/data/v58.0/limits")
+    assert session.post.call_count == 2
+    retry_headers = session.request.call_args_list[1][1]["headers"]
+    assert retry_headers["Authorization"] == "Bearer T2"
+    invalidate_token()
+
+
+@patch("salesforce_sync_lambda.handler.rebuild_snapshot")
 @patch("salesforce_sync_lambda.handler.is_admin", return_value=True)
-@patch("salesforce_sync_lambda.handler.put_item")
 @patch("salesforce_sync_lambda.handler.fetch_customers")
-def test_salesforce_sync_flow(mock_fetch_customers, mock_put_item, mock_is_admin):
-    """Tests the manual Salesforce sync flow logic."""
+def test_salesforce_sync_flow(mock_fetch_customers, mock_is_admin, mock_rebuild):
+    """Tests the manual Salesforce sync flow and its change detection."""
     print("\n--- Testing Salesforce Sync Flow ---")
-
-    # 1. Arrange
-    logger.info("1. Setting up mocks for manual Salesforce sync")
-    mock_fetch_customers.return_value = [
-        {"Id": "SF_MANUAL_01", "Name": "Manual Sync Corp"},
+    suffix = uuid.uuid4().hex[:8]
+    contacts = [
+        {
+            "attributes": {"type": "Contact"},
+            "Id": f"SF_MANUAL_{suffix}_{i}",
+            "Name": f"Manual Sync Corp {i}",
+            "Email": None,
+            "AnnualRevenue": 1000.0 * i,
+        }
+        for i in range(3)
     ]
     admin_event = {"headers": {"Authorization": "Bearer any-admin-token"}}
 
-    # 2. Act
-    logger.info("2. Executing the manual sync handler")
-    response = salesforce_sync_handler(admin_event, None)
-    print("Sync Handler Response:", response)
+    def sync(records):
+        mock_fetch_customers.return_value = iter([dict(r) for r in records])
+        response = salesforce_sync_handler(admin_event, None)
+        assert response["statusCode"] == 200, response
+        return json.loads(response["body"])
 
-    # 3. Assert
-    logger.info("3. Verifying mock calls and response")
-    assert response["statusCode"] == 200
-    assert "Successfully synced 1 customers" in response["body"]
-    mock_fetch_customers.assert_called_once()
-    mock_put_item.assert_called_once_with(
-        os.environ["CUSTOMERS_TABLE"],
-        {"Id": "SF_MANUAL_01", "Name": "Manual Sync Corp"},
+    logger.info("1. A first sync inserts every customer with its content hash")
+    version = listing_cache.current_version()
+    body = sync(contacts)
+    assert body["inserted"] == 3 and body["written"] == 3
+    assert body["retried"] == 0 and body["failed"] == 0
+    assert "Successfully synced 3 customers" in body["message"]
+    stored = get_item("Customers", {"Id": f"SF_MANUAL_{suffix}_1"})
+    assert stored["Name"] == "Manual Sync Corp 1" and "Email" not in stored
+    expected = dict(stored)
+    assert stored[content_hash.HASH_ATTRIBUTE] == content_hash.compute(expected)
+    mock_rebuild.assert_called_once()
+    assert listing_cache.current_version() == version + 1
+
+    logger.info("2. An identical sync writes nothing and invalidates nothing")
+    with patch.object(content_hash, "_put_if_unchanged") as mock_put, patch.object(
+        content_hash, "batch_write_items"
+    ) as mock_batch:
+        body = sync(contacts)
+    mock_put.assert_not_called()
+    mock_batch.assert_not_called()
+    assert body["unchanged"] >= 3 and body["written"] == 0
+    mock_rebuild.assert_called_once()
+    assert listing_cache.current_version() == version + 1
+
+    logger.info("3. Only the changed customer is rewritten")
+    contacts[2] = dict(contacts[2], Name="Renamed Corp")
+    body = sync(contacts)
+    assert body["updated"] == 1 and body["inserted"] == 0
+    assert get_item("Customers", {"Id": f"SF_MANUAL_{suffix}_2"})["Name"] == (
+        "Renamed Corp"
     )
 
+    logger.info("4. A record that moved since the index was read is left alone")
+    key = f"SF_MANUAL_{suffix}_0"
+    index = {key: content_hash.load_index("Customers")[key]}
+    update_item("Customers", {"Id": key}, {content_hash.HASH_ATTRIBUTE: "newer"})
+    item = {"Id": key, "Name": "Stale Corp"}
+    counts = content_hash.sync_items("Customers", [item], index)
+    assert counts["conflicts"] == 1
+    assert get_item("Customers", {"Id": key})["Name"] == "Manual Sync Corp 0"
+
+    logger.info("5. Records stream through in windows; new ones are batch-written")
+    pulled, batches = [], []
+
+    def stream():
+        for i in range(5):
+            pulled.append(i)
+            yield {"Id": f"SF_MANUAL_{suffix}_w{i}", "AnnualRevenue": float(i)}
+
+    def record_batch(table_name, batch, max_workers):
+        batches.append((len(pulled), len(batch)))
+        return {"written": len(batch), "retried": int(len(batches) == 1), "failed": 0}
+
+    with patch.object(content_hash, "WINDOW_SIZE", 2), patch.object(
+        content_hash, "batch_write_items", side_effect=record_batch
+    ):
+        counts = content_hash.sync_items("Customers", stream(), {})
+    assert counts["inserted"] == 5 and counts["retried"] == 1
+    assert batches == [(2, 2), (4, 2), (5, 1)]
+    assert content_hash.compute({"R": 1.0}) == content_hash.compute({"R": 1})
+
+
+@patch("common.dynamodb.time.sleep")
+@patch("common.dynamodb.get_resource")
+def test_batch_write_items(mock_get_resource, mock_sleep):
+    """Tests 25-item chunking and UnprocessedItems retries."""
+    print("\n--- Testing DynamoDB Batch Write ---")
+    items = [{"Id": f"BW{i:03d}", "Name": "Bulk"} for i in range(60)]
+    # A duplicate key within one chunk must be collapsed into a single request.
+    items.insert(10, {"Id": "BW000", "Name": "Bulk (latest)"})
+    leftover = [{"PutRequest": {"Item": {"Id": "BW001", "Name": "Bulk"}}}]
+    batch_write_item = mock_get_resource.return_value.batch_write_item
+    batch_write_item.side_effect = [
+        {"UnprocessedItems": {"Customers": leftover}},
+        {"UnprocessedItems": {}},
+        {"UnprocessedItems": {}},
+        {"UnprocessedItems": {}},
+    ]
+
+    counts = batch_write_items("Customers", iter(items))
+
+    assert counts == {"written": 60, "retried": 1, "failed": 0}
+    calls = batch_write_item.call_args_list
+    sizes = [len(c[1]["RequestItems"]["Customers"]) for c in calls]
+    assert sizes == [25, 1, 25, 10]
+    first_chunk = calls[0][1]["RequestItems"]["Customers"]
+    assert {"Id": "BW000", "Name": "Bulk (latest)"} in [
+        r["PutRequest"]["Item"] for r in first_chunk
+    ]
+    assert mock_sleep.call_count == 1
+
+
+def test_response_encoding():
+    """Tests DynamoDB-aware JSON encoding, compression and NDJSON listings."""
+    print("\n--- Testing Response Encoding ---")
+    import base64
+    import gzip
+    from decimal import Decimal
+    from boto3.dynamodb.types import Binary
+
+    logger.info(
+        "1. Decimals, sets and binaries encode the same with and without orjson"
+    )
+    item = {"Id": "E1", "AnnualRevenue": Decimal("1500000"), "Score": Decimal("2.5")}
+    item.update(Tags={"b", "a"}, Blob=Binary(b"hi"))
+    fast = responses.dumps(item, sort_keys=True)
+    with patch.object(responses, "orjson", None):
+        assert responses.dumps(item, sort_keys=True) == fast
+    assert json.loads(fast) == {
+        "AnnualRevenue": 1500000,
+        "Blob": "aGk=",
+        "Id": "E1",
+        "Score": 2.5,
+        "Tags": ["a", "b"],
+    }
+
+    logger.info("2. Large listings are gzip-compressed NDJSON on request")
+    for i in range(40):
+        put_item("Customers", {"Id": f"ENC{i:02d}", "AnnualRevenue": Decimal(i)})
+    # Direct writes skip the Salesforce writers' bump; cached listings would hide them.
+    listing_cache.bump_version()
+    headers = {"Accept": "application/x-ndjson", "Accept-Encoding": "gzip, br;q=0"}
+    event = {"headers": headers, "queryStringParameters": {"export": "true"}}
+    response = customers_handler(event, None)
+    assert response["isBase64Encoded"] is True
+    assert response["headers"]["Content-Encoding"] == "gzip"
+    body = gzip.decompress(base64.b64decode(response["body"])).decode("utf-8")
+    rows = [json.loads(line) for line in body.splitlines()]
+    assert {"Id": "ENC07", "AnnualRevenue": 7} in rows
+
+    logger.info("3. Small bodies and clients without Accept-Encoding stay plain")
+    small = responses.respond({"headers": {"Accept-Encoding": "gzip"}}, {"ok": True})
+    assert small["body"] == '{"ok":true}' and "isBase64Encoded" not in small
+    assert (
+        responses.accepted_encoding({"headers": {"accept-encoding": "gzip;q=0"}})
+        is None
+    )
+
+    logger.info("4. Base64 request bodies are decoded")
+    encoded = base64.b64encode(b'{"prompt": "hi"}').decode("ascii")
+    assert responses.request_body({"body": encoded, "isBase64Encoded": True}) == {
+        "prompt": "hi"
+    }
+    print("Response encoding verified.")
+
+
+def test_instrumentation():
+    """Tests spans, correlation ids and the per-invocation EMF record."""
+    print("\n--- Testing Instrumentation ---")
+    import logging
+
+    emitted = []
+    context = MagicMock(aws_request_id="req-123")
+    with patch.object(instrumentation, "METRICS_ENABLED", True), patch.object(
+        instrumentation, "TRACE_SAMPLE_RATE", 1.0
+    ), patch.object(instrumentation, "_emit", emitted.append):
+        logger.info("1. One invocation flushes its spans and one EMF record")
+        response = customers_handler({"queryStringParameters": {"limit": "2"}}, context)
+        assert response["statusCode"] == 200
+
+    emf = [entry for entry in emitted if "_aws" in entry]
+    assert len(emf) == 1
+    record = emf[0]
+    assert record["function"] == "customers_lambda"
+    assert record["request_id"] == "req-123"
+    names = {m["Name"] for m in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+    assert {"dynamodb", "serialize", "handler"} <= names
+    spans = [entry for entry in emitted if entry.get("span") == "dynamodb"]
+    assert spans and spans[0]["operation"] == "Scan"
+    assert spans[0]["request_id"] == "req-123"
+
+    logger.info("2. Bound ids appear in JSON log lines")
+    log_record = logging.LogRecord("t", logging.INFO, __file__, 1, "hi", None, None)
+    with instrumentation.bind(query_id="q-42"):
+        line = json.loads(instrumentation.JsonFormatter().format(log_record))
+    assert line["query_id"] == "q-42" and line["message"] == "hi"
+
+    logger.info("3. Metrics keep a bounded sample of their values")
+    for i in range(250):
+        instrumentation.put_metric("sampled", i)
+    assert len(instrumentation._metrics["sampled"]["values"]) == 100
+    instrumentation.flush()
+    assert instrumentation._metrics == {}
+    print("Instrumentation verified.")
+
 
 def test_customers_flow():
     """Tests adding and fetching customers."""
@@ -260,6 +1198,7 @@ def test_customers_flow():
         "Customers", {"Id": "CUST01", "Name": "Alice", "Email": "alice@example.com"}
     )
     put_item("Customers", {"Id": "CUST02", "Name": "Bob", "Email": "bob@example.com"})
+    listing_cache.bump_version()
 
     # Corrected to pass two arguments as the handler expects
     customers_response = customers_handler({}, None)
@@ -268,11 +1207,374 @@ def test_customers_flow():
     assert len(json.loads(customers_response["body"])) >= 2
 
 
+def test_customers_pagination_flow():
+    """Tests cursor pagination, projection and parallel export of customers."""
+    print("\n--- Testing Customers Pagination Flow ---")
+    logger.info("1. Adding customers")
+    expected = {f"PAGE{i:02d}" for i in range(5)}
+    for customer_id in expected:
+        put_item("Customers", {"Id": customer_id, "Name": "Paged", "Email": "p@x.io"})
+    listing_cache.bump_version()
+
+    logger.info("2. Walking every page with limit=2 and a projection")
+    seen = []
+    params = {"limit": "2", "fields": "Id,Name"}
+    while True:
+        response = customers_handler({"queryStringParameters": params}, None)
+        assert response["statusCode"] == 200
+        page = json.loads(response["body"])
+        assert len(page) <= 2
+        assert all(set(item) <= {"Id", "Name"} for item in page)
+        seen.extend(item["Id"] for item in page)
+        next_token = response["headers"].get("X-Next-Token")
+        if not next_token:
+            break
+        params = dict(params, next_token=next_token)
+    assert expected <= set(seen)
+    assert len(seen) == len(set(seen))
+
+    logger.info("3. Exporting with a parallel segment scan")
+    response = customers_handler({"queryStringParameters": {"export": "true"}}, None)
+    exported = {item["Id"] for item in json.loads(response["body"])}
+    assert exported == set(seen)
+
+    logger.info("4. Rejecting a malformed token")
+    bad = {"queryStringParameters": {"next_token": "not-a-token"}}
+    assert customers_handler(bad, None)["statusCode"] == 400
+
+
+def test_customer_listing_cache():
+    """Tests version-keyed listing caching, ETags and 304 responses."""
+    print("\n--- Testing Customer Listing Cache ---")
+    listing_cache.clear()
+    listing_cache.bump_version()
+    event = {"headers": {}, "queryStringParameters": {"limit": "3"}}
+
+    logger.info("1. The first listing is computed and tagged with the version")
+    first = customers_handler(event, None)
+    assert first["statusCode"] == 200
+    tag = first["headers"]["ETag"]
+
+    logger.info("2. Until the next sync, reads never list the table again")
+    with patch("customers_lambda.handler.list_customers", side_effect=AssertionError):
+        revalidate = dict(event, headers={"If-None-Match": tag})
+        assert customers_handler(revalidate, None)["statusCode"] == 304
+        again = customers_handler(event, None)
+    assert again["headers"]["X-Cache"] == "hit"
+    assert again["body"] == first["body"] and again["headers"]["ETag"] == tag
+
+    logger.info("3. A committed write bumps the version and the ETag")
+    listing_cache.bump_version()
+    fresh = customers_handler(revalidate, None)
+    assert fresh["statusCode"] == 200 and fresh["headers"]["ETag"] != tag
+    assert "X-Cache" not in fresh["headers"]
+    print("Customer listing cache verified.")
+
+
+def test_customer_queries():
+    """Tests index-backed customer filters, the planner and its scan fallback."""
+    print("\n--- Testing Customer Queries ---")
+    import time
+
+    suffix = uuid.uuid4().hex[:8]
+    industry, kind = f"Mining-{suffix}", f"Partner-{suffix}"
+    # Revenues no other run against the same mock server uses, so revenue
+    # filters only ever match this run's rows.
+    base = 10**18 + time.time_ns() * 1000
+    ids = [f"Q{suffix}{i}" for i in range(5)]
+    for i, customer_id in enumerate(ids):
+        put_item(
+            "Customers",
+            {
+                "Id": customer_id,
+                "Industry": industry,
+                "Type": kind if i < 2 else "Prospect",
+                "AnnualRevenue": base + i * 100,
+            },
+        )
+    # Not in the indexes, which need their AnnualRevenue sort key.
+    put_item("Customers", {"Id": f"Q{suffix}none", "Industry": industry})
+    put_item("Customers", {"Id": f"Q{suffix}big", "AnnualRevenue": base + 10**6})
+    listing_cache.bump_version()
+
+    def get(**params):
+        response = customers_handler({"queryStringParameters": params}, None)
+        assert response["statusCode"] == 200, response
+        return json.loads(response["body"]), response["headers"]
+
+    try:
+        logger.info("1. Industry and revenue filters are one index query")
+        indexes = {
+            i["IndexName"] for i in get_table("Customers").global_secondary_indexes
+        }
+        assert {"IndustryIndex", "TypeIndex"} <= indexes
+        items, headers = get(industry=industry, min_revenue=str(base + 200))
+        assert headers["X-Query-Plan"] == "IndustryIndex"
+        assert sorted(item["Id"] for item in items) == ids[2:]
+
+        logger.info("2. With two indexed filters the more selective index is used")
+        counts = {"Industry": {industry: 5}, "Type": {kind: 2}}
+        customer_queries.clear_stats()
+        with patch("common.dataset_snapshot.group_counts", return_value=counts):
+            items, headers = get(industry=industry, type=kind, min_revenue="0")
+        assert headers["X-Query-Plan"] == "TypeIndex"
+        assert sorted(item["Id"] for item in items) == ids[:2]
+        customer_queries.clear_stats()
+
+        logger.info("3. Pages of an index query follow X-Next-Token")
+        seen, token = [], None
+        while True:
+            params = {"industry": industry, "min_revenue": "0", "limit": "2"}
+            if token:
+                params["next_token"] = token
+            items, headers = get(**params)
+            assert len(items) <= 2
+            seen.extend(item["Id"] for item in items)
+            token = headers.get("X-Next-Token")
+            if not token:
+                break
+        assert sorted(seen) == ids
+
+        logger.info("4. Without a revenue bound, customers without revenue are kept")
+        items, headers = get(industry=industry, export="true")
+        assert headers["X-Query-Plan"] == "scan"
+        assert sorted(item["Id"] for item in items) == ids + [f"Q{suffix}none"]
+
+        logger.info("5. Revenue-only filters fall back to a filtered scan")
+        items, headers = get(min_revenue=str(base + 10**6), export="true")
+        assert headers["X-Query-Plan"] == "scan"
+        assert [item["Id"] for item in items] == [f"Q{suffix}big"]
+        bad = customers_handler(
+            {"queryStringParameters": {"min_revenue": "lots"}}, None
+        )
+        assert bad["statusCode"] == 400
+    finally:
+        # Outsized revenues would crowd the snapshot's top customers elsewhere.
+        for customer_id in ids + [f"Q{suffix}none", f"Q{suffix}big"]:
+            get_table("Customers").delete_item(Key={"Id": customer_id})
+        listing_cache.bump_version()
+    print("Customer queries verified.")
+
+
+def test_dataset_snapshot_flow():
+    """Tests building, incrementally updating and loading the AI dataset snapshot."""
+    print("\n--- Testing Dataset Snapshot Flow ---")
+    logger.info("1. Building a snapshot from Customers")
+    # The shared mock table holds every other test's rows; scan a known set.
+    rows = [
+        {"Id": "SNAP01", "Name": "Big Co", "Industry": "Energy", "AnnualRevenue": 900},
+        {"Id": "SNAP03", "Name": "Small Co", "Industry": "Retail"},
+    ]
+    with patch("common.dataset_snapshot.parallel_scan", return_value=rows) as scan:
+        version = dataset_snapshot.rebuild_snapshot()
+    assert scan.call_args[0][0] == "Customers"
+    dataset_snapshot.clear_cache()
+    text = dataset_snapshot.load_snapshot_text()
+    assert text.startswith("Customers: 2")
+    assert "Big Co" in text and "Retail" in text
+    assert dataset_snapshot.estimate_tokens(text) <= dataset_snapshot.TOKEN_BUDGET
+
+    logger.info("2. Applying a poll change set bumps the version")
+    new_item = {"Id": "SNAP02", "Name": "Bigger Co", "Industry": "Energy"}
+    new_item["AnnualRevenue"] = 10**12
+    assert dataset_snapshot.update_snapshot([(None, new_item)]) == version + 1
+    dataset_snapshot.clear_cache()
+    text = dataset_snapshot.load_snapshot_text()
+    assert text.startswith("Customers: 3")
+    assert text.index("Bigger Co") < text.index("Big Co")
+
+
+@patch("common.openai_agent.openai.ChatCompletion.acreate", new_callable=AsyncMock)
+def test_async_io(mock_acreate):
+    """Tests the asyncio runner and the async DynamoDB, Salesforce and OpenAI helpers."""
+    print("\n--- Testing Async I/O ---")
+    import asyncio
+    from aiohttp import web
+    from common import aio, salesforce
+    from decimal import Decimal
+    from common.aio import aws
+    from common.aio import dynamodb as aio_dynamodb
+    from common.aio import openai_agent as aio_openai_agent
+    from common.aio import salesforce as aio_salesforce
+
+    logger.info("1. gather runs awaitables concurrently within its limit")
+    running = {"now": 0, "peak": 0}
+
+    async def wait(i):
+        running["now"] += 1
+        running["peak"] = max(running["peak"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+        return i
+
+    assert aio.run(aio.gather((wait(i) for i in range(20)), limit=5)) == list(range(20))
+    assert running["peak"] == 5
+
+    logger.info("2. Async DynamoDB helpers read back what they write")
+    # requirements.txt installs aiobotocore; without it this only tests the
+    # executor fallback.
+    assert aws.NATIVE
+    suffix = uuid.uuid4().hex[:8]
+    items = [{"Id": f"A{suffix}{i}", "Name": f"Async {i}"} for i in range(30)]
+
+    async def dynamodb_round_trip():
+        counts = await aio_dynamodb.batch_write_items("Customers", items)
+        await aio_dynamodb.update_item(
+            "Customers", {"Id": f"A{suffix}0"}, {"Name": "Renamed"}
+        )
+        found = await aio_dynamodb.batch_get_items(
+            "Customers", [{"Id": item["Id"]} for item in items]
+        )
+        first = await aio_dynamodb.get_item("Customers", {"Id": f"A{suffix}0"})
+        return counts, found, first
+
+    counts, found, first = aio.run(dynamodb_round_trip())
+    assert counts["written"] == 30 and len(found) == 30
+    assert first["Name"] == "Renamed"
+
+    logger.info("3. The native helpers retry unprocessed writes and keys")
+    client = MagicMock()
+
+    def batch_write(RequestItems):
+        requests = RequestItems["Customers"]
+        first_call = client.batch_write_item.call_count == 1
+        return {"UnprocessedItems": {"Customers": requests[:2]}} if first_call else {}
+
+    def batch_get(RequestItems):
+        request = RequestItems["Customers"]
+        found = [dict(key, Name={"S": "Stub"}) for key in request["Keys"][:1]]
+        rest = dict(request, Keys=request["Keys"][1:])
+        unprocessed = {"Customers": rest} if rest["Keys"] else {}
+        return {"Responses": {"Customers": found}, "UnprocessedKeys": unprocessed}
+
+    client.batch_write_item = AsyncMock(side_effect=batch_write)
+    client.batch_get_item = AsyncMock(side_effect=batch_get)
+    rows = [
+        {"Id": f"S{i}", "AnnualRevenue": Decimal("1.5"), "Tags": {"a"}}
+        for i in range(5)
+    ]
+    with patch.object(aws, "NATIVE", True), patch.object(
+        aio_dynamodb, "_client", AsyncMock(return_value=client)
+    ):
+        counts = aio.run(aio_dynamodb.batch_write_items("Customers", rows))
+        found = aio.run(
+            aio_dynamodb.batch_get_items("Customers", [{"Id": "S0"}, {"Id": "S1"}])
+        )
+    assert counts == {"written": 5, "retried": 2, "failed": 0}
+    sent = client.batch_write_item.call_args_list[0].kwargs["RequestItems"]
+    assert sent["Customers"][0]["PutRequest"]["Item"] == {
+        "Id": {"S": "S0"},
+        "AnnualRevenue": {"N": "1.5"},
+        "Tags": {"SS": ["a"]},
+    }
+    assert found == [{"Id": "S0", "Name": "Stub"}, {"Id": "S1", "Name": "Stub"}]
+    assert client.batch_get_item.call_count == 2
+
+    logger.info("4. Salesforce pages are fetched over aiohttp, renewing a stale token")
+    logins = []
+
+    async def token(request):
+        logins.append(1)
+        return web.json_response(
+            {"access_token": f"t{len(logins)}", "instance_url": base_url}
+        )
+
+    async def query(request):
+        if request.headers["Authorization"] == "Bearer t1":
+            return web.Response(status=401)
+        if request.query.get("q"):
+            return web.json_response(
+                {"done": False, "nextRecordsUrl": "/next", "records": [{"Id": "1"}]}
+            )
+        return web.json_response({"done": True, "records": [{"Id": "2"}]})
+
+    async def start_server():
+        app = web.Application()
+        app.router.add_post("/token", token)
+        app.router.add_get(f"/services/data/{salesforce.API_VERSION}/query", query)
+        app.router.add_get("/next", query)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        aio.on_close(runner.cleanup)
+        return runner.addresses[0][1]
+
+    async def read_all():
+        return [r async for r in aio_salesforce.stream_records("SELECT Id FROM A")]
+
+    base_url = f"http://127.0.0.1:{aio.run(start_server())}"
+    salesforce.invalidate_token()
+    with patch.dict(os.environ, {"SF_AUTH_URL": f"{base_url}/token"}):
+        records = aio.run(read_all())
+    assert [r["Id"] for r in records] == ["1", "2"]
+    assert len(logins) == 2
+    # The async login is shared with the sync API.
+    assert salesforce.get_salesforce_token()[0] == "t2"
+    salesforce.invalidate_token()
+
+    logger.info("5. Model calls share the rate limiter with the threaded path")
+    mock_acreate.return_value = {"choices": [{"message": {"content": "Async!"}}]}
+    rate_limit.reset()
+    answers = aio.run(
+        aio.gather(
+            aio_openai_agent.complete("system", f"question {i}") for i in range(8)
+        )
+    )
+    assert answers == ["Async!"] * 8
+    assert rate_limit.get_stats()["calls"] == 8
+    rate_limit.reset()
+    aio.close()
+    print("Async I/O verified.")
+
+
+@patch("common.dynamodb.boto3.resource")
+def test_dynamodb_registry(mock_resource):
+    """Tests that DynamoDB resources and tables are built once and reused."""
+    print("\n--- Testing DynamoDB Registry ---")
+    reset_registry()
+    try:
+        logger.info("1. Fetching the same table twice")
+        first = get_table("AIQueries")
+        second = get_table("AIQueries")
+        assert first is second
+        mock_resource.assert_called_once()
+
+        logger.info("2. Resetting the registry forces a rebuild")
+        reset_registry()
+        get_table("AIQueries")
+        assert mock_resource.call_count == 2
+    finally:
+        reset_registry()
+
+
 if __name__ == "__main__":
     setup_mock_environment()
     test_ai_flow()
+    test_ai_batch_submit_flow()
+    test_ai_status_delivery()
+    test_ai_streaming_flow()
+    test_prompt_budget_map_reduce()
+    test_ai_worker_batch_flow()
+    test_query_storage()
+    test_ai_response_cache()
+    test_single_flight_flow()
+    test_rate_limited_worker()
+    test_jwt_cache_and_jwks()
     test_rbac_flow()
     test_salesforce_poll_flow()
+    test_salesforce_poll_resume()
+    test_salesforce_streaming()
+    test_salesforce_token_cache()
     test_salesforce_sync_flow()
+    test_batch_write_items()
     test_customers_flow()
+    test_instrumentation()
+    test_response_encoding()
+    test_customers_pagination_flow()
+    test_customer_queries()
+    test_customer_listing_cache()
+    test_dataset_snapshot_flow()
+    test_dynamodb_registry()
+    test_async_io()
     print("\n--- All mock tests completed successfully! ---")